@@ -0,0 +1,597 @@
+#!/usr/bin/env python3
+"DN42 Schema Checker Benchmarks"
+
+from __future__ import print_function
+
+import os
+import sys
+import gc
+import time
+import random
+import argparse
+import contextlib
+import glob
+import importlib.util
+import ipaddress
+import json
+import platform
+import shutil
+import threading
+
+import log
+
+
+def load_schema():
+    "import dn42-schema.py as a module"
+    fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dn42-schema.py")
+    spec = importlib.util.spec_from_file_location("dn42_schema", fn)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+schema = load_schema()
+
+
+# Results are written in this layout; bump when metrics change meaning.
+FORMAT = 1
+
+# Objects are parsed CHUNK at a time so 100x registries fit in memory.
+CHUNK = 20000
+
+
+def list_files(path):
+    "object files under path, as scanned by dn42-schema.py"
+    return list(getattr(schema, "__list_files")(path))
+
+
+def chunked(files):
+    "files CHUNK at a time"
+    for i in range(0, len(files), CHUNK):
+        yield files[i:i + CHUNK]
+
+
+def load_schemas(path):
+    "compiled schemas of a registry by ref"
+    schemas = {}
+    for fn in glob.glob(os.path.join(path, "schema", "*")):
+        s = schema.SchemaDOM(fn)
+        schemas[s.ref] = s
+    return schemas
+
+
+def registry_keys(files):
+    "lookup key set, typed by directory as scan --since does"
+    return frozenset(
+        (schema.XLAT[fn.split("/")[-2] + "/"], fn.split("/")[-1].replace("_", "/"))
+        for fn in files
+    )
+
+
+@contextlib.contextmanager
+def quiet():
+    "drop CHECK lines and log messages"
+    capture = schema.log.default.capture
+    with open(os.devnull, "w") as null, contextlib.redirect_stdout(null):
+        schema.log.default.capture = []
+        try:
+            yield
+        finally:
+            schema.log.default.capture = capture
+
+
+def deep_size(objs):
+    "bytes used by objs and everything they reference, counting shared objects once"
+    seen = set()
+    stack = list(objs)
+    size = 0
+
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        size += sys.getsizeof(o)
+
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple, set, frozenset)):
+            stack.extend(o)
+        elif hasattr(o, "__slots__"):
+            stack.extend(getattr(o, k) for k in o.__slots__ if hasattr(o, k))
+        elif hasattr(o, "__dict__"):
+            stack.append(o.__dict__)
+
+    return size
+
+
+def timed(func, repeat):
+    "best wall time of repeat runs"
+    best = None
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+
+def bench_parse(path, repeat):
+    "FileDOM parse throughput and memory"
+    files = list_files(path)
+    nbytes = sum(os.path.getsize(fn) for fn in files)
+
+    def parse():
+        for fn in files:
+            schema.FileDOM(fn)
+
+    t = timed(parse, repeat)
+
+    sample = files[:CHUNK]
+    doms = [schema.FileDOM(fn) for fn in sample]
+    mem = deep_size(doms) - sys.getsizeof(doms)
+
+    return {
+        "objects": len(files),
+        "bytes": nbytes,
+        "seconds": t,
+        "objects_per_sec": len(files) / t,
+        "mb_per_sec": nbytes / t / 1e6,
+        "bytes_per_object": mem / len(sample),
+    }
+
+
+def bench_validate(path, repeat):
+    "SchemaDOM.check_file and sanity_check throughput on parsed objects"
+    schemas = load_schemas(path)
+    files = list_files(path)
+    keys = registry_keys(files)
+
+    t = 0
+    n = 0
+    with quiet():
+        for chunk in chunked(files):
+            work = [(schemas[d.schema], d) for d in map(schema.FileDOM, chunk)
+                    if d.schema in schemas]
+            t += timed(lambda: [s.check_file(d, keys) for s, d in work], repeat)
+            n += len(work)
+
+    return {
+        "objects": n,
+        "seconds": t,
+        "objects_per_sec": n / t,
+    }
+
+
+def bench_lookup(path, repeat):
+    "building the lookup key set and resolving every reference against it"
+    schemas = load_schemas(path)
+    files = list_files(path)
+    t_keys = timed(lambda: registry_keys(files), repeat)
+    keys = registry_keys(files)
+
+    refs = []
+    for chunk in chunked(files):
+        for d in map(schema.FileDOM, chunk):
+            s = schemas.get(d.schema)
+            if s is None:
+                continue
+            for k, v, _ in d.dom:
+                if k in s.lookups:
+                    refs.extend((r, v.split()[0]) for r, _ in s.lookups[k])
+
+    def resolve():
+        return sum(1 for r, v in refs if not any((i, v) in keys for i in r))
+
+    t = timed(resolve, repeat)
+    return {
+        "keys": len(keys),
+        "keys_seconds": t_keys,
+        "references": len(refs),
+        "unresolved": resolve(),
+        "seconds": t,
+        "references_per_sec": len(refs) / t,
+    }
+
+
+def bench_policy(path, repeat):
+    "offline registry build time and test_policy latency"
+    t = timed(lambda: schema.LocalRegistry(path), repeat)
+    registry = schema.LocalRegistry(path)
+
+    items = []
+    for obj_type in ("aut-num", "inetnum", "inet6num", "route", "route6"):
+        for fn in os.listdir(os.path.join(path, obj_type)):
+            items.append((obj_type, fn))
+
+    rnd = random.Random(42)
+    sample = []
+    for obj_type, fn in rnd.sample(items, min(2000, len(items))):
+        dom = schema.FileDOM(os.path.join(path, obj_type, fn))
+        sample.append(schema.policy_name(obj_type, fn) + (
+            dom.mntner[0] if dom.mntner else "UNKNOWN", registry))
+
+    status = {}
+    with quiet():
+        us = per_op(schema.test_policy, sample)
+        for i in sample:
+            ck = schema.test_policy(*i)
+            status[ck] = status.get(ck, 0) + 1
+
+    return {
+        "registry_seconds": t,
+        "checks": len(sample),
+        "status": status,
+        "test_policy_us": us,
+    }
+
+
+def bench_remote(path, repeat):
+    """test_policy latency against the registry API stand-in, uncached on
+    kept alive connections and from the response cache"""
+    server = schema.registry_stub(path, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://%s:%d" % server.server_address[:2]
+
+    items = []
+    for obj_type in ("aut-num", "inetnum", "inet6num", "route", "route6"):
+        for fn in os.listdir(os.path.join(path, obj_type)):
+            items.append((obj_type, fn))
+
+    rnd = random.Random(42)
+    sample = []
+    for obj_type, fn in rnd.sample(items, min(200, len(items))):
+        dom = schema.FileDOM(os.path.join(path, obj_type, fn))
+        sample.append(schema.policy_name(obj_type, fn) + (
+            dom.mntner[0] if dom.mntner else "UNKNOWN",))
+
+    try:
+        with quiet():
+            cold = schema.RegistryClient(url, ttl=0)
+            cold_us = per_op(schema.test_policy, [i + (cold,) for i in sample])
+            warm = schema.RegistryClient(url)
+            for i in sample:
+                schema.test_policy(*i, warm)
+            warm_us = per_op(schema.test_policy, [i + (warm,) for i in sample])
+        cold.close()
+        warm.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {
+        "checks": len(sample),
+        "uncached_us": cold_us,
+        "cached_us": warm_us,
+        "cache_entries": len(warm.cache),
+    }
+
+
+def bench_scan(path, repeat):
+    "end to end serial scan_files"
+    files = list_files(path)
+    with quiet():
+        t = timed(lambda: schema.scan_files(path), repeat)
+
+    return {
+        "objects": len(files),
+        "seconds": t,
+        "objects_per_sec": len(files) / t,
+    }
+
+
+def per_op(func, items):
+    "mean microseconds per call of func over items"
+    start = time.perf_counter()
+    for i in items:
+        func(*i)
+    return (time.perf_counter() - start) / len(items) * 1e6
+
+
+def bench_hierarchy(path, repeat):
+    "NetTree build time and query latency"
+    t = timed(lambda: schema.NetTree.from_registry(path), repeat)
+    tree = schema.NetTree.from_registry(path)
+
+    prefixes = []
+    for obj_type in schema.NetTree.TYPES:
+        d = os.path.join(path, obj_type)
+        for fn in os.listdir(d):
+            net = schema.parse_net(obj_type, fn.replace("_", "/"))
+            if net is not None:
+                prefixes.append((obj_type, fn.replace("_", "/"), net))
+
+    rnd = random.Random(42)
+    sample = [rnd.choice(prefixes) for _ in range(10000)]
+    nets = [i[2] for i in sample]
+    addrs = [(net | rnd.getrandbits(128 - mask),) for net, mask in nets]
+    objs = [(i[0], i[1]) for i in sample[:2000]]
+
+    def churn(obj_type, name):
+        tree.delete(obj_type, name)
+        tree.insert(obj_type, name)
+
+    return {
+        "objects": tree.size,
+        "build_seconds": t,
+        "longest_prefix_us": per_op(tree.longest_prefix, addrs),
+        "covering_us": per_op(tree.covering, nets),
+        "covered_by_us": per_op(tree.covered_by, nets),
+        "attrs_us": per_op(tree.attrs, objs),
+        "delete_insert_us": per_op(churn, objs),
+    }
+
+
+BENCHMARKS = {
+    "parse": bench_parse,
+    "validate": bench_validate,
+    "lookup": bench_lookup,
+    "policy": bench_policy,
+    "remote": bench_remote,
+    "scan": bench_scan,
+    "hierarchy": bench_hierarchy,
+}
+
+
+def obj(*attrs):
+    "object text in registry layout"
+    return "".join("%-20s%s\n" % (k + ":", v) for k, v in attrs)
+
+
+def inet_range(net):
+    "inetnum/inet6num range of net as the registry writes it"
+    if net.version == 4:
+        return "%s - %s" % (net.network_address, net.broadcast_address)
+    return "%s - %s" % (net.network_address.exploded, net.broadcast_address.exploded)
+
+
+def synthesize(src, dst, scale, seed=42):
+    """build a registry with scale times the participants of src in dst
+
+    Schemas, registries, as-blocks, filters and DN42-MNT are copied from
+    src. Each participant gets a person, mntner and aut-num, and by the
+    ratios of the dn42 registry some of: an organisation, a domain, an
+    inetnum /27 under 10.0.0.0/8 with a nested /28, an inet6num /48 under
+    fd00::/8 with a nested /56, routes for them and an as-set of peers."""
+    rnd = random.Random("%s-%d" % (seed, scale))
+    if os.path.exists(dst):
+        shutil.rmtree(dst)
+
+    for d in ("schema", "registry", "as-block"):
+        shutil.copytree(os.path.join(src, d), os.path.join(dst, d))
+    for f in ("filter.txt", "filter6.txt"):
+        shutil.copy(os.path.join(src, f), os.path.join(dst, f))
+    os.makedirs(os.path.join(dst, "mntner"))
+    shutil.copy(os.path.join(src, "mntner", "DN42-MNT"), os.path.join(dst, "mntner"))
+
+    def write(obj_type, name, text):
+        d = os.path.join(dst, obj_type)
+        if not os.path.isdir(d):
+            os.makedirs(d)
+        with open(os.path.join(d, name.replace("/", "_")), "w") as f:
+            f.write(text)
+
+    def net(obj_type, n, mnt, *attrs):
+        write(obj_type, str(n), obj(
+            (obj_type, inet_range(n)), ("cidr", str(n)),
+            ("netname", "NET-%s" % (str(n).replace(".", "-").replace(":", "-")
+                                    .replace("/", "-").upper())),
+        ) + obj(*attrs) + obj(("mnt-by", mnt), ("source", "DN42")))
+
+    root4 = ipaddress.ip_network("10.0.0.0/8")
+    root6 = ipaddress.ip_network("fd00::/8")
+    net("inetnum", ipaddress.ip_network("0.0.0.0/0"), "DN42-MNT", ("policy", "reserved"))
+    net("inetnum", root4, "DN42-MNT", ("status", "ALLOCATED"), ("policy", "open"))
+    net("inet6num", ipaddress.ip_network("::/0"), "DN42-MNT", ("policy", "reserved"))
+    net("inet6num", root6, "DN42-MNT", ("status", "ALLOCATED"), ("policy", "open"))
+
+    n = len(os.listdir(os.path.join(src, "mntner"))) * scale
+    if n > 2048 * 256:
+        raise ValueError("scale %d does not fit in %s" % (scale, root4))
+
+    asns = []
+    prefixes6 = set()
+    for k in range(n):
+        mnt = "SYN%06d-MNT" % (k)
+        person = "SYN%06d-DN42" % (k)
+        asn = "AS%d" % (4242420000 + k if k < 10000 else 4200000000 + k)
+        asns.append(asn)
+        contact = (("admin-c", person), ("tech-c", person))
+
+        write("person", person, obj(
+            ("person", "Participant %d" % (k)), ("nic-hdl", person),
+            ("mnt-by", mnt), ("source", "DN42")))
+        write("mntner", mnt, obj(
+            ("mntner", mnt), ("admin-c", person), ("mnt-by", mnt),
+            ("source", "DN42"), ("auth", "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5%08x" % (k))))
+
+        org = []
+        if rnd.random() < 0.15:
+            org = [("org", "ORG-SYN%06d" % (k))]
+            write("organisation", org[0][1], obj(
+                ("organisation", org[0][1]), ("org-name", "Organisation %d" % (k)),
+                ("admin-c", person), ("mnt-by", mnt), ("source", "DN42")))
+
+        write("aut-num", asn, obj(
+            ("aut-num", asn), ("as-name", "SYN-%d-AS" % (k)), *contact, *org,
+            ("mnt-by", mnt), ("source", "DN42")))
+
+        if rnd.random() < 0.42:
+            domain = "syn%d.dn42" % (k)
+            write("dns", domain, obj(
+                ("domain", domain), *contact,
+                ("nserver", "ns1.%s" % (domain)), ("nserver", "ns2.%s" % (domain)),
+                ("mnt-by", mnt), ("source", "DN42")))
+
+        if rnd.random() < 0.8:
+            block = ipaddress.ip_network((int(root4.network_address) + k * 32, 27))
+            if k % 2048 == 0:
+                net("inetnum", block.supernet(new_prefix=16), "DN42-MNT",
+                    ("status", "ALLOCATED"))
+            net("inetnum", block, mnt, *contact, ("status", "ASSIGNED"))
+            if rnd.random() < 0.95:
+                write("route", str(block), obj(
+                    ("route", str(block)), ("origin", asn), ("mnt-by", mnt),
+                    ("source", "DN42")))
+            if rnd.random() < 0.25:
+                sub = next(block.subnets(new_prefix=28))
+                net("inetnum", sub, mnt, *contact, ("status", "ASSIGNED"))
+                if rnd.random() < 0.35:
+                    write("route", str(sub), obj(
+                        ("route", str(sub)), ("origin", asn), ("mnt-by", mnt),
+                        ("source", "DN42")))
+
+        if rnd.random() < 0.68:
+            block = None
+            while block is None or block in prefixes6:
+                block = ipaddress.ip_network(
+                    (int(root6.network_address) | rnd.getrandbits(40) << 80, 48))
+            prefixes6.add(block)
+            net("inet6num", block, mnt, *contact, ("status", "ASSIGNED"))
+            if rnd.random() < 0.98:
+                write("route6", str(block), obj(
+                    ("route6", str(block)), ("origin", asn), ("mnt-by", mnt),
+                    ("source", "DN42")))
+            if rnd.random() < 0.26:
+                sub = next(block.subnets(new_prefix=56))
+                net("inet6num", sub, mnt, *contact, ("status", "ASSIGNED"))
+                if rnd.random() < 0.45:
+                    write("route6", str(sub), obj(
+                        ("route6", str(sub)), ("origin", asn), ("mnt-by", mnt),
+                        ("source", "DN42")))
+
+    # as-sets last, so that members can point at any aut-num.
+    for k in range(n):
+        if rnd.random() < 0.033:
+            name = "AS-SYN%06d" % (k)
+            members = [asns[k]] + rnd.sample(asns, min(len(asns), rnd.randint(1, 10)))
+            write("as-set", name, obj(
+                ("as-set", name), *(("members", m) for m in members),
+                ("mnt-by", "SYN%06d-MNT" % (k)), ("source", "DN42")))
+
+
+def synthetic(src, workdir, scale, seed):
+    "path of the scale synthetic registry, generating it if needed"
+    dst = os.path.join(workdir, "synthetic-%dx" % (scale))
+    stamp = {"format": FORMAT, "scale": scale, "seed": seed}
+    try:
+        with open(dst + ".json") as f:
+            if json.load(f) == stamp:
+                return dst
+    except (OSError, ValueError):
+        pass
+
+    log.info("generating %s" % (dst))
+    start = time.perf_counter()
+    synthesize(src, dst, scale, seed)
+    with open(dst + ".json", "w") as f:
+        json.dump(stamp, f)
+    log.info("generated %d objects in %.1fs"
+             % (len(list_files(dst)), time.perf_counter() - start))
+    return dst
+
+
+def compare(old, new):
+    "old and new value and ratio of every numeric metric in both results"
+    for target, benches in sorted(new["results"].items()):
+        for name, res in sorted(benches.items()):
+            before = old["results"].get(target, {}).get(name, {})
+            for k, v in sorted(res.items()):
+                if not isinstance(v, (int, float)) or not isinstance(
+                        before.get(k), (int, float)):
+                    continue
+                ratio = v / before[k] if before[k] else float("nan")
+                print("%-16s %-10s %-20s %12.4f %12.4f %8.2fx"
+                      % (target, name, k, before[k], v, ratio))
+
+
+def get_args():
+    """Get and parse command line arguments"""
+
+    parser = argparse.ArgumentParser(description="Benchmark the schema checker")
+    parser.add_argument("path", nargs="?", help="Path for dn42 data", default="data/")
+    parser.add_argument(
+        "-b",
+        "--bench",
+        help="Benchmarks to run [Default all]",
+        choices=sorted(BENCHMARKS),
+        action="append",
+    )
+    parser.add_argument(
+        "-r", "--repeat", help="Runs per benchmark [Default 3]", type=int, default=3
+    )
+    parser.add_argument(
+        "-s",
+        "--scale",
+        help="Also run on a synthetic registry scale times the size of path, "
+        "e.g. -s 1 -s 10 -s 100 [Default None]",
+        type=int,
+        action="append",
+    )
+    parser.add_argument(
+        "--workdir",
+        help="Where synthetic registries are kept [Default .cache/bench]",
+        default=".cache/bench",
+    )
+    parser.add_argument(
+        "--seed", help="Synthetic registry seed [Default 42]", type=int, default=42
+    )
+    parser.add_argument(
+        "--json", help="Print results as JSON [Default OFF]", action="store_true"
+    )
+    parser.add_argument("-o", "--output", help="Also write JSON results to file")
+    parser.add_argument(
+        "--compare", help="Compare with JSON results from an earlier run"
+    )
+
+    return vars(parser.parse_args())
+
+
+def run(args):
+    "run"
+    targets = [(args["path"], args["path"])]
+    for scale in args["scale"] or []:
+        path = synthetic(args["path"], args["workdir"], scale, args["seed"])
+        targets.append(("synthetic-%dx" % (scale), path))
+
+    results = {}
+    for target, path in targets:
+        results[target] = {}
+        for name in args["bench"] or sorted(BENCHMARKS):
+            log.info("running %s on %s" % (name, target))
+            results[target][name] = BENCHMARKS[name](path, args["repeat"])
+
+    out = {
+        "format": FORMAT,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "repeat": args["repeat"],
+        "results": results,
+    }
+    if args["output"] is not None:
+        with open(args["output"], "w") as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+
+    if args["compare"] is not None:
+        with open(args["compare"]) as f:
+            compare(json.load(f), out)
+        return
+
+    if args["json"]:
+        print(json.dumps(out, indent=2, sort_keys=True))
+        return
+
+    for target, benches in results.items():
+        for name, res in benches.items():
+            for k, v in res.items():
+                if isinstance(v, float):
+                    v = "%.4f" % (v) if v < 100 else "%.0f" % (v)
+                print("%-16s %-10s %-20s %s" % (target, name, k, v))
+
+
+if __name__ == "__main__":
+    run(get_args())
@@ -4,30 +4,103 @@
 from __future__ import print_function
 
 import re
+import io
 import os
 import sys
 import time
 import argparse
+import collections
+import asyncio
+import atexit
+import contextlib
+import functools
+import concurrent.futures
+import ctypes
+import ctypes.util
 import glob
+import hashlib
+import heapq
+import mmap
+import multiprocessing
+import select
+import socket
+import socketserver
+import struct
+import subprocess
+import threading
 import urllib.parse
 import http.client
+import http.server
+import ipaddress
+import array
 import json
 
 import log
 
 SCHEMA_NAMESPACE = "dn42."
 
+XLAT = {
+    "dns/": SCHEMA_NAMESPACE + "domain",
+    "inetnum/": SCHEMA_NAMESPACE + "inetnum",
+    "inet6num/": SCHEMA_NAMESPACE + "inet6num",
+    "route/": SCHEMA_NAMESPACE + "route",
+    "route6/": SCHEMA_NAMESPACE + "route6",
+    "aut-num/": SCHEMA_NAMESPACE + "aut-num",
+    "as-set/": SCHEMA_NAMESPACE + "as-set",
+    "as-block/": SCHEMA_NAMESPACE + "as-block",
+    "organisation/": SCHEMA_NAMESPACE + "organisation",
+    "mntner/": SCHEMA_NAMESPACE + "mntner",
+    "person/": SCHEMA_NAMESPACE + "person",
+    "role/": SCHEMA_NAMESPACE + "role",
+    "tinc-key/": SCHEMA_NAMESPACE + "tinc-key",
+    "tinc-keyset/": SCHEMA_NAMESPACE + "tinc-keyset",
+    "registry/": SCHEMA_NAMESPACE + "registry",
+    "schema/": SCHEMA_NAMESPACE + "schema",
+    "key-cert/": SCHEMA_NAMESPACE + "key-cert",
+}
+
 
 class SchemaDOM:
     "schema"
-    def __init__(self, fn):
+    # Flags for the key options that check_file() tests.
+    REQUIRED = 1
+    RECOMMEND = 2
+    SCHEMA = 4
+    SINGLE = 8
+    ONELINE = 16
+    DEPRECATE = 32
+
+    FLAGS = {
+        "required": REQUIRED,
+        "recommend": RECOMMEND,
+        "schema": SCHEMA,
+        "single": SINGLE,
+        "oneline": ONELINE,
+        "deprecate": DEPRECATE,
+    }
+
+    def __init__(self, fn, text=None):
         self.name = None
         self.ref = None
         self.primary = None
         self.type = None
         self.src = fn
-        f = FileDOM(fn)
-        self.schema = self.__parse_schema(f)
+
+        if text is None:
+            with open(fn, mode="rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        else:
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+        cache = SchemaCache.open(os.path.dirname(fn))
+        compiled = cache.get(digest)
+        if compiled is None:
+            f = FileDOM(fn, text)
+            self.schema = self.__parse_schema(f)
+            compiled = self.__compile()
+            cache.put(digest, compiled)
+
+        self.__load(compiled)
 
     def __parse_schema(self, f):
         schema = {}
@@ -50,127 +123,232 @@ class SchemaDOM:
 
                 schema[key].add(i)
 
-            for k, v in schema.items():
-                if "schema" in v:
-                    self.type = k
-
-                if "primary" in v:
-                    self.primary = k
-                    schema[k].add("oneline")
-                    if "multiline" in v:
-                        schema[k].remove("multiline")
-                    schema[k].add("single")
-                    if "multiple" in v:
-                        schema[k].remove("multiple")
-                    schema[k].add("required")
-                    if "optional" in v:
-                        schema[k].remove("optional")
-                    if "recommend" in v:
-                        schema[k].remove("recommend")
-                    if "deprecate" in v:
-                        schema[k].remove("deprecate")
-
-                if "oneline" not in v:
-                    schema[k].add("multiline")
-                if "single" not in v:
-                    schema[k].add("multiple")
+        for k, v in schema.items():
+            if "schema" in v:
+                self.type = k
+
+            if "primary" in v:
+                self.primary = k
+                schema[k].add("oneline")
+                if "multiline" in v:
+                    schema[k].remove("multiline")
+                schema[k].add("single")
+                if "multiple" in v:
+                    schema[k].remove("multiple")
+                schema[k].add("required")
+                if "optional" in v:
+                    schema[k].remove("optional")
+                if "recommend" in v:
+                    schema[k].remove("recommend")
+                if "deprecate" in v:
+                    schema[k].remove("deprecate")
+
+            if "oneline" not in v:
+                schema[k].add("multiline")
+            if "single" not in v:
+                schema[k].add("multiple")
 
         return schema
 
-    def check_file(self, f, lookups=None):
-        "check file"
+    def __compile(self):
+        "flat form of the schema used by check_file()"
+        keys = []
+        for k, v in self.schema.items():
+            flags = 0
+            lookups = []
+            for o in sorted(v):
+                flags |= self.FLAGS.get(o, 0)
+                if o.startswith("lookup="):
+                    lookups.append(o.split("=", 2)[1].split(","))
+            keys.append([k, flags, lookups, sorted(v)])
+
+        return {
+            "name": self.name,
+            "ref": self.ref,
+            "primary": self.primary,
+            "type": self.type,
+            "keys": keys,
+        }
+
+    def __load(self, compiled):
+        self.name = compiled["name"]
+        self.ref = compiled["ref"]
+        self.primary = compiled["primary"]
+        self.type = compiled["type"]
+
+        self.schema = {}
+        self.flags = {}
+        self.lookups = {}
+        for k, flags, lookups, options in compiled["keys"]:
+            self.schema[k] = set(options)
+            self.flags[k] = flags
+            if len(lookups) > 0:
+                self.lookups[k] = tuple((tuple(refs), str(refs)) for refs in lookups)
+
+        # Keys with checks that apply whether or not they are in the file.
+        mask = self.REQUIRED | self.RECOMMEND | self.SCHEMA | self.SINGLE | self.ONELINE
+        self.checks = tuple((k, f) for k, f in self.flags.items() if f & mask)
+
+    def check_file(self, f, lookups=None, fmt="text", profile=None):
+        "check file, timing sanity checks and logging into profile if given"
+        findings = []
+
+        def report(level, line, key, code, message):
+            text = "%s Line %d: %s" % (f.src, line, message)
+            if profile is None:
+                log.default.output(level, text, 2)
+            else:
+                profile.timed("log", log.default.output, level, text, 3)
+            findings.append(_finding(level, line, key, code, message))
+
         status = "PASS"
         if not f.valid:
-            log.error("%s Line 0: File does not parse" % (f.src))
+            report(log.VERB_ERROR, 0, None, "parse", "File does not parse")
             status = "FAIL"
 
-        for k, v in self.schema.items():
-            if "required" in v and k not in f.keys:
-                log.error("%s Line 0: Key [%s] not found and is required." % (f.src, k))
+        for k, v in self.checks:
+            if v & self.REQUIRED and k not in f.keys:
+                report(log.VERB_ERROR, 0, k, "required",
+                       "Key [%s] not found and is required." % (k))
                 status = "FAIL"
-            elif "recommend" in v and k not in f.keys:
-                log.notice(
-                    "%s Line 0: Key [%s] not found and is recommended." % (f.src, k)
-                )
+            elif v & self.RECOMMEND and k not in f.keys:
+                report(log.VERB_NOTICE, 0, k, "recommended",
+                       "Key [%s] not found and is recommended." % (k))
                 status = "NOTE"
 
-            if "schema" in v and SCHEMA_NAMESPACE + f.dom[0][0] != self.ref:
-                log.error(
-                    "%s Line 1: Key [%s] not found and is required as the first line."
-                    % (f.src, k)
-                )
+            if v & self.SCHEMA and SCHEMA_NAMESPACE + f.dom[0][0] != self.ref:
+                report(log.VERB_ERROR, 1, k, "first-line",
+                       "Key [%s] not found and is required as the first line." % (k))
                 status = "FAIL"
 
-            if "single" in v and k in f.keys and len(f.keys[k]) > 1:
-                log.warning(
-                    "%s Line %d: Key [%s] first defined here and has repeated keys."
-                    % (f.src, f.keys[k][0], k)
-                )
+            if v & self.SINGLE and k in f.keys and len(f.keys[k]) > 1:
+                report(log.VERB_WARN, f.keys[k][0], k, "repeated",
+                       "Key [%s] first defined here and has repeated keys." % (k))
                 for l in f.keys[k][1:]:
-                    log.error(
-                        "%s Line %d: Key [%s] can only appear once." % (f.src, l, k)
-                    )
+                    report(log.VERB_ERROR, l, k, "single",
+                           "Key [%s] can only appear once." % (k))
                     status = "FAIL"
 
-            if "oneline" in v and k in f.multi:
+            if v & self.ONELINE and k in f.multi:
                 for l in f.keys[k]:
-                    log.error(
-                        "%s Line %d: Key [%s] can not have multiple lines."
-                        % (f.src, l, k)
-                    )
+                    report(log.VERB_ERROR, l, k, "multiline",
+                           "Key [%s] can not have multiple lines." % (k))
                     status = "FAIL"
 
         for k, v, l in f.dom:
             if k == self.primary and not f.src.endswith(
                     v.replace("/", "_").replace(" ", "")):
-                log.error(
-                    "%s Line %d: Primary [%s: %s] does not match filename."
-                    % (f.src, l, k, v)
-                )
+                report(log.VERB_ERROR, l, k, "primary",
+                       "Primary [%s: %s] does not match filename." % (k, v))
                 status = "FAIL"
 
             if k.startswith("x-"):
-                log.info("%s Line %d: Key [%s] is user defined." % (f.src, l, k))
+                report(log.VERB_INFO, l, k, "user-defined",
+                       "Key [%s] is user defined." % (k))
+                continue
 
-            elif k not in self.schema:
-                log.error("%s Line %d: Key [%s] not in schema." % (f.src, l, k))
+            flags = self.flags.get(k)
+            if flags is None:
+                report(log.VERB_ERROR, l, k, "unknown-key",
+                       "Key [%s] not in schema." % (k))
                 status = "FAIL"
                 continue
-            else:
-                if "deprecate" in self.schema[k]:
-                    log.info(
-                        "%s Line %d: Key [%s] was found and is deprecated."
-                        % (f.src, l, k)
-                    )
-                    status = "INFO"
-
-                if lookups is not None:
-                    for o in self.schema[k]:
-                        if o.startswith("lookup="):
-                            refs = o.split("=", 2)[1].split(",")
-                            val = v.split()[0]
-                            found = False
-                            for ref in refs:
-                                if (ref, val) in lookups:
-                                    found = True
-                            if not found:
-                                log.error(
-                                    "%s Line %d: Key %s references object %s in %s but does not exist."
-                                    % (f.src, l, k, val, refs)
-                                )
-                                status = "FAIL"
+
+            if flags & self.DEPRECATE:
+                report(log.VERB_INFO, l, k, "deprecated",
+                       "Key [%s] was found and is deprecated." % (k))
+                status = "INFO"
+
+            if lookups is not None and k in self.lookups:
+                val = v.split()[0]
+                for refs, name in self.lookups[k]:
+                    if not any((ref, val) in lookups for ref in refs):
+                        report(log.VERB_ERROR, l, k, "reference",
+                               "Key %s references object %s in %s but does not exist."
+                               % (k, val, name))
+                        status = "FAIL"
         if status != "FAIL":
-            ck = sanity_check(f)
+            if profile is None:
+                ck = sanity_check(f, findings)
+            else:
+                ck = profile.timed("sanity", sanity_check, f, findings)
             if ck == "FAIL":
                 status = ck
 
-        print("CHECK\t%-54s\t%s\tMNTNERS: %s" % (f.src, status, ",".join(f.mntner)))
+        print_check(f.src, status, f.mntner, f.schema, findings, fmt)
         return status
 
 
+class SchemaCache:
+    """compiled schemas, stored in a file in the schema directory and keyed
+    by the hash of each schema file"""
+
+    VERSION = 1
+    NAME = ".compiled-cache.json"
+
+    caches = {}
+
+    def __init__(self, path):
+        self.path = path
+        self.src = os.path.join(path, self.NAME)
+        self.schemas = {}
+        self.dirty = False
+
+        try:
+            with open(self.src, mode="r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") == self.VERSION:
+            self.schemas = data.get("schemas", {})
+
+    @classmethod
+    def open(cls, path):
+        "cache for schema directory, shared by the whole process"
+        path = os.path.abspath(path)
+        if path not in cls.caches:
+            if len(cls.caches) == 0:
+                atexit.register(cls.save_all)
+            cls.caches[path] = cls(path)
+        return cls.caches[path]
+
+    @classmethod
+    def save_all(cls):
+        "write out all caches that have new entries"
+        for c in cls.caches.values():
+            if c.dirty:
+                c.save()
+
+    def get(self, digest):
+        "compiled schema or None"
+        return self.schemas.get(digest)
+
+    def put(self, digest, compiled):
+        "store compiled schema"
+        self.schemas[digest] = compiled
+        self.dirty = True
+
+    def save(self):
+        "write cache, keeping entries for schema files that still exist"
+        current = set()
+        for fn in glob.glob(os.path.join(self.path, "*")):
+            with open(fn, mode="rb") as f:
+                current.add(hashlib.sha1(f.read()).hexdigest())
+
+        schemas = {k: v for k, v in self.schemas.items() if k in current}
+        try:
+            _write_json(self.src, {"version": self.VERSION, "schemas": schemas})
+        except OSError as e:
+            log.debug("Unable to write schema cache %s: %s" % (self.src, e))
+        self.dirty = False
+
+
 class FileDOM:
     "file"
-    def __init__(self, fn):
+    __slots__ = ("valid", "dom", "keys", "multi", "mntner", "schema", "src")
+
+    def __init__(self, fn, text=None):
         self.valid = True
         self.dom = []
         self.keys = {}
@@ -179,45 +357,54 @@ class FileDOM:
         self.schema = None
         self.src = fn
 
-        with open(fn, mode="r", encoding="utf-8") as f:
-            dom = []
-            keys = {}
-            multi = {}
-            mntner = []
-            last_multi = None
+        if text is None:
+            with open(fn, mode="r", encoding="utf-8") as f:
+                text = f.read()
+
+        # Attributes are (key, value, line) tuples. The one being read is
+        # kept in key/val/ln until the next key starts, so continuation
+        # lines never have to modify dom.
+        dom = []
+        keys = {}
+        multi = {}
+        mntner = []
+        key = val = ln = None
+        last_multi = None
+
+        for lineno, i in enumerate(text.split("\n"), 1):
+            c = i[:1]
+            if c == " " or c == "\t":
+                if key is None:
+                    log.error("File %s does not parse properly" % (fn))
+                    self.valid = False
+                    return
+
+                val += "\n" + i.strip()
+
+                if last_multi is None:
+                    multi.setdefault(key, []).append(lineno)
+                    last_multi = key
 
-            for lineno, i in enumerate(f.readlines(), 1):
-                if re.match(r"[ \t]", i):
-                    if len(dom) == 0:
-                        log.error("File %s does not parse properly" % (fn))
-                        self.valid = False
-                        return
-
-                    dom[-1][1] += "\n" + i.strip()
-
-                    if dom[-1][0] not in multi:
-                        multi[dom[-1][0]] = []
-
-                    if last_multi is None:
-                        multi[dom[-1][0]].append(lineno)
-                        last_multi = dom[-1][0]
-
-                else:
-                    i = i.split(":")
-                    if len(i) < 2:
-                        continue
+            else:
+                k, sep, v = i.partition(":")
+                if not sep:
+                    continue
 
-                    dom.append([i[0].strip(), ":".join(i[1:]).strip(), lineno - 1])
+                if key is not None:
+                    dom.append((key, val, ln))
 
-                    if i[0].strip() not in keys:
-                        keys[i[0].strip()] = []
+                key = sys.intern(k.strip())
+                val = v.strip()
+                ln = lineno - 1
+                keys.setdefault(key, []).append(len(dom))
 
-                    keys[i[0].strip()].append(len(dom) - 1)
+                last_multi = None
 
-                    last_multi = None
+            if key == "mnt-by":
+                mntner.append(val)
 
-                if dom[-1][0] == "mnt-by":
-                    mntner.append(dom[-1][1])
+        if key is not None:
+            dom.append((key, val, ln))
 
         self.dom = dom
         self.keys = keys
@@ -250,6 +437,78 @@ class FileDOM:
         return self.dom[self.keys[key][index]][1]
 
 
+FINDING_LEVELS = ("critical", "error", "warning", "notice", "info", "debug")
+
+
+def _finding(level, line, key, code, message):
+    "structured form of a check message"
+    return {
+        "level": FINDING_LEVELS[level],
+        "line": line,
+        "key": key,
+        "code": code,
+        "message": message,
+    }
+
+
+def print_check(src, status, mntner, schema, findings, fmt="text"):
+    "print the result line of a checked object"
+    if fmt == "jsonl":
+        print(json.dumps({
+            "type": "object",
+            "path": src,
+            "name": src.split("/")[-1].replace("_", "/"),
+            "schema": schema,
+            "status": status,
+            "mntners": mntner,
+            "findings": findings,
+        }, sort_keys=True))
+        return
+
+    print("CHECK\t%-54s\t%s\tMNTNERS: %s"
+          % (src, status, "UNKNOWN" if mntner is None else ",".join(mntner)))
+
+
+def _print_no_schema(src, fmt):
+    name = src.split("/")[-1].replace("_", "/")
+    log.error("No schema found for %s" % (name))
+    print_check(src, "FAIL", None, None, [_finding(
+        log.VERB_ERROR, 0, None, "no-schema", "No schema found for %s" % (name))], fmt)
+
+
+class _ScanTally:
+    "overall status, per status counts and timing of a scan"
+    def __init__(self):
+        self.status = True
+        self.counts = {}
+        self.started = time.time()
+
+    def add(self, ck):
+        "count one checked object"
+        if ck is None:
+            return
+        self.counts[ck] = self.counts.get(ck, 0) + 1
+        if ck == "INFO" and self.status != "FAIL":
+            self.status = ck
+        if ck == "FAIL":
+            self.status = ck
+
+    def finish(self, fmt):
+        "print the summary record and return the overall status"
+        if fmt == "jsonl":
+            seconds = time.time() - self.started
+            objects = sum(self.counts.values())
+            print(json.dumps({
+                "type": "summary",
+                "objects": objects,
+                "counts": self.counts,
+                "status": "PASS" if self.status is True else self.status,
+                "seconds": round(seconds, 3),
+                "objects_per_sec": round(objects / seconds, 1) if seconds > 0 else None,
+            }, sort_keys=True))
+        return self.status
+
+
 def main(infile, schema):
     "main command"
     log.debug("Check File: %s" % (infile))
@@ -288,11 +547,31 @@ def check_schemas(path):
     return ok
 
 
-def scan_index(infile, mntner=None):
+def scan_index(infile, mntner=None, fmt="text"):
     "scan index"
     idx = {}
     schemas = {}
 
+    if RegistryIndex.is_index(infile):
+        ri = RegistryIndex(infile)
+        log.info("index %s: %d objects" % (infile, len(ri)))
+        stale = 0
+        for i, obj_type, name, src, mnts in ri:
+            # Objects are checked as indexed, say so where the file moved on.
+            if ri.stale(i):
+                log.warning("%s has changed since it was indexed" % (src))
+                stale += 1
+            idx[(obj_type, name)] = (src, ",".join(mnts), functools.partial(ri.dom, i))
+            if obj_type == SCHEMA_NAMESPACE + "schema":
+                s = SchemaDOM(src, ri.text(i))
+                log.info("read schema: %s" % (s.name))
+                schemas[s.ref] = s
+        if stale > 0:
+            log.error("index %s: %d objects are out of date, rebuild it with index"
+                      % (infile, stale))
+
+        return __scan_index(idx, schemas, mntner, fmt=fmt)
+
     with open(infile, "r") as f:
         for line in f.readlines():
             line = line.split()
@@ -302,12 +581,20 @@ def scan_index(infile, mntner=None):
                 log.info("read schema: %s" % (s.name))
                 schemas[s.ref] = s
 
-    return __scan_index(idx, schemas, mntner)
+    return __scan_index(idx, schemas, mntner, fmt=fmt)
 
 
-def scan_files(path, mntner=None, use_file=None):
-    "scan files"
-    arr = __index_files(path, use_file)
+def scan_files(path, mntner=None, use_file=None, jobs=1, cache=None, mnt_index=None,
+               fmt="text", profile=None):
+    "scan files, timing each phase into a ScanProfile if one is given"
+    if jobs != 1 or cache is not None or mnt_index is not None:
+        return __scan_files_pooled(path, mntner, use_file, jobs, cache, mnt_index, fmt,
+                                   profile)
+
+    if profile is None:
+        arr = __index_files(path, use_file)
+    else:
+        arr = __index_files_profiled(path, use_file, profile)
 
     idx = {}
     schemas = {}
@@ -323,23 +610,38 @@ def scan_files(path, mntner=None, use_file=None):
 
         idx[(line[0], line[1])] = line[2:]
         if line[0] == SCHEMA_NAMESPACE + "schema":
-            s = SchemaDOM(line[2])
+            if profile is None:
+                s = SchemaDOM(line[2])
+            else:
+                s = profile.timed("schema", SchemaDOM, line[2])
             schemas[s.ref] = s
 
-    return __scan_index(idx, schemas, mntner, use_file)
+    return __scan_index(idx, schemas, mntner, use_file, fmt, profile)
 
 
-def __scan_index(idx, schemas, mntner, use_file=None):
-    ok = True
+def __index_files_profiled(path, use_file, profile):
+    files = profile.timed("walk", list, __list_files(path, use_file))
+    for fn in files:
+        start = profile.clock()
+        dom = profile.timed("parse", FileDOM, fn, profile.timed("read", __read_file, fn))
+        profile.object(dom.schema, fn, *profile.since(start))
+        yield dom
+
+
+def __scan_index(idx, schemas, mntner, use_file=None, fmt="text", profile=None):
+    lookups = idx.keys()
+    if profile is not None:
+        lookups = _ProfiledLookups(lookups, profile)
+
+    tally = _ScanTally()
     for k, v in idx.items():
         if use_file is not None and use_file != v[0]:
             continue
 
         s = schemas.get(k[0], None)
         if s is None:
-            log.error("No schema found for %s" % (k[1]))
-            print("CHECK\t%-54s\tFAIL\tMNTNERS: UNKNOWN" % (v[2].src))
-            ok = "FAIL"
+            _print_no_schema(v[0], fmt)
+            tally.add("FAIL")
 
         else:
             mlist = []
@@ -349,40 +651,710 @@ def __scan_index(idx, schemas, mntner, use_file=None):
             if mntner is not None and mntner not in mlist:
                 continue
 
-            c = v[2]
-            ck = s.check_file(c, idx.keys())
+            # Text index files only carry the path and binary ones parse
+            # their copy of the object on demand.
+            c = v[2] if len(v) > 2 else FileDOM(v[0])
+            if callable(c):
+                c = c()
+            if profile is None:
+                tally.add(s.check_file(c, lookups, fmt))
+                continue
 
-            if ck == "INFO" and ok != "FAIL":
-                ok = ck
-            if ck == "FAIL":
-                ok = ck
-    return ok
+            start = profile.clock()
+            tally.add(profile.timed("check", s.check_file, c, lookups, fmt, profile))
+            profile.object(k[0], v[0], *profile.since(start))
+    return tally.finish(fmt)
 
 
-def __index_files(path, use_file=None):
-    xlat = {
-        "dns/": SCHEMA_NAMESPACE + "domain",
-        "inetnum/": SCHEMA_NAMESPACE + "inetnum",
-        "inet6num/": SCHEMA_NAMESPACE + "inet6num",
-        "route/": SCHEMA_NAMESPACE + "route",
-        "route6/": SCHEMA_NAMESPACE + "route6",
-        "aut-num/": SCHEMA_NAMESPACE + "aut-num",
-        "as-set/": SCHEMA_NAMESPACE + "as-set",
-        "as-block/": SCHEMA_NAMESPACE + "as-block",
-        "organisation/": SCHEMA_NAMESPACE + "organisation",
-        "mntner/": SCHEMA_NAMESPACE + "mntner",
-        "person/": SCHEMA_NAMESPACE + "person",
-        "role/": SCHEMA_NAMESPACE + "role",
-        "tinc-key/": SCHEMA_NAMESPACE + "tinc-key",
-        "tinc-keyset/": SCHEMA_NAMESPACE + "tinc-keyset",
-        "registry/": SCHEMA_NAMESPACE + "registry",
-        "schema/": SCHEMA_NAMESPACE + "schema",
-        "key-cert/": SCHEMA_NAMESPACE + "key-cert",
-    }
+def __read_file(fn):
+    with open(fn, mode="r", encoding="utf-8") as f:
+        return f.read()
+
+
+class _ProfiledLookups:
+    "lookup key set that times membership tests"
+    def __init__(self, keys, profile):
+        self.keys = keys
+        self.profile = profile
+
+    def __contains__(self, key):
+        return self.profile.timed("lookup", self.keys.__contains__, key)
+
+
+class ScanProfile:
+    """wall and CPU time of scan phases, object types and the slowest objects
+
+    Phase times are exclusive: time spent in a phase started inside
+    another (lookups, sanity checks and logging inside a check) is only
+    counted once, under the inner phase. Objects checked by pool workers
+    are timed there and merged, so with more than one job the phase
+    times add up to more than the wall time of the scan."""
+
+    PHASES = ("walk", "index", "read", "parse", "schema", "cache", "check", "lookup",
+              "sanity", "log")
+
+    def __init__(self, top=10):
+        self.top = top
+        self.phases = {}
+        self.objects = {}
+        self.inner = [0.0, 0.0]
+        self.started = self.clock()
+
+    @staticmethod
+    def clock():
+        "current (wall, cpu) time"
+        return time.perf_counter(), time.process_time()
+
+    def since(self, start):
+        "(wall, cpu) time since start"
+        wall, cpu = self.clock()
+        return wall - start[0], cpu - start[1]
+
+    def timed(self, phase, func, *args):
+        "call func, counting its time to phase"
+        start = self.clock()
+        outer, self.inner = self.inner, [0.0, 0.0]
+        try:
+            return func(*args)
+        finally:
+            wall, cpu = self.since(start)
+            p = self.phases.setdefault(phase, [0, 0.0, 0.0])
+            p[0] += 1
+            p[1] += wall - self.inner[0]
+            p[2] += cpu - self.inner[1]
+            self.inner = outer
+            outer[0] += wall
+            outer[1] += cpu
+
+    def object(self, schema, src, wall, cpu):
+        "add to the time spent on one object"
+        t = self.objects.setdefault(src, [schema, 0.0, 0.0])
+        t[1] += wall
+        t[2] += cpu
+
+    def state(self, schema):
+        "what merge() needs of the profile of a single object"
+        wall, cpu = self.since(self.started)
+        return schema, self.phases, wall, cpu
+
+    def merge(self, src, state):
+        "add the state() of an object timed in another process"
+        schema, phases, wall, cpu = state
+        for k, (n, w, c) in phases.items():
+            p = self.phases.setdefault(k, [0, 0.0, 0.0])
+            p[0] += n
+            p[1] += w
+            p[2] += c
+        self.object(schema, src, wall, cpu)
+
+    def report(self, fmt="text"):
+        "print the profile, as a JSON record with fmt jsonl"
+        wall, cpu = self.since(self.started)
+        phases = sorted(self.phases.items(), key=lambda i: self.PHASES.index(i[0]))
+
+        types = {}
+        for schema, w, c in self.objects.values():
+            t = types.setdefault(schema, [0, 0.0, 0.0])
+            t[0] += 1
+            t[1] += w
+            t[2] += c
+        types = sorted(types.items(), key=lambda i: -i[1][1])
+        slowest = heapq.nlargest(
+            self.top, ((w, c, src) for src, (_, w, c) in self.objects.items()))
+
+        if fmt == "jsonl":
+            print(json.dumps({
+                "type": "profile",
+                "wall": round(wall, 6),
+                "cpu": round(cpu, 6),
+                "phases": {k: {"calls": n, "wall": round(w, 6), "cpu": round(c, 6)}
+                           for k, (n, w, c) in phases},
+                "types": {k: {"objects": n, "wall": round(w, 6), "cpu": round(c, 6)}
+                          for k, (n, w, c) in types},
+                "slowest": [{"path": src, "wall": round(w, 6), "cpu": round(c, 6)}
+                            for w, c, src in slowest],
+            }, sort_keys=True))
+            return
+
+        out = log.OUTPUT
+        print("PROFILE %-24s %9s %10s %10s %6s" % ("phase", "calls", "wall s", "cpu s", "wall%"),
+              file=out)
+        for k, (n, w, c) in phases:
+            print("PROFILE %-24s %9d %10.4f %10.4f %5.1f%%" % (k, n, w, c, 100 * w / wall),
+                  file=out)
+        print("PROFILE %-24s %9s %10.4f %10.4f" % ("total", "", wall, cpu), file=out)
+
+        print("PROFILE %-24s %9s %10s %10s %6s" % ("type", "objects", "wall s", "cpu s", "us/obj"),
+              file=out)
+        for k, (n, w, c) in types:
+            print("PROFILE %-24s %9d %10.4f %10.4f %6.0f" % (k, n, w, c, 1e6 * w / n),
+                  file=out)
+
+        print("PROFILE %-54s %10s %10s" % ("slowest", "wall ms", "cpu ms"), file=out)
+        for w, c, src in slowest:
+            print("PROFILE %-54s %10.3f %10.3f" % (src, 1e3 * w, 1e3 * c), file=out)
+
+
+def __scan_files_pooled(path, mntner, use_file, jobs, cache_file, index_file, fmt,
+                        profile=None):
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    timed = _profile_timer(profile)
+
+    files = timed("walk", list, __list_files(path, use_file))
+    chunk = max(1, len(files) // (jobs * 16))
+
+    # Pass 1: read the object type of every file to build the lookup keys.
+    mntners = None
+    if index_file is not None:
+        index = MntnerIndex(index_file)
+        heads = timed("index", index.refresh, files, jobs)
+        mntners = index.mntners
+    else:
+        with _scan_pool(jobs) as pool:
+            heads = timed("index", pool.map, _peek_file, files, chunk)
+
+    idx = {}
+    digests = {}
+    schemas = {}
+    for fn, (schema, digest) in zip(files, heads):
+        idx[(schema, fn.split("/")[-1].replace("_", "/"))] = fn
+        digests[fn] = (schema, digest)
+        if schema == SCHEMA_NAMESPACE + "schema":
+            s = timed("schema", SchemaDOM, fn)
+            schemas[s.ref] = s
+
+    lookups = frozenset(idx)
+    work = [fn for fn in idx.values() if use_file is None or use_file == fn]
+    if mntner is not None and mntners is not None:
+        # Objects without a schema always fail, whoever maintains them.
+        work = [fn for fn in work
+                if digests[fn][0] not in schemas or mntner in mntners[fn]]
+
+    cache = None
+    hits = {}
+    if cache_file is not None:
+        cache = ScanCache(cache_file)
+        schema_digests = {k: digests[s.src][1] for k, s in schemas.items()}
+        for fn in work:
+            schema, digest = digests[fn]
+            hit = timed("cache", cache.get, fn, digest, schema_digests.get(schema),
+                        lookups, fmt)
+            if hit is not None:
+                hits[fn] = hit
+        log.info("scan cache: %d of %d objects unchanged" % (len(hits), len(work)))
+
+    # Pass 2: parse and check each object. Results come back in
+    # submission order so the output matches a serial scan.
+    tally = _ScanTally()
+    state = (schemas, lookups, mntner, cache is not None, fmt, profile is not None)
+    with _scan_pool(jobs, _scan_worker_init, (state,)) as pool:
+        fresh = pool.imap(
+            _scan_worker, [fn for fn in work if fn not in hits], chunk)
+
+        for fn in work:
+            if fn in hits:
+                ck, records, out, mlist, _ = hits[fn]
+                if mntner is not None and mntner not in mlist:
+                    continue
+            else:
+                ck, records, out, mlist, probes, times = next(fresh)
+                if times is not None:
+                    profile.merge(fn, times)
+                if cache is not None and probes is not None:
+                    schema, digest = digests[fn]
+                    cache.put(fn, digest, schema_digests[schema], lookups, fmt,
+                              (ck, records, out, mlist, probes))
+
+            timed("log", log.default.replay, records)
+            sys.stdout.write(out)
+            tally.add(ck)
+
+    if cache is not None:
+        cache.save(digests)
+    return tally.finish(fmt)
+
+
+class _InlinePool:
+    "runs pool tasks in this process"
+    def __init__(self, initializer=None, initargs=()):
+        if initializer is not None:
+            initializer(*initargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        return False
+
+    def map(self, func, iterable, chunksize=None):
+        "map"
+        return list(map(func, iterable))
+
+    def imap(self, func, iterable, chunksize=None):
+        "imap"
+        return map(func, iterable)
+
+
+def _profile_timer(profile):
+    "profile.timed, or a plain call when there is no profile"
+    if profile is not None:
+        return profile.timed
+    return lambda phase, func, *args: func(*args)
+
+
+def _scan_pool(jobs, initializer=None, initargs=()):
+    if jobs == 1:
+        return _InlinePool(initializer, initargs)
+    return multiprocessing.Pool(jobs, initializer, initargs)
+
+
+def _peek_file(fn):
+    "read the schema name from the first key of a file and hash its content"
+    with open(fn, mode="rb") as f:
+        data = f.read()
+
+    return _peek_schema(data.decode("utf-8")), hashlib.sha1(data).hexdigest()
+
+
+def _peek_schema(text):
+    "schema name from the first key of an object"
+    return _peek_lines(io.StringIO(text))
+
+
+def _peek_head(fn):
+    "schema name from the first key of a file, reading no further than it"
+    with open(fn, mode="r", encoding="utf-8") as f:
+        return _peek_lines(f)
+
+
+def _peek_lines(lines):
+    for i in lines:
+        if i[:1] in (" ", "\t"):
+            return None
+        key, sep, _ = i.partition(":")
+        if sep:
+            return SCHEMA_NAMESPACE + key.strip()
+    return None
+
+
+_SCAN_WORKER = {}
+
+
+def _scan_worker_init(state):
+    _SCAN_WORKER["state"] = state
+
+
+def _scan_worker(fn):
+    schemas, lookups, mntner, probe, fmt, profiled = _SCAN_WORKER["state"]
+    if probe:
+        lookups = probes = _LookupProbe(lookups)
+
+    profile = None
+    if profiled:
+        profile = ScanProfile()
+        lookups = _ProfiledLookups(lookups, profile)
+
+    records = []
+    out = io.StringIO()
+    ck = None
+    mlist = []
+
+    capture, log.default.capture = log.default.capture, records
+    try:
+        with contextlib.redirect_stdout(out):
+            if profile is None:
+                dom = FileDOM(fn)
+            else:
+                dom = profile.timed("parse", FileDOM, fn,
+                                    profile.timed("read", __read_file, fn))
+            mlist = dom.mntner
+            s = schemas.get(dom.schema, None)
+
+            if s is None:
+                _print_no_schema(dom.src, fmt)
+                ck = "FAIL"
+                probe = False
+
+            elif mntner is None or mntner in mlist:
+                if profile is None:
+                    ck = s.check_file(dom, lookups, fmt)
+                else:
+                    ck = profile.timed("check", s.check_file, dom, lookups, fmt, profile)
+
+            else:
+                probe = False
+    finally:
+        log.default.capture = capture
+
+    return (ck, records, out.getvalue(), mlist, probes.seen if probe else None,
+            profile.state(dom.schema) if profile is not None else None)
+
+
+class _LookupProbe:
+    "lookup key set that records which keys were asked for"
+    def __init__(self, keys):
+        self.keys = keys
+        self.seen = []
+
+    def __contains__(self, key):
+        self.seen.append(key)
+        return key in self.keys
+
+
+class ScanCache:
+    """on-disk cache of scan results
+
+    Entries are keyed by path and are only replayed while the content
+    hash of the file, the hash of its schema file and the presence of
+    every lookup key the object referenced are unchanged."""
+
+    VERSION = 2
+
+    def __init__(self, fn):
+        self.src = fn
+        self.tool = self.__tool_digest()
+        self.objects = {}
+        self.dirty = True
+
+        try:
+            with open(fn, mode="r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") == self.VERSION and data.get("tool") == self.tool:
+            self.objects = data.get("objects", {})
+            self.dirty = False
+
+    @staticmethod
+    def __tool_digest():
+        h = hashlib.sha1()
+        for fn in (__file__, log.__file__):
+            with open(fn, mode="rb") as f:
+                h.update(f.read())
+        return h.hexdigest()
+
+    @staticmethod
+    def __deps_digest(probes, lookups):
+        deps = "".join(
+            "%s\t%s\t%d\n" % (ref, val, (ref, val) in lookups) for ref, val in probes
+        )
+        return hashlib.sha1(deps.encode("utf-8")).hexdigest()
+
+    def get(self, fn, digest, schema_digest, lookups, fmt):
+        "cached (status, records, out, mntners, probes) or None"
+        e = self.objects.get(fn)
+        if e is None or schema_digest is None or e["format"] != fmt:
+            return None
+        if e["hash"] != digest or e["schema"] != schema_digest:
+            return None
+
+        probes = [tuple(i) for i in e["probes"]]
+        if e["deps"] != self.__deps_digest(probes, lookups):
+            return None
+
+        records = [(i[0], i[1], tuple(i[2])) for i in e["records"]]
+        return e["status"], records, e["out"], e["mntner"], probes
+
+    def put(self, fn, digest, schema_digest, lookups, fmt, result):
+        "store result"
+        ck, records, out, mlist, probes = result
+        self.dirty = True
+        self.objects[fn] = {
+            "format": fmt,
+            "hash": digest,
+            "schema": schema_digest,
+            "deps": self.__deps_digest(probes, lookups),
+            "probes": probes,
+            "status": ck,
+            "records": records,
+            "out": out,
+            "mntner": mlist,
+        }
+
+    def save(self, files):
+        "write cache, dropping entries for files that no longer exist"
+        objects = {k: v for k, v in self.objects.items() if k in files}
+        if not self.dirty and len(objects) == len(self.objects):
+            return
+
+        data = {"version": self.VERSION, "tool": self.tool, "objects": objects}
+
+        _write_json(self.src, data)
+
 
+class MntnerIndex:
+    """persistent index of the object type, content hash and mnt-by values
+    of every file
+
+    Files are only re-read when their modification time or size changes,
+    so filtering by mntner does not have to parse the whole registry."""
+
+    VERSION = 1
+
+    def __init__(self, fn):
+        self.src = fn
+        self.files = {}
+        self.mntners = {}
+
+        try:
+            with open(fn, mode="r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        if data.get("version") == self.VERSION:
+            self.files = data.get("files", {})
+
+    def refresh(self, files, jobs=1):
+        "(schema, digest) for each file, re-reading files that changed"
+        stamps = {}
+        stale = []
+        for fn in files:
+            st = os.stat(fn)
+            stamps[fn] = [st.st_mtime_ns, st.st_size]
+            e = self.files.get(fn)
+            if e is None or e[:2] != stamps[fn]:
+                stale.append(fn)
+
+        if len(stale) > 0:
+            log.info("mntner index: reading %d changed files" % (len(stale)))
+            with _scan_pool(min(jobs, len(stale))) as pool:
+                res = pool.map(_index_file, stale, max(1, len(stale) // (jobs * 16)))
+            for fn, e in zip(stale, res):
+                self.files[fn] = stamps[fn] + list(e)
+
+        dirty = len(stale) > 0 or len(self.files) != len(stamps)
+        self.files = {fn: self.files[fn] for fn in stamps}
+        self.mntners = {fn: e[4] for fn, e in self.files.items()}
+
+        if dirty:
+            _write_json(self.src, {"version": self.VERSION, "files": self.files})
+
+        return [(self.files[fn][2], self.files[fn][3]) for fn in files]
+
+
+def _index_file(fn):
+    schema, digest = _peek_file(fn)
+
+    # Parse errors are reported when the object itself is checked.
+    capture, log.default.capture = log.default.capture, []
+    try:
+        mlist = FileDOM(fn).mntner
+    finally:
+        log.default.capture = capture
+
+    return schema, digest, mlist
+
+
+def _write_json(fn, data):
+    "atomically replace fn with data"
+    d = os.path.dirname(fn)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+
+    tmp = "%s.%d.tmp" % (fn, os.getpid())
+    with open(tmp, mode="w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, fn)
+
+
+def _write_if_changed(fn, text):
+    "atomically replace fn with text unless it already holds it"
+    mode = None
+    try:
+        with open(fn, mode="r", encoding="utf-8", newline="") as f:
+            if f.read() == text:
+                return False
+            mode = os.fstat(f.fileno()).st_mode & 0o7777
+    except (OSError, UnicodeDecodeError):
+        pass
+
+    d = os.path.dirname(fn)
+    if d and not os.path.isdir(d):
+        os.makedirs(d)
+    tmp = "%s.%d.tmp" % (fn, os.getpid())
+    with open(tmp, mode="w", encoding="utf-8", newline="") as f:
+        f.write(text)
+    if mode is not None:
+        os.chmod(tmp, mode)
+    os.replace(tmp, fn)
+    return True
+
+
+def scan_changes(path, since, mntner=None, jobs=1, fmt="text", index_file=None,
+                 profile=None):
+    """scan objects changed since commit and objects referring to removed
+    ones; with index_file, object types come from the mntner index"""
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    timed = _profile_timer(profile)
+
+    changed, removed = __git_changes(path, since)
+
+    # The lookup keys come from the first key of every object, as in a
+    # full scan, since some objects are not filed under their own type.
+    # Only the first line is read, or nothing where the index is current.
+    files = timed("walk", list, __list_files(path))
+    if index_file is not None:
+        heads = [i[0] for i in timed("index", MntnerIndex(index_file).refresh, files, jobs)]
+    else:
+        with _scan_pool(jobs) as pool:
+            heads = timed("index", pool.map, _peek_head, files,
+                          max(1, len(files) // (jobs * 16)))
+
+    idx = {}
+    for fn, schema in zip(files, heads):
+        idx[(schema, fn.split("/")[-1].replace("_", "/"))] = fn
+
+    work = set(fn for fn in changed if fn.split("/")[-2] + "/" in XLAT)
+
+    schemas = {}
+    for (schema, _), fn in idx.items():
+        if schema == SCHEMA_NAMESPACE + "schema":
+            s = timed("schema", SchemaDOM, fn)
+            schemas[s.ref] = s
+
+    # A changed or removed schema affects every object of its type.
+    types = set()
+    for fn in changed + removed:
+        if fn.split("/")[-2] == "schema":
+            types.update(k for k, s in schemas.items() if s.src == fn)
+            types.update(k[0] for k in idx if k[0] not in schemas)
+    work.update(fn for k, fn in idx.items() if k[0] in types)
+
+    gone = set()
+    for fn in removed:
+        if fn.split("/")[-2] + "/" not in XLAT:
+            continue
+        ret = __git(path, "show", "%s:./%s" % (since, os.path.relpath(fn, path)))
+        key = (_peek_schema(ret.stdout.decode("utf-8")), fn.split("/")[-1].replace("_", "/"))
+        if key[0] is not None and key not in idx:
+            gone.add(key)
+
+    dependents = __find_referrers(path, schemas, gone)
+    work.update(dependents)
+
+    log.info(
+        "scan since %s: %d changed, %d removed, %d dependent objects"
+        % (since, len(changed), len(gone), len(dependents))
+    )
+
+    work = sorted(work)
+    tally = _ScanTally()
+    state = (schemas, frozenset(idx), mntner, False, fmt, profile is not None)
+    with _scan_pool(jobs, _scan_worker_init, (state,)) as pool:
+        for fn, (ck, records, out, _, _, times) in zip(work, pool.imap(_scan_worker, work)):
+            if times is not None:
+                profile.merge(fn, times)
+            timed("log", log.default.replay, records)
+            sys.stdout.write(out)
+            tally.add(ck)
+    return tally.finish(fmt)
+
+
+def __git(path, *args):
+    return subprocess.run(
+        ["git", "-C", path] + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        check=False,
+    )
+
+
+def __git_changes(path, since):
+    "files changed and removed under path since commit, including untracked files"
+    ret = __git(path, "diff", "--name-status", "-M", "-z", "--relative", since, "--", ".")
+    if ret.returncode != 0:
+        log.fatal("git diff %s failed: %s" % (since, ret.stderr.decode("utf-8").strip()))
+
+    changed, removed = [], []
+    fields = ret.stdout.decode("utf-8").split("\0")
+    i = 0
+    while i < len(fields) - 1:
+        status = fields[i]
+        if status[0] in "RC":
+            if status[0] == "R":
+                removed.append(os.path.join(path, fields[i + 1]))
+            changed.append(os.path.join(path, fields[i + 2]))
+            i += 3
+            continue
+
+        if status[0] == "D":
+            removed.append(os.path.join(path, fields[i + 1]))
+        else:
+            changed.append(os.path.join(path, fields[i + 1]))
+        i += 2
+
+    ret = __git(path, "ls-files", "-z", "--others", "--exclude-standard", "--", ".")
+    for fn in ret.stdout.decode("utf-8").split("\0"):
+        if fn:
+            changed.append(os.path.join(path, fn))
+
+    changed = [fn for fn in changed
+               if os.path.isfile(fn) and not os.path.basename(fn).startswith(".")]
+    removed = [fn for fn in removed if not os.path.basename(fn).startswith(".")]
+    return changed, removed
+
+
+def __find_referrers(path, schemas, gone):
+    "files with a lookup attribute naming one of the removed (schema, name) keys"
+    if len(gone) == 0:
+        return set()
+
+    # Reverse reference index: target type -> attributes that look it up.
+    rev = {}
+    for ref, s in schemas.items():
+        for k, lookups in s.lookups.items():
+            for refs, _ in lookups:
+                for target in refs:
+                    rev.setdefault(target, set()).add((ref, k))
+
+    attrs = {}
+    for schema, name in gone:
+        for ref, k in rev.get(schema, ()):
+            attrs.setdefault(ref, set()).add(k)
+
+    dirs = [t for t, schema in XLAT.items() if schema in attrs]
+    names = set(name for _, name in gone)
+    if len(dirs) == 0:
+        return set()
+
+    args = ["grep", "-l", "-z", "-F", "-w", "--untracked"]
+    for name in names:
+        args += ["-e", name]
+    ret = __git(path, *(args + ["--"] + dirs))
+
+    if ret.returncode in (0, 1):
+        candidates = [os.path.join(path, fn)
+                      for fn in ret.stdout.decode("utf-8").split("\0") if fn]
+    else:
+        candidates = []
+        for t in dirs:
+            for fn in glob.glob(os.path.join(path, t, "*")):
+                with open(fn, mode="r", encoding="utf-8") as f:
+                    text = f.read()
+                if any(name in text for name in names):
+                    candidates.append(fn)
+
+    found = set()
+    for fn in candidates:
+        if not os.path.isfile(fn):
+            continue
+        dom = FileDOM(fn)
+        keys = attrs.get(dom.schema, ())
+        for k, v, _ in dom.dom:
+            if k in keys and len(v.split()) > 0 and v.split()[0] in names:
+                found.add(fn)
+                break
+    return found
+
+
+def __list_files(path, use_file=None):
     for root, _, files in os.walk(path):
         ignore = True
-        for t in xlat:
+        for t in XLAT:
             if root + "/" == os.path.join(path, t):
                 ignore = False
                 break
@@ -392,69 +1364,1337 @@ def __index_files(path, use_file=None):
         for f in files:
             if f[0] == ".":
                 continue
-            dom = FileDOM(os.path.join(root, f))
-            yield dom
+            yield os.path.join(root, f)
 
     if use_file is not None:
-        dom = FileDOM(use_file)
-        yield dom
+        yield use_file
 
 
-def index_files(path):
+def __index_files(path, use_file=None):
+    for fn in __list_files(path, use_file):
+        yield FileDOM(fn)
+
+
+def index_files(path, outfile=None):
     "index files"
-    idx = __index_files(path)
-    for i in idx:
-        print("%s\t%s\t%s\t%s" % i)
+    if outfile is None:
+        RegistryIndex.write(__list_files(path), sys.stdout.buffer)
+        return
 
+    with open(outfile + ".tmp", "wb") as f:
+        RegistryIndex.write(__list_files(path), f)
+    os.replace(outfile + ".tmp", outfile)
 
-def http_get(server, url, query=None, headers=None):
-    "http get"
-    if headers is None:
-        headers = {}
-    if "User-Agent" not in headers:
-        headers["User-Agent"] = "curl"
-    if "Accept" not in headers:
-        headers["Accept"] = "application/json"
 
-    if query is None:
-        query = {}
+class RegistryIndex:
+    """memory mapped binary registry index
+
+    Layout, little endian:
 
-    http_client = http.client.HTTPSConnection(server)
+        header   magic, version, strings, objects, mntners
+        strings  (strings + 1) u32 offsets into the string data
+        objects  type, key, path and text string ids, first mntner,
+                 mntners, source size (u32 each) and source mtime in
+                 ns (u64)
+        mntners  string ids of the mnt-by values
+        string data, utf-8
 
-    full_url = url + "?" + urllib.parse.urlencode(query)
-    log.debug("GET " + full_url)
+    The text of an object is its whole attribute block as read from the
+    file, so objects are validated from the index without opening their
+    sources. Strings are decoded when first asked for; opening the index
+    costs a mmap and a header read no matter how large the registry is."""
 
-    http_client.request("GET", full_url, headers=headers)
-    req = http_client.getresponse()
-    log.debug("HTTP Response: %d %s" % (req.status, req.reason))
+    MAGIC = b"DN42IDX\0"
+    VERSION = 2
+    HEADER = struct.Struct("<8sIIII")
+    OBJECT = struct.Struct("<7IQ")
 
-    if "application/json" in req.getheader("Content-Type", "application/json"):
-        if req.status > 299:
-            return {}
-        r = req.read()
-        if not isinstance(r, str):
-            r = r.decode("utf-8")
-        return json.loads(r)
+    def __init__(self, fn):
+        with open(fn, mode="rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, nstr, nobj, nmnt = self.HEADER.unpack_from(self.mm)
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError("%s is not a version %d index" % (fn, self.VERSION))
+
+        self.nobj = nobj
+        self.str_off = self.HEADER.size
+        self.obj_off = self.str_off + (nstr + 1) * 4
+        self.mnt_off = self.obj_off + nobj * self.OBJECT.size
+        self.data_off = self.mnt_off + nmnt * 4
+        self.strings = {}
+
+    @classmethod
+    def is_index(cls, fn):
+        "does fn start with the index magic"
+        with open(fn, mode="rb") as f:
+            return f.read(len(cls.MAGIC)) == cls.MAGIC
+
+    @classmethod
+    def write(cls, files, out):
+        "index files and write the result to the binary stream out"
+        strings = {}
+        objects = []
+        mnts = []
+
+        def sid(v):
+            if v not in strings:
+                strings[v] = len(strings)
+            return strings[v]
+
+        for fn in files:
+            with open(fn, mode="rb") as f:
+                st = os.fstat(f.fileno())
+                text = f.read().decode("utf-8")
+            dom = FileDOM(fn, text)
+            if not dom.valid:
+                log.warning("Unable to index %s" % (fn))
+                continue
 
-    if req.status > 299:
-        return ""
+            first_mnt = len(mnts)
+            mnts.extend(sid(m) for m in dom.mntner)
+
+            objects.append((
+                sid(dom.schema),
+                sid(fn.split("/")[-1].replace("_", "/")),
+                sid(fn),
+                sid(text),
+                first_mnt,
+                len(mnts) - first_mnt,
+                st.st_size,
+                st.st_mtime_ns,
+            ))
+
+        data = [s.encode("utf-8") for s in strings]
+        offsets = [0]
+        for s in data:
+            offsets.append(offsets[-1] + len(s))
+
+        out.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, len(data), len(objects),
+                                  len(mnts)))
+        out.write(struct.pack("<%dI" % (len(offsets)), *offsets))
+        for o in objects:
+            out.write(cls.OBJECT.pack(*o))
+        out.write(struct.pack("<%dI" % (len(mnts)), *mnts))
+        out.write(b"".join(data))
+
+    def __len__(self):
+        return self.nobj
+
+    def __iter__(self):
+        "(number, schema, primary key, path, mntners) of every object"
+        mnts = memoryview(self.mm)[self.mnt_off:self.data_off].cast("I")
+        string = self.string
+        for i, (t, k, p, _, first, n, _, _) in enumerate(struct.iter_unpack(
+                self.OBJECT.format, self.mm[self.obj_off:self.mnt_off])):
+            yield (i, string(t), string(k), string(p),
+                   [string(m) for m in mnts[first:first + n]])
+
+    def __decode(self, i):
+        start, end = struct.unpack_from("<2I", self.mm, self.str_off + i * 4)
+        return self.mm[self.data_off + start:self.data_off + end].decode("utf-8")
+
+    def string(self, i):
+        "string table entry i"
+        s = self.strings.get(i)
+        if s is None:
+            s = self.strings[i] = self.__decode(i)
+        return s
 
-    return req.read()
+    def object(self, i):
+        "(schema, primary key, path, mntners) of object i"
+        t, k, p, _, first, n, _, _ = self.OBJECT.unpack_from(
+            self.mm, self.obj_off + i * self.OBJECT.size)
+        mnts = struct.unpack_from("<%dI" % (n), self.mm, self.mnt_off + first * 4)
+        return (self.string(t), self.string(k), self.string(p),
+                [self.string(m) for m in mnts])
+
+    def text(self, i):
+        "indexed text of object i, not kept once returned"
+        return self.__decode(self.OBJECT.unpack_from(
+            self.mm, self.obj_off + i * self.OBJECT.size)[3])
+
+    def dom(self, i):
+        "parse the indexed text of object i"
+        return FileDOM(self.object(i)[2], self.text(i))
+
+    def stale(self, i):
+        "has the source of object i changed or gone since it was indexed"
+        o = self.OBJECT.unpack_from(self.mm, self.obj_off + i * self.OBJECT.size)
+        return _file_stat(self.string(o[2])) != (o[7], o[6])
+
+
+class Inotify:
+    "directory watcher on the Linux inotify calls, through ctypes"
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    EVENT = struct.Struct("iIII")
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add(self, path):
+        "watch files created, written, moved or removed in directory path"
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_add_watch %s failed" % (path))
+        self.watches[wd] = path
+
+    def fileno(self):
+        return self.fd
+
+    def read(self):
+        "(changed paths, overflowed) for the events queued so far"
+        changed = set()
+        overflow = False
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = self.EVENT.unpack_from(buf, pos)
+                pos += self.EVENT.size
+                name = buf[pos:pos + length].rstrip(b"\0")
+                pos += length
+
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                elif wd in self.watches and name:
+                    changed.add(os.path.join(self.watches[wd], os.fsdecode(name)))
+        return changed, overflow
+
+
+class RegistryWatch:
+    """files of a registry changed since they were last read
+
+    Changes come from inotify events on the object directories, or from a
+    stat of every file where inotify is missing or its queue overflowed.
+    Shared by the resident registries of serve and whois-serve."""
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = {}
+        self.inotify = None
+        try:
+            self.inotify = Inotify()
+            for t in XLAT:
+                d = os.path.join(path, t)
+                if os.path.isdir(d):
+                    self.inotify.add(d)
+        except (OSError, AttributeError) as e:
+            log.warning("inotify unavailable, checking file times instead: %s" % (e))
+            self.inotify = None
+
+    def fileno(self):
+        return self.inotify.fileno()
+
+    def stat(self, fn):
+        "record fn as read, returns its stat or None if it is gone"
+        stat = _file_stat(fn)
+        if stat is None:
+            self.stats.pop(fn, None)
+        else:
+            self.stats[fn] = stat
+        return stat
+
+    def changed(self):
+        "sorted files changed since the last call, dot files left out"
+        if self.inotify is not None:
+            changed, overflow = self.inotify.read()
+        if self.inotify is None or overflow:
+            changed = set(fn for fn in _registry_files(self.path)
+                          if self.stats.get(fn) != _file_stat(fn))
+            changed.update(fn for fn in self.stats if not os.path.exists(fn))
+        return sorted(fn for fn in changed if not os.path.basename(fn).startswith("."))
+
+
+class ResidentRegistry:
+    """parsed registry kept in memory for serve
+
+    Holds every FileDOM, the compiled schemas, the lookup keys and the
+    check result of each object. Changed files are re-parsed from inotify
+    events, or from a stat of every file where inotify is missing. A
+    result is dropped when its file changes or when a lookup key it
+    asked for appears or disappears."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.doms = {}
+        self.broken = {}
+        self.keys = {}
+        self.schemas = {}
+        self.results = {}
+        self.referrers = {}
+        self.paths = {}
+
+        self.watch = RegistryWatch(path)
+        for fn in _registry_files(path):
+            self.__update(fn)
+        self.__compile()
+
+    def __key(self, fn):
+        dom = self.doms.get(fn)
+        if dom is None:
+            return None
+        return dom.schema, fn.split("/")[-1].replace("_", "/")
+
+    def __invalidate(self, key):
+        for fn in self.referrers.pop(key, ()):
+            self.results.pop(fn, None)
+
+    def __update(self, fn):
+        "re-read fn, returns True if it is a schema file"
+        old = self.__key(fn)
+        self.broken.pop(fn, None)
+        self.results.pop(fn, None)
+
+        dom = None
+        if self.watch.stat(fn) is not None:
+            try:
+                dom = FileDOM(fn)
+            except (OSError, ValueError, IndexError) as e:
+                self.broken[fn] = str(e) or "empty file"
+
+        # A changed file keeps its place, so scans print in walk order.
+        if dom is not None:
+            self.doms[fn] = dom
+        else:
+            self.doms.pop(fn, None)
+
+        if dom is not None or fn in self.broken:
+            self.paths[os.path.abspath(fn)] = fn
+        else:
+            self.paths.pop(os.path.abspath(fn), None)
+
+        new = self.__key(fn)
+        if old != new:
+            if old is not None and self.keys.get(old) == fn:
+                del self.keys[old]
+                self.__invalidate(old)
+            if new is not None:
+                self.keys[new] = fn
+                self.__invalidate(new)
+
+        return fn.split("/")[-2] == "schema"
+
+    def __compile(self):
+        self.schemas = {}
+        for (schema, _), fn in self.keys.items():
+            if schema == SCHEMA_NAMESPACE + "schema":
+                s = SchemaDOM(fn)
+                self.schemas[s.ref] = s
+        self.results = {}
+        self.referrers = {}
+
+    def refresh(self):
+        "apply file changes since the last refresh"
+        with self.lock:
+            changed = self.watch.changed()
+            schema = False
+            added = False
+            for fn in changed:
+                added = added or fn not in self.doms
+                schema = self.__update(fn) or schema
+            if schema:
+                self.__compile()
+            if added:
+                self.doms = dict((fn, self.doms[fn]) for fn in _registry_files(self.path)
+                                 if fn in self.doms)
+            if changed:
+                log.info("serve: re-read %d files" % (len(changed)))
+
+    def __check(self, fn, dom, fmt):
+        records = []
+        out = io.StringIO()
+        probe = _LookupProbe(self.keys)
+
+        capture, log.default.capture = log.default.capture, records
+        try:
+            with contextlib.redirect_stdout(out):
+                s = self.schemas.get(dom.schema)
+                if s is None:
+                    _print_no_schema(fn, fmt)
+                    ck = "FAIL"
+                else:
+                    ck = s.check_file(dom, probe, fmt)
+        finally:
+            log.default.capture = capture
+
+        for key in probe.seen:
+            self.referrers.setdefault(key, set()).add(fn)
+        return ck, records, out.getvalue()
+
+    def scan(self, mntner=None, use_file=None, fmt="text"):
+        "(status, log records, output) of a scan, as scan_files would print it"
+        self.refresh()
+        with self.lock:
+            if use_file is not None:
+                use_file = self.paths.get(os.path.abspath(use_file))
+                if use_file is None:
+                    return None
+
+            tally = _ScanTally()
+            records = []
+            out = io.StringIO()
+            for fn in list(self.broken) + list(self.doms):
+                if use_file is not None and use_file != fn:
+                    continue
+
+                dom = self.doms.get(fn)
+                if dom is None:
+                    message = "File does not parse: %s" % (self.broken[fn])
+                    capture, log.default.capture = log.default.capture, records
+                    try:
+                        log.error("%s Line 0: %s" % (fn, message))
+                    finally:
+                        log.default.capture = capture
+                    with contextlib.redirect_stdout(out):
+                        print_check(fn, "FAIL", None, None, [_finding(
+                            log.VERB_ERROR, 0, None, "parse", message)], fmt)
+                    tally.add("FAIL")
+                    continue
+
+                if (mntner is not None and dom.schema in self.schemas
+                        and mntner not in dom.mntner):
+                    continue
+
+                results = self.results.setdefault(fn, {})
+                result = results.get(fmt)
+                if result is None:
+                    result = results[fmt] = self.__check(fn, dom, fmt)
+                ck, rec, text = result
+                records.extend(rec)
+                out.write(text)
+                tally.add(ck)
+
+            with contextlib.redirect_stdout(out):
+                status = tally.finish(fmt)
+            return status, records, out.getvalue()
+
+
+def _registry_files(path):
+    return list(__list_files(path))
+
+
+def _object_files(path):
+    "files of a registry, or of a directory of objects such as data/inetnum"
+    files = _registry_files(path)
+    if len(files) == 0:
+        files = sorted(os.path.join(path, f) for f in os.listdir(path)
+                       if f[0] != "." and os.path.isfile(os.path.join(path, f)))
+    return files
+
+
+def _file_stat(fn):
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size
+
+
+class _ServeHandler(socketserver.StreamRequestHandler):
+    "one JSON request line in, one JSON response line out"
+
+    def handle(self):
+        try:
+            req = json.loads(self.rfile.readline())
+        except ValueError:
+            return
+
+        registry = self.server.registry
+        if req.get("command") == "scan" and req.get("path") != os.path.abspath(registry.path):
+            resp = {"error": "serving %s, not %s" % (os.path.abspath(registry.path),
+                                                      req.get("path"))}
+        elif req.get("command") == "scan":
+            start = time.perf_counter()
+            res = registry.scan(req.get("mntner"), req.get("file"), req.get("format", "text"))
+            if res is None:
+                resp = {"error": "file is not in the registry"}
+            else:
+                status, records, out = res
+                resp = {"status": "PASS" if status is True else status,
+                        "records": records, "out": out}
+            log.info("serve: %s in %.1fms" % (req, (time.perf_counter() - start) * 1e3))
+        elif req.get("command") == "ping":
+            resp = {"status": "PASS", "path": registry.path}
+        else:
+            resp = {"error": "unknown command"}
+
+        self.wfile.write(json.dumps(resp).encode("utf-8") + b"\n")
+
+
+def serve(path, sock):
+    "keep path parsed in memory and answer scan requests on unix socket sock"
+    if serve_request(sock, {"command": "ping"}) is not None:
+        log.fatal("serve: %s is already in use" % (sock))
+    if os.path.exists(sock):
+        os.unlink(sock)
+    if os.path.dirname(sock):
+        os.makedirs(os.path.dirname(sock), exist_ok=True)
+
+    start = time.perf_counter()
+    registry = ResidentRegistry(path)
+    log.notice("serve: loaded %d objects from %s in %.2fs"
+               % (len(registry.doms), path, time.perf_counter() - start))
+
+    def watch():
+        while True:
+            select.select([registry.watch], [], [])
+            registry.refresh()
+
+    if registry.watch.inotify is not None:
+        threading.Thread(target=watch, daemon=True).start()
+
+    # Only the owner may connect, from the moment the socket exists.
+    umask = os.umask(0o177)
+    try:
+        server = socketserver.UnixStreamServer(sock, _ServeHandler)
+    finally:
+        os.umask(umask)
+    server.registry = registry
+    log.notice("serve: listening on %s" % (sock))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(sock)
+
+
+def serve_request(sock, req):
+    "response of a running serve to req, None if nothing is listening on sock"
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as c:
+            c.connect(sock)
+            c.sendall(json.dumps(req).encode("utf-8") + b"\n")
+            data = c.makefile("rb").readline()
+    except OSError:
+        return None
+
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+
+class WhoisIndex:
+    """registry objects held in memory for whois-serve
+
+    Objects are indexed by primary key, by address in a NetTree for
+    longest prefix matches, by ASN range for as-blocks and by the values
+    of the inverse attributes. Every index entry of a file is recorded
+    with it, so a changed file is taken out and put back on its own."""
+
+    INVERSE = ("mnt-by", "admin-c", "tech-c")
+
+    def __init__(self, path):
+        self.path = path
+        self.texts = {}
+        self.types = {}
+        self.entries = {}
+        self.names = {}
+        self.inverse = dict((k, {}) for k in self.INVERSE)
+        self.blocks = {}
+        self.tree = NetTree()
+
+        self.watch = RegistryWatch(path)
+        for fn in _registry_files(path):
+            self.update(fn)
+
+    def update(self, fn):
+        "take fn out of the indexes and put it back if it still parses"
+        for kind, key, val in self.entries.pop(fn, ()):
+            if kind == "name":
+                self.names[key].remove(fn)
+                if len(self.names[key]) == 0:
+                    del self.names[key]
+            elif kind == "net":
+                self.tree.delete(key, val)
+            elif kind == "block":
+                self.blocks.pop(fn, None)
+            else:
+                refs = self.inverse[kind][key]
+                refs.discard(fn)
+                if len(refs) == 0:
+                    del self.inverse[kind][key]
+        self.texts.pop(fn, None)
+        self.types.pop(fn, None)
+
+        if self.watch.stat(fn) is None:
+            return
+        try:
+            with open(fn, mode="r", encoding="utf-8") as f:
+                text = f.read()
+            capture, log.default.capture = log.default.capture, []
+            try:
+                dom = FileDOM(fn, text)
+            finally:
+                log.default.capture = capture
+        except (OSError, ValueError, IndexError):
+            return
+        if not dom.valid or len(dom.dom) == 0:
+            return
+
+        obj_type = dom.schema[len(SCHEMA_NAMESPACE):]
+        name = os.path.basename(fn).replace("_", "/")
+        self.texts[fn] = text
+        self.types[fn] = obj_type
+        entries = self.entries[fn] = [("name", name.upper(), None)]
+        self.names.setdefault(name.upper(), []).append(fn)
+
+        if obj_type in NetTree.TYPES and self.tree.insert(obj_type, name) is not None:
+            entries.append(("net", obj_type, name))
+        if obj_type == "as-block":
+            rng = [i.strip().upper() for i in name.split("-")]
+            if len(rng) == 2 and all(i[:2] == "AS" and i[2:].isdigit() for i in rng):
+                self.blocks[fn] = (int(rng[0][2:]), int(rng[1][2:]))
+                entries.append(("block", None, None))
+
+        for k in self.INVERSE:
+            for i in dom.keys.get(k, []):
+                val = dom.dom[i][1].split()[0].upper() if dom.dom[i][1] else ""
+                if val and (k, val, None) not in entries:
+                    self.inverse[k].setdefault(val, set()).add(fn)
+                    entries.append((k, val, None))
+
+    def refresh(self):
+        "apply file changes since the last refresh, returns the files re-read"
+        changed = self.watch.changed()
+        for fn in changed:
+            self.update(fn)
+        return changed
+
+    def __nets(self, text, less):
+        obj_type = "inet6num" if ":" in text else "inetnum"
+        if "/" not in text:
+            text += "/128" if obj_type == "inet6num" else "/32"
+        net = parse_net(obj_type, text)
+        if net is None:
+            return None
+
+        found = []
+        for types in (NetTree.NETS, ("route", "route6")):
+            # IPv4 space sits inside ::/0 in the tree, skip IPv6 parents.
+            nodes = [n for n in self.tree.covering(*net)
+                     if any(t in types for t, _ in n.objects)
+                     and (obj_type == "inet6num" or n.mask >= 96)]
+            for node in nodes if less else nodes[-1:]:
+                found.extend(self.__fn(t, name) for t, name in node.objects if t in types)
+        return found
+
+    def __fn(self, obj_type, name):
+        return next(fn for fn in self.names[name.upper()] if self.types[fn] == obj_type)
+
+    def lookup(self, query, types=None, inverse=None, less=False, exact=False):
+        "files answering a query, in answer order"
+        key = query.upper()
+        if inverse is not None:
+            found = sorted(set().union(*(self.inverse[k].get(key, ()) for k in inverse)))
+        else:
+            if key.isdigit():
+                key = "AS" + key
+            found = list(self.names.get(key, []))
+            if not exact and "/" not in key and re.match(r"^AS\d+$", key):
+                asn = int(key[2:])
+                blocks = sorted((lo - hi, fn) for fn, (lo, hi) in self.blocks.items()
+                                if lo <= asn <= hi)
+                if less:
+                    found.extend(fn for _, fn in blocks)
+                elif len(found) == 0:
+                    found.extend(fn for _, fn in blocks[-1:])
+            elif not exact and re.match(r"^[0-9A-F:.]+(/\d+)?$", key) and (
+                    "." in key or ":" in key):
+                found.extend(fn for fn in self.__nets(query, less) or ()
+                             if fn not in found)
+
+        if types is not None:
+            found = [fn for fn in found if self.types[fn] in types]
+        return found
+
+    def query(self, line):
+        "response text to one whois query line"
+        args = line.split()
+        types = inverse = None
+        less = exact = False
+        words = []
+        try:
+            while args:
+                a = args.pop(0)
+                if a == "-T":
+                    types = set(args.pop(0).lower().split(","))
+                elif a == "-i":
+                    inverse = args.pop(0).lower().split(",")
+                    if any(k not in self.INVERSE for k in inverse):
+                        return "%%ERROR:106: inverse lookup only on %s\n\n" % (
+                            ", ".join(self.INVERSE))
+                elif a == "-L":
+                    less = True
+                elif a == "-x":
+                    exact = True
+                elif a in ("-r", "-B", "-G"):
+                    continue
+                elif a.startswith("-"):
+                    return "%%ERROR:111: invalid option %s\n\n" % (a)
+                else:
+                    words.append(a)
+        except IndexError:
+            return "%ERROR:106: option needs an argument\n\n"
+        if len(words) != 1:
+            return "%ERROR:106: no search key specified\n\n"
+
+        found = self.lookup(words[0], types, inverse, less, exact)
+        if len(found) == 0:
+            return "%ERROR:101: no entries found\n\n"
+        out = []
+        for fn in found:
+            out.append("%% Information related to '%s/%s':\n" % (
+                self.types[fn], os.path.basename(fn).replace("_", "/")))
+            out.append(self.texts[fn].rstrip("\n") + "\n\n")
+        return "".join(out)
+
+
+async def _whois_client(index, reader, writer):
+    start = time.perf_counter()
+    try:
+        line = await asyncio.wait_for(reader.readline(), 10)
+        line = line[:1024].decode("utf-8", "replace").strip()
+        writer.write(index.query(line).encode("utf-8"))
+        await writer.drain()
+        log.info("whois-serve: %s in %.2fms" % (line, (time.perf_counter() - start) * 1e3))
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def whois_serve(path, host, port):
+    "answer RFC 3912 whois queries on host:port from path held in memory"
+    start = time.perf_counter()
+    index = WhoisIndex(path)
+    log.notice("whois-serve: loaded %d objects from %s in %.2fs"
+               % (len(index.texts), path, time.perf_counter() - start))
+
+    async def main():
+        loop = asyncio.get_running_loop()
+
+        def refresh():
+            changed = index.refresh()
+            if changed:
+                log.info("whois-serve: re-read %d files" % (len(changed)))
+
+        if index.watch.inotify is not None:
+            loop.add_reader(index.watch.fileno(), refresh)
+
+        server = await asyncio.start_server(
+            lambda r, w: _whois_client(index, r, w), host, port)
+        log.notice("whois-serve: listening on %s" % (", ".join(
+            "%s:%d" % s.getsockname()[:2] for s in server.sockets)))
+        async with server:
+            while True:
+                await asyncio.sleep(5)
+                if index.watch.inotify is None:
+                    refresh()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+# Server of the registry API, "host[:port]" for HTTPS or a full URL.
+REGISTRY_SERVER = "registry.dn42.us"
+REGISTRY_URL = "/v1/reg/reg.objects"
+
+
+class RegistryClient:
+    """HTTP client for the registry API
+
+    find() asks server unless given another. Connections are kept alive
+    and reused, up to size idle ones per server. JSON responses are kept
+    in an LRU cache of cache_size entries for ttl seconds, keyed on the
+    server, url and query. Safe to share between threads."""
+
+    RETRY = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+             ConnectionResetError, BrokenPipeError)
+
+    def __init__(self, server=REGISTRY_SERVER, size=8, cache_size=4096, ttl=300, timeout=30):
+        self.server = server
+        self.size = size
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __connect(self, server):
+        scheme, netloc = "https", server
+        if "://" in server:
+            u = urllib.parse.urlsplit(server)
+            scheme, netloc = u.scheme, u.netloc
+        if scheme == "http":
+            return http.client.HTTPConnection(netloc, timeout=self.timeout)
+        return http.client.HTTPSConnection(netloc, timeout=self.timeout)
+
+    def __request(self, server, full_url, headers):
+        with self.lock:
+            pool = self.idle.setdefault(server, [])
+            conn = pool.pop() if pool else None
+        reused = conn is not None
+        if conn is None:
+            conn = self.__connect(server)
+
+        try:
+            conn.request("GET", full_url, headers=headers)
+            req = conn.getresponse()
+            data = req.read()
+        except self.RETRY:
+            conn.close()
+            if not reused:
+                raise
+            # The server dropped an idle connection, ask again on a new one.
+            conn = self.__connect(server)
+            conn.request("GET", full_url, headers=headers)
+            req = conn.getresponse()
+            data = req.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if req.will_close:
+            conn.close()
+        else:
+            with self.lock:
+                pool = self.idle.setdefault(server, [])
+                if len(pool) < self.size:
+                    pool.append(conn)
+                    conn = None
+            if conn is not None:
+                conn.close()
+        return req, data
+
+    def get(self, server, url, query=None, headers=None):
+        "response of a GET, decoded if it is JSON, as http_get() returns it"
+        if headers is None:
+            headers = {}
+        if "User-Agent" not in headers:
+            headers["User-Agent"] = "curl"
+        if "Accept" not in headers:
+            headers["Accept"] = "application/json"
+
+        if query is None:
+            query = {}
+
+        key = (server, url, tuple(sorted(query.items())))
+        now = time.monotonic()
+        with self.lock:
+            hit = self.cache.get(key)
+            if hit is not None and hit[0] > now:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return hit[1]
+            self.misses += 1
+
+        full_url = url + "?" + urllib.parse.urlencode(query)
+        log.debug("GET " + full_url)
+
+        req, data = self.__request(server, full_url, headers)
+        log.debug("HTTP Response: %d %s" % (req.status, req.reason))
+
+        if "application/json" in req.getheader("Content-Type", "application/json"):
+            if req.status > 299:
+                return {}
+            res = json.loads(data.decode("utf-8"))
+        elif req.status > 299:
+            return ""
+        else:
+            res = data
+
+        if self.ttl > 0 and self.cache_size > 0:
+            with self.lock:
+                self.cache[key] = (now + self.ttl, res)
+                self.cache.move_to_end(key)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return res
+
+    def find(self, fields=None, filters=None, server=None):
+        "registry objects matching filters, with fields"
+        if fields is None:
+            fields = []
+        if filters is None:
+            filters = {}
+        query = {
+            "fields": ",".join(fields),
+            "filter": ",".join([k + "=" + v for k, v in filters.items()]),
+        }
+        return self.get(server or self.server, REGISTRY_URL, query)
+
+    def close(self):
+        "close idle connections"
+        with self.lock:
+            for pool in self.idle.values():
+                for conn in pool:
+                    conn.close()
+            self.idle = {}
+
+
+HTTP = RegistryClient()
+
+
+def http_get(server, url, query=None, headers=None):
+    "http get"
+    return HTTP.get(server, url, query, headers)
 
 
 def find(fields=None, filters=None):
     "find"
-    server = "registry.dn42.us"
-    url = "/v1/reg/reg.objects"
-    if fields is None:
-        fields = []
-    if filters is None:
-        filters = {}
-    query = {
-        "fields": ",".join(fields),
-        "filter": ",".join([k + "=" + v for k, v in filters.items()]),
-    }
-    return http_get(server, url, query)
+    return HTTP.find(fields, filters)
+
+
+class _RegistryStubHandler(http.server.BaseHTTPRequestHandler):
+    "registry API requests answered from a LocalRegistry"
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes on a kept alive connection.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        u = urllib.parse.urlsplit(self.path)
+        q = urllib.parse.parse_qs(u.query, keep_blank_values=True)
+        status = 200
+        if u.path != REGISTRY_URL:
+            status, res = 404, {"error": "not found"}
+        else:
+            fields = [i for i in q.get("fields", [""])[0].split(",") if i]
+            filters = dict(i.split("=", 1) for i in q.get("filter", [""])[0].split(",")
+                           if "=" in i)
+            try:
+                with self.server.lock:
+                    res = self.server.registry.find(fields, filters)
+            except (ValueError, KeyError, IndexError) as e:
+                status, res = 400, {"error": "unsupported query: %s" % (e)}
+
+        data = json.dumps(res).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        log.debug("registry-stub: " + format % args)
+
+
+def registry_stub(path, host="127.0.0.1", port=8043, rev=None):
+    """HTTP server answering the registry API queries of test_policy()
+    from the registry at path; serve_forever() it, or run it in a thread"""
+    server = http.server.ThreadingHTTPServer((host, port), _RegistryStubHandler)
+    server.daemon_threads = True
+    server.registry = LocalRegistry(path, rev)
+    server.lock = threading.Lock()
+    return server
+
+
+def parse_net(obj_type, name):
+    """(network, mask) of an inetnum, inet6num, route or route6 prefix in
+    the IPv4-mapped IPv6 space, or None if it does not parse"""
+    try:
+        ip, mask = name.split("/")
+        mask = int(mask)
+        if obj_type in ("inetnum", "route"):
+            if not 0 <= mask <= 32:
+                return None
+            net, mask = (0xFFFF << 32) | to_num(ip), mask + 96
+        else:
+            if not 0 <= mask <= 128:
+                return None
+            net = int(expand_ipv6(ip), 16)
+    except (ValueError, TypeError, IndexError):
+        return None
+
+    if not 0 <= net < 1 << 128:
+        return None
+    return net & ~((1 << (128 - mask)) - 1), mask
+
+
+class NetNode:
+    "radix tree node for one prefix"
+    __slots__ = ("net", "mask", "parent", "children", "objects")
+
+    def __init__(self, net, mask, parent):
+        self.net = net
+        self.mask = mask
+        self.parent = parent
+        self.children = [None, None]
+        self.objects = []
+
+    def __repr__(self):
+        return "NetNode(%032x/%d, %s)" % (self.net, self.mask, self.objects)
+
+
+class NetTree:
+    """path compressed binary radix tree of inetnum, inet6num, route and
+    route6 objects in the IPv4-mapped IPv6 space
+
+    Each prefix has one node holding the (type, name) of its objects.
+    Nodes without objects only join branches. Objects can be inserted and
+    deleted at any time. The hierarchy attributes the registry API derives
+    (@netlevel, @netmin, @netmax, @netmask and @family) are computed from
+    the tree."""
+
+    NETS = ("inetnum", "inet6num")
+    TYPES = ("inetnum", "inet6num", "route", "route6")
+
+    def __init__(self):
+        self.root = NetNode(0, 0, None)
+        self.size = 0
+
+    @classmethod
+    def from_registry(cls, path, types=TYPES):
+        "tree of the address objects under path"
+        tree = cls()
+        for t in types:
+            d = os.path.join(path, t)
+            if not os.path.isdir(d):
+                continue
+            for fn in os.listdir(d):
+                if fn[0] != "." and tree.insert(t, fn.replace("_", "/")) is None:
+                    log.warning("Unable to index %s/%s" % (t, fn))
+        return tree
+
+    def insert(self, obj_type, name):
+        "add object, returns its node or None if the name does not parse"
+        net = parse_net(obj_type, name)
+        if net is None:
+            return None
+
+        node = self.__insert(*net)
+        if (obj_type, name) not in node.objects:
+            node.objects.append((obj_type, name))
+            self.size += 1
+        return node
+
+    def delete(self, obj_type, name):
+        "remove object, returns False if it was not in the tree"
+        net = parse_net(obj_type, name)
+        node = None if net is None else self.node(*net)
+        if node is None or (obj_type, name) not in node.objects:
+            return False
+
+        node.objects.remove((obj_type, name))
+        self.size -= 1
+        self.__prune(node)
+        return True
+
+    def __insert(self, net, mask):
+        node = self.root
+        while True:
+            if node.mask == mask:
+                return node
+
+            bit = (net >> (127 - node.mask)) & 1
+            child = node.children[bit]
+            if child is None:
+                child = node.children[bit] = NetNode(net, mask, node)
+                return child
+
+            common = min(128 - (child.net ^ net).bit_length(), child.mask, mask)
+            if common == child.mask:
+                node = child
+                continue
+
+            # Split the edge to child with a node at the common prefix.
+            if common == mask:
+                new = NetNode(net, mask, node)
+            else:
+                new = NetNode(net & ~((1 << (128 - common)) - 1), common, node)
+            node.children[bit] = new
+            new.children[(child.net >> (127 - common)) & 1] = child
+            child.parent = new
+
+            if common == mask:
+                return new
+            leaf = new.children[(net >> (127 - common)) & 1] = NetNode(net, mask, new)
+            return leaf
+
+    def __prune(self, node):
+        while node is not self.root and len(node.objects) == 0:
+            kids = [c for c in node.children if c is not None]
+            if len(kids) == 2:
+                return
+
+            p = node.parent
+            bit = 0 if p.children[0] is node else 1
+            if len(kids) == 1:
+                p.children[bit] = kids[0]
+                kids[0].parent = p
+                return
+
+            p.children[bit] = None
+            node = p
+
+    def node(self, net, mask):
+        "node of exactly this prefix or None"
+        node = self.root
+        while node is not None and node.mask < mask:
+            node = node.children[(net >> (127 - node.mask)) & 1]
+        if node is None or node.mask != mask or node.net != net:
+            return None
+        return node
+
+    def covering(self, net, mask=128, strict=False):
+        "nodes with objects whose prefix contains net/mask, shortest first"
+        res = []
+        node = self.root
+        while node is not None and node.mask <= mask and (net ^ node.net) >> (128 - node.mask) == 0:
+            if len(node.objects) > 0 and not (strict and node.mask == mask):
+                res.append(node)
+            if node.mask == mask:
+                break
+            node = node.children[(net >> (127 - node.mask)) & 1]
+        return res
+
+    def longest_prefix(self, net, mask=128, strict=False):
+        "most specific node with objects containing net/mask, or None"
+        res = self.covering(net, mask, strict)
+        return res[-1] if len(res) > 0 else None
+
+    def covered_by(self, net, mask, strict=False):
+        "nodes with objects inside net/mask, in address order"
+        node = self.root
+        while node is not None and node.mask < mask:
+            if (net ^ node.net) >> (128 - node.mask) != 0:
+                return []
+            node = node.children[(net >> (127 - node.mask)) & 1]
+        if node is None or (net ^ node.net) >> (128 - mask) != 0:
+            return []
+
+        res = []
+        stack = [node]
+        while stack:
+            n = stack.pop()
+            if len(n.objects) > 0 and not (strict and n.mask == mask):
+                res.append(n)
+            for c in reversed(n.children):
+                if c is not None:
+                    stack.append(c)
+        return res
+
+    def parent(self, node):
+        "nearest node with objects above node, or None"
+        node = node.parent
+        while node is not None and len(node.objects) == 0:
+            node = node.parent
+        return node
+
+    def children(self, node):
+        "nearest nodes with objects below node"
+        res = []
+        stack = [c for c in reversed(node.children) if c is not None]
+        while stack:
+            n = stack.pop()
+            if len(n.objects) > 0:
+                res.append(n)
+                continue
+            stack.extend(c for c in reversed(n.children) if c is not None)
+        return res
+
+    def netlevel(self, node, obj_type):
+        """nesting depth of an object: 1 + the number of inetnum/inet6num
+        objects containing it, counting one on the same prefix for routes"""
+        level = 1
+        if obj_type not in self.NETS and self.__has_net(node):
+            level += 1
+        node = node.parent
+        while node is not None:
+            if self.__has_net(node):
+                level += 1
+            node = node.parent
+        return level
+
+    def __has_net(self, node):
+        for t, _ in node.objects:
+            if t in self.NETS:
+                return True
+        return False
+
+    def attrs(self, obj_type, name):
+        "derived @ attributes of an object in the tree, as the registry API returns them"
+        net = parse_net(obj_type, name)
+        node = None if net is None else self.node(*net)
+        if node is None:
+            return None
+
+        return {
+            "@family": "ipv4" if obj_type in ("inetnum", "route") else "ipv6",
+            "@netmin": "%032x" % (node.net),
+            "@netmax": "%032x" % (node.net | ((1 << (128 - node.mask)) - 1)),
+            "@netmask": "%03d" % (node.mask),
+            "@netlevel": "%03d" % (self.netlevel(node, obj_type)),
+        }
+
+
+class LocalRegistry:
+    """answers the registry API queries made by test_policy() from a local
+    copy of the registry, either the files under path or, when rev is
+    given, the tree of that git revision
+
+    inetnum and inet6num objects are kept in a NetTree, so covering nets
+    are found with one walk down the tree."""
+
+    def __init__(self, path, rev=None):
+        self.path = path
+        self.rev = rev
+        self.git = None
+        self.dirs = {}
+        self.doms = {}
+
+        if rev is not None:
+            self.git = subprocess.Popen(
+                ["git", "-C", path, "cat-file", "--batch"],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+            )
+
+        self.tree = NetTree()
+        for t in NetTree.NETS:
+            for fn in self.__list(t):
+                if self.tree.insert(t, fn.replace("_", "/")) is None:
+                    log.warning("Unable to index %s/%s" % (t, fn))
+
+        self.blocks = []
+        for fn in self.__list("as-block"):
+            try:
+                lo, hi = [int(i.strip()[2:]) for i in fn.split("-")]
+            except ValueError:
+                log.warning("Unable to index as-block/%s" % (fn))
+                continue
+            self.blocks.append((lo, hi, fn))
+        self.blocks.sort()
+
+    def __list(self, obj_type):
+        "file names of objects of a type"
+        if obj_type not in self.dirs:
+            names = set()
+            if self.rev is None:
+                d = os.path.join(self.path, obj_type)
+                if os.path.isdir(d):
+                    names = set(f for f in os.listdir(d) if f[0] != ".")
+            else:
+                ret = subprocess.run(
+                    ["git", "-C", self.path, "ls-tree", "-z", "--name-only",
+                     self.rev, "--", obj_type + "/"],
+                    stdout=subprocess.PIPE,
+                    check=False,
+                )
+                names = set(i.split("/")[-1] for i in ret.stdout.decode("utf-8").split("\0") if i)
+            self.dirs[obj_type] = names
+        return self.dirs[obj_type]
+
+    def __dom(self, obj_type, fn):
+        key = (obj_type, fn)
+        if key not in self.doms:
+            src = os.path.join(self.path, obj_type, fn)
+            if self.rev is None:
+                self.doms[key] = FileDOM(src)
+            else:
+                self.git.stdin.write(("%s:./%s/%s\n" % (self.rev, obj_type, fn)).encode("utf-8"))
+                self.git.stdin.flush()
+                header = self.git.stdout.readline().split()
+                data = self.git.stdout.read(int(header[2]) + 1)[:-1]
+                self.doms[key] = FileDOM(src, data.decode("utf-8"))
+        return self.doms[key]
+
+    def __get(self, obj_type, name):
+        fn = name.replace("/", "_")
+        if fn in self.__list(obj_type):
+            return [(self.__dom(obj_type, fn), {})]
+        return []
+
+    def __covering_nets(self, filters):
+        lo = int(filters["@netmin"].split("=", 1)[1], 16)
+        hi = int(filters["@netmax"].split("=", 1)[1], 16)
+        op, mask = filters["@netmask"].split("=", 1)
+
+        objs = []
+        for node in self.tree.covering(lo, int(mask), strict=(op == "lt")):
+            if node.net | ((1 << (128 - node.mask)) - 1) < hi:
+                continue
+            for obj_type, name in node.objects:
+                level = {"@netlevel": "%03d" % (self.tree.netlevel(node, obj_type))}
+                objs.append((self.__dom(obj_type, name.replace("/", "_")), level))
+        return objs
+
+    def __covering_blocks(self, filters):
+        lo = int(filters["@as-min"].split("=", 1)[1][2:])
+        hi = int(filters["@as-max"].split("=", 1)[1][2:])
+
+        objs = []
+        for bmin, bmax, fn in self.blocks:
+            if bmin > lo:
+                break
+            if bmax >= hi:
+                objs.append((
+                    self.__dom("as-block", fn),
+                    {"@as-min": "AS{:0>9}".format(bmin), "@as-max": "AS{:0>9}".format(bmax)},
+                ))
+        return objs
+
+    def find(self, fields=None, filters=None):
+        "same as find(), for the queries test_policy() makes"
+        if fields is None:
+            fields = []
+        if filters is None:
+            filters = {}
+
+        obj_type = filters.get("@type")
+        if "@name" in filters:
+            objs = self.__get(obj_type, filters["@name"])
+        elif obj_type == "net" and "cidr" in filters:
+            objs = self.__get("inetnum", filters["cidr"]) + self.__get("inet6num", filters["cidr"])
+        elif obj_type == "route" and ("route" in filters or "route6" in filters):
+            rt = "route" if "route" in filters else "route6"
+            objs = self.__get(rt, filters[rt])
+        elif obj_type == "net" and "@netmin" in filters:
+            objs = self.__covering_nets(filters)
+        elif obj_type == "as-block" and "@as-min" in filters:
+            objs = self.__covering_blocks(filters)
+        else:
+            raise ValueError("Unsupported local query %s" % (filters))
+
+        lis = []
+        for dom, derived in objs:
+            o = []
+            for k in fields:
+                if k in derived:
+                    o.append([k, derived[k]])
+                    continue
+                for i in dom.keys.get(k, []):
+                    o.append([k, dom.dom[i][1]])
+            lis.append(o)
+        return lis
 
 
 def to_num(ip):
@@ -526,10 +2766,12 @@ def inet6range(inet):
     )
 
 
-def test_policy(obj_type, name, mntner):
+def test_policy(obj_type, name, mntner, registry=None):
     "test policy"
     log.debug([obj_type, name, mntner])
 
+    query = find if registry is None else registry.find
+
     if obj_type in ["organisation",
                     "mntner",
                     "person",
@@ -555,7 +2797,7 @@ def test_policy(obj_type, name, mntner):
             log.error("%s does not end with '-DN42'" % (name))
             return "FAIL"
 
-        lis = find(["mnt-by"], {"@type": obj_type, "@name": name})
+        lis = query(["mnt-by"], {"@type": obj_type, "@name": name})
         log.debug(lis)
 
         if len(lis) == 0:
@@ -576,7 +2818,7 @@ def test_policy(obj_type, name, mntner):
 
     elif obj_type in ["inetnum", "inet6num"]:
         log.info("Checking inetnum type")
-        lis = find(["mnt-by"], {"@type": "net", "cidr": name})
+        lis = query(["mnt-by"], {"@type": "net", "cidr": name})
         log.debug(lis)
 
         if len(lis) > 0:
@@ -598,7 +2840,7 @@ def test_policy(obj_type, name, mntner):
         mask = "%03d" % (mask)
 
         log.info([Lnet, Hnet, mask])
-        lis = find(
+        lis = query(
             ["inetnum", "inet6num", "policy", "@netlevel", "mnt-by", "mnt-lower"],
             {
                 "@type": "net",
@@ -642,7 +2884,7 @@ def test_policy(obj_type, name, mntner):
 
     elif obj_type in ["route", "route6"]:
         log.info("Checking route type")
-        lis = find(["mnt-by"], {"@type": "route", obj_type: name})
+        lis = query(["mnt-by"], {"@type": "route", obj_type: name})
         log.debug(lis)
 
         if len(lis) > 0:
@@ -663,7 +2905,7 @@ def test_policy(obj_type, name, mntner):
         mask = "%03d" % (mask)
 
         log.info([Lnet, Hnet, mask])
-        lis = find(
+        lis = query(
             ["inetnum", "inet6num", "policy", "@netlevel", "mnt-by", "mnt-lower"],
             {
                 "@type": "net",
@@ -711,7 +2953,7 @@ def test_policy(obj_type, name, mntner):
             return "FAIL"
 
         # 1. Check if they already have an object
-        lis = find(["mnt-by"], {"@type": "aut-num", "@name": name})
+        lis = query(["mnt-by"], {"@type": "aut-num", "@name": name})
         log.debug(lis)
 
         if len(lis) > 0:
@@ -727,7 +2969,7 @@ def test_policy(obj_type, name, mntner):
 
         # 2. Check if the as-block has an open policy
         asn = "AS{:0>9}".format(name[2:])
-        lis = find(
+        lis = query(
             ["as-block", "policy", "@as-min", "@as-max", "mnt-by", "mnt-lower"],
             {"@type": "as-block", "@as-min": "le=" + asn, "@as-max": "ge=" + asn},
         )
@@ -770,7 +3012,7 @@ def test_policy(obj_type, name, mntner):
             return "FAIL"
 
         # 1. Check if they already have an object
-        lis = find(["mnt-by"], {"@type": "as-block", "@name": name})
+        lis = query(["mnt-by"], {"@type": "as-block", "@name": name})
         log.debug(lis)
 
         if len(lis) > 0:
@@ -791,7 +3033,7 @@ def test_policy(obj_type, name, mntner):
         if Lasn > Hasn:
             log.error("%s should come before %s" % (Lname, Hname))
 
-        lis = find(
+        lis = query(
             ["as-block", "policy", "@as-min", "@as-max", "mnt-by", "mnt-lower"],
             {"@type": "as-block", "@as-min": "le=" + Lasn, "@as-max": "ge=" + Hasn},
         )
@@ -831,37 +3073,1196 @@ def test_policy(obj_type, name, mntner):
     return "FAIL"
 
 
-def sanity_check(dom):
+class QueryCache:
+    """memoizes find() results for one run
+
+    Safe to share between threads: concurrent requests for the same query
+    wait for the first one instead of asking again."""
+
+    def __init__(self, func):
+        self.func = func
+        self.lock = threading.Lock()
+        self.results = {}
+
+    def find(self, fields=None, filters=None):
+        "cached find()"
+        key = (tuple(fields or ()), tuple(sorted((filters or {}).items())))
+        with self.lock:
+            fut = self.results.get(key)
+            owner = fut is None
+            if owner:
+                fut = self.results[key] = concurrent.futures.Future()
+
+        if owner:
+            try:
+                fut.set_result(self.func(fields, filters))
+            except Exception as e:  # pylint: disable=broad-except
+                fut.set_exception(e)
+
+        return fut.result()
+
+
+def policy_batch(items, registry=None, jobs=8):
+    """test policy for (type, name, mntner) items, sharing lookups between
+    them; registry is a LocalRegistry or RegistryClient, find() if None"""
+    if isinstance(registry, LocalRegistry):
+        # Local lookups are cheap and the registry is not thread safe.
+        jobs = 1
+    query = QueryCache(find if registry is None else registry.find)
+
+    def check(obj_type, name, mntner):
+        records = log.default.capture = []
+        try:
+            status = test_policy(obj_type, name, mntner, query)
+        finally:
+            log.default.capture = None
+        return status, records
+
+    ok = True
+    with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as pool:
+        futures = [pool.submit(check, *i) for i in items]
+        for (obj_type, name, mntner), fut in zip(items, futures):
+            status, records = fut.result()
+            log.default.replay(records)
+            print_policy(obj_type, name, mntner, status)
+            if status != "PASS":
+                ok = False
+    return ok
+
+
+def policy_items(lines, mntner=None):
+    "(type, name, mntner) items from 'type name [mntner]' lines"
+    items = []
+    for line in lines:
+        line = line.split()
+        if len(line) == 0 or line[0].startswith("#"):
+            continue
+        if len(line) < 3 and mntner is None:
+            log.fatal("Mntner should be provided for %s" % (" ".join(line)))
+        items.append(policy_name(line[0], line[1]) + (line[2] if len(line) > 2 else mntner,))
+    return items
+
+
+def policy_changes(path, since, mntner):
+    "(type, name, mntner) items for objects changed since commit"
+    ret = __git(path, "diff", "--name-only", "-z", "--relative", since, "--", ".")
+    if ret.returncode != 0:
+        log.fatal("git diff %s failed: %s" % (since, ret.stderr.decode("utf-8").strip()))
+
+    items = []
+    for fn in ret.stdout.decode("utf-8").split("\0"):
+        fn = fn.split("/")
+        if len(fn) == 2 and fn[1]:
+            items.append(policy_name(fn[0], fn[1]) + (mntner,))
+    return items
+
+
+def policy_name(obj_type, name):
+    "(type, name) with file names of address objects turned into prefixes"
+    if obj_type in ["inetnum", "inet6num", "route", "route6"]:
+        name = name.replace("_", "/")
+    return obj_type, name
+
+
+def print_policy(obj_type, name, mntner, status):
+    "print policy result"
+    print("POLICY %-12s\t%-8s\t%20s\t%s" % (mntner, obj_type, name, status))
+
+
+def range_text(num):
+    "address as pretty_ip() prints the expanded form of num"
+    if num >> 32 == 0xFFFF:
+        return to_ip(num & 0xFFFFFFFF)
+    h = "%032x" % (num)
+    return "%s:%s:%s:%s:%s:%s:%s:%s" % (
+        h[0:4], h[4:8], h[8:12], h[12:16], h[16:20], h[20:24], h[24:28], h[28:32])
+
+
+def __cidr_net(obj_type, cidr):
+    """(network, mask) of a cidr in the IPv4-mapped space, or None where
+    inetrange()/inet6range() would not give the same addresses"""
+    try:
+        ip, mask = cidr.split("/")
+        mask = int(mask)
+        if obj_type == "inetnum":
+            num = to_num(ip)
+            if 0 <= num < 1 << 32 and 0 <= mask <= 32:
+                return (0xFFFF << 32) | num, mask + 96
+        else:
+            ip = expand_ipv6(ip)
+            if len(ip) == 32 and 0 <= mask <= 128:
+                return int(ip, 16), mask
+    except (ValueError, TypeError, IndexError, AttributeError):
+        pass
+    return None
+
+
+def cidr_range(obj_type, cidr):
+    """"low-high" text of the range of an inetnum/inet6num cidr, as
+    inetrange()/inet6range() and pretty_ip() give it"""
+    net = __cidr_net(obj_type, cidr)
+
+    # Anything the integer path does not take fails or passes the way
+    # the string functions let it.
+    if net is None:
+        Lnet, Hnet, _ = (inetrange if obj_type == "inetnum" else inet6range)(cidr)
+        return pretty_ip(Lnet) + "-" + pretty_ip(Hnet)
+
+    host = (1 << (128 - net[1])) - 1
+    return range_text(net[0] & ~host) + "-" + range_text(net[0] | host)
+
+
+def sanity_check(dom, findings=None):
     "sanity check"
     ck = "PASS"
-    if dom.schema == "dn42.inetnum":
+    if dom.schema == "dn42.inetnum" or dom.schema == "dn42.inet6num":
+        obj_type = dom.schema[len(SCHEMA_NAMESPACE):]
         cidr = dom.get("cidr")
-        Lnet, Hnet, _ = inetrange(cidr)
-        cidr_range = pretty_ip(Lnet) + "-" + pretty_ip(Hnet)
-        file_range = dom.get("inetnum")
-        file_range = re.sub(r"\s+", "", file_range, flags=re.UNICODE)
+        if obj_type == "inet6num":
+            log.info(cidr)
+        try:
+            want = cidr_range(obj_type, cidr)
+        except (ValueError, TypeError, IndexError, AttributeError):
+            log.error("cidr [%s] does not parse" % (cidr))
+            __sanity_finding(dom, findings, "cidr", "cidr",
+                             "cidr [%s] does not parse" % (cidr))
+            return "FAIL"
 
-        if cidr_range != file_range:
+        file_range = "".join(dom.get(obj_type, default="").split())
+        if want != file_range:
             log.error(
-                "inetnum range [%s] does not match: [%s]" % (file_range, cidr_range)
+                "inetnum range [%s] does not match: [%s]" % (file_range, want)
             )
+            __range_finding(dom, findings, file_range, want)
+            return "FAIL"
+
+        # The range is the aligned block of the cidr, so a cidr naming an
+        # address inside it instead of its first one is all that is left.
+        net = __cidr_net(obj_type, cidr)
+        if net is not None and net[0] & ((1 << (128 - net[1])) - 1) != 0:
+            host = (1 << (128 - net[1])) - 1
+            message = "cidr [%s] has host bits set: [%s]" % (
+                cidr, prefix_str(net[0] & ~host, net[1]))
+            log.error(message)
+            __sanity_finding(dom, findings, "cidr", "host-bits", message)
             ck = "FAIL"
 
-    if dom.schema == "dn42.inet6num":
+    return ck
+
+
+def sanity_check_bulk(doms):
+    """sanity_check() of many objects at once, returns the check of each
+
+    The cidr and range of every inetnum/inet6num are parsed into integer
+    arrays, addresses split into high and low 64 bit halves, and
+    range/cidr agreement and host bits are tested in passes over the
+    whole arrays. A range equal to the block of its cidr is aligned.
+    Objects failing a pass, or with a range not written the way
+    sanity_check() prints it, go through sanity_check() for their
+    messages."""
+    doms = list(doms)
+    res = ["PASS"] * len(doms)
+    idx = [i for i, d in enumerate(doms)
+           if d.schema == "dn42.inetnum" or d.schema == "dn42.inet6num"]
+    v4 = [doms[i].schema == "dn42.inetnum" for i in idx]
+
+    # Parse: the cidr as (network, mask) and each end of the range.
+    nets = [__cidr_net("inetnum" if f else "inet6num", doms[i].get("cidr", default=""))
+            for i, f in zip(idx, v4)]
+    ends = [__range_halves(f, "".join(doms[i].get(
+        "inetnum" if f else "inet6num", default="").split())) for i, f in zip(idx, v4)]
+    bad = [n is None or e is None for n, e in zip(nets, ends)]
+
+    M64 = (1 << 64) - 1
+    net_hi = array.array("Q", [0 if n is None else n[0] >> 64 for n in nets])
+    net_lo = array.array("Q", [0 if n is None else n[0] & M64 for n in nets])
+    bits = [0 if n is None else 128 - n[1] for n in nets]
+    host_hi = array.array("Q", [(1 << max(0, b - 64)) - 1 for b in bits])
+    host_lo = array.array("Q", [(1 << min(64, b)) - 1 for b in bits])
+    ends = [(0, 0, 0, 0) if e is None else e for e in ends]
+    lo_hi = array.array("Q", [e[0] for e in ends])
+    lo_lo = array.array("Q", [e[1] for e in ends])
+    hi_hi = array.array("Q", [e[2] for e in ends])
+    hi_lo = array.array("Q", [e[3] for e in ends])
+
+    # Host bits: the cidr is the first address of its block.
+    host = [nh & hh | nl & hl != 0
+            for nh, nl, hh, hl in zip(net_hi, net_lo, host_hi, host_lo)]
+
+    # Agreement: the range runs from the cidr to its last address.
+    start = [a != nh or b != nl for a, b, nh, nl in zip(lo_hi, lo_lo, net_hi, net_lo)]
+    end = [a != nh | hh or b != nl | hl
+           for a, b, nh, nl, hh, hl in zip(hi_hi, hi_lo, net_hi, net_lo, host_hi, host_lo)]
+
+    for i, b, h, s, e in zip(idx, bad, host, start, end):
+        if b or h or s or e:
+            res[i] = sanity_check(doms[i])
+    return res
+
+
+def __range_halves(v4, text):
+    """(low high half, low low half, high high half, high low half) of a
+    range written as sanity_check() prints it, or None"""
+    ends = text.split("-")
+    if len(ends) != 2:
+        return None
+
+    res = []
+    for addr in ends:
+        if v4:
+            parts = addr.split(".")
+            if len(parts) != 4 or not all(
+                    p.isascii() and p.isdigit() and (p == "0" or p[0] != "0") and int(p) < 256
+                    for p in parts):
+                return None
+            res += [0, (0xFFFF << 32) | to_num(addr)]
+        else:
+            groups = addr.split(":")
+            if len(groups) != 8 or not all(len(g) == 4 for g in groups) \
+                    or addr.strip("0123456789abcdef:") != "":
+                return None
+            h = "".join(groups)
+            res += [int(h[:16], 16), int(h[16:], 16)]
+    return tuple(res)
+
+
+def fmt_fix(dom):
+    """apply the safe automatic fixes to dom, returns what was fixed
+
+    The inetnum/inet6num range is rewritten from the cidr when the two
+    do not agree."""
+    fixes = []
+    if dom.schema == "dn42.inetnum" or dom.schema == "dn42.inet6num":
+        obj_type = dom.schema[len(SCHEMA_NAMESPACE):]
         cidr = dom.get("cidr")
-        log.info(cidr)
-        Lnet, Hnet, _ = inet6range(cidr)
-        cidr_range = pretty_ip(Lnet) + "-" + pretty_ip(Hnet)
-        file_range = dom.get("inet6num")
-        file_range = re.sub(r"\s+", "", file_range, flags=re.UNICODE)
+        if cidr is not None and obj_type in dom.keys \
+                and __cidr_net(obj_type, cidr) is not None:
+            want = cidr_range(obj_type, cidr)
+            i = dom.keys[obj_type][0]
+            if "".join(dom.dom[i][1].split()) != want:
+                dom.dom[i] = (obj_type, want.replace("-", " - "), dom.dom[i][2])
+                fixes.append("range")
+    return fixes
+
+
+def _fmt_file(item):
+    "format one file, returns (fn, status, fixes, log records)"
+    fn, fix, write = item
+    capture, log.default.capture = log.default.capture, []
+    try:
+        with open(fn, mode="r", encoding="utf-8", newline="") as f:
+            text = f.read()
+        dom = FileDOM(fn, text)
+        if not dom.valid or len(dom.dom) == 0:
+            return fn, "invalid", [], log.default.capture
+        fixes = fmt_fix(dom) if fix else []
+        out = str(dom)
+        if out == text:
+            return fn, "ok", fixes, log.default.capture
+        if write:
+            _write_if_changed(fn, out)
+        return fn, "changed", fixes, log.default.capture
+    except (OSError, UnicodeDecodeError) as e:
+        log.error("%s: %s" % (fn, e))
+        return fn, "invalid", [], log.default.capture
+    finally:
+        log.default.capture = capture
+
+
+def fmt_files(path, check=False, fix=False, jobs=0):
+    """format every object of the registry at path across a worker pool
+
+    Only files whose content changes are replaced, atomically. In check
+    mode nothing is written. Returns (fn, status, fixes) of each file,
+    status being ok, changed or invalid."""
+    if jobs < 1:
+        jobs = os.cpu_count() or 1
+    files = sorted(_registry_files(path))
+    items = [(fn, fix, not check) for fn in files]
+
+    res = []
+    with _scan_pool(min(jobs, max(1, len(items)))) as pool:
+        for fn, status, fixes, records in pool.imap(
+                _fmt_file, items, max(1, len(items) // (jobs * 16))):
+            log.default.replay(records)
+            res.append((fn, status, fixes))
+    return res
+
+
+class RefGraph:
+    """reference graph of a registry
+
+    Edges run from an object to the object one of its lookup attributes
+    names, keyed by that attribute, and are indexed both ways. Objects
+    are (schema, name) keys as used by check_file()."""
+
+    ORPHAN_TYPES = ("person", "role", "mntner", "organisation")
+
+    def __init__(self):
+        self.keys = {}
+        self.out = {}
+        self.into = {}
+        self.dangling = []
+        self.names = {}
+
+    @classmethod
+    def from_registry(cls, path):
+        "parse every object of path once and link its references"
+        g = cls()
+        schemas = {}
+        refs = []
+        for fn in _registry_files(path):
+            dom = FileDOM(fn)
+            key = (dom.schema, fn.split("/")[-1].replace("_", "/"))
+            g.keys[key] = fn
+            g.names.setdefault(key[1], []).append(key)
+            if dom.schema == SCHEMA_NAMESPACE + "schema":
+                sdom = SchemaDOM(fn)
+                schemas[sdom.ref] = sdom
+            refs.append((key, dom))
+
+        # Links are resolved once every key is known.
+        for key, dom in refs:
+            s = schemas.get(key[0])
+            if s is None:
+                continue
+            for k, v, l in dom.dom:
+                if k not in s.lookups or not v:
+                    continue
+                val = v.split()[0]
+                for targets, name in s.lookups[k]:
+                    dst = next((i for i in ((ref, val) for ref in targets)
+                                if i in g.keys), None)
+                    if dst is None:
+                        g.dangling.append((key, k, val, name, l))
+                    else:
+                        g.link(key, k, dst)
+        return g
+
+    def link(self, src, attr, dst):
+        "add edge src -attr-> dst"
+        self.out.setdefault(src, []).append((attr, dst))
+        self.into.setdefault(dst, []).append((attr, src))
+
+    def find(self, name):
+        """keys matching name, given as NAME, dir/NAME, type/NAME or
+        dn42.type/NAME, so dns/NAME and domain/NAME are the same object"""
+        obj_type, sep, rest = name.partition("/")
+        if sep:
+            for schema in (XLAT.get(obj_type + "/"), SCHEMA_NAMESPACE + obj_type, obj_type):
+                if (schema, rest) in self.keys:
+                    return [(schema, rest)]
+        return self.names.get(name, [])
+
+    def orphans(self, types=ORPHAN_TYPES):
+        "objects of types that no other object refers to"
+        schemas = set(SCHEMA_NAMESPACE + t for t in types)
+        return [
+            key for key in self.keys
+            if key[0] in schemas
+            and not any(src != key for _, src in self.into.get(key, ()))
+        ]
+
+    def dependents(self, key, recursive=False):
+        "(attribute, object) pairs that refer to key, and what refers to those"
+        seen = {key}
+        found = []
+        todo = [key]
+        while todo:
+            for attr, src in self.into.get(todo.pop(), ()):
+                if src in seen:
+                    continue
+                seen.add(src)
+                found.append((attr, src))
+                if recursive:
+                    todo.append(src)
+        return found
+
+
+def graph_name(key):
+    "dir/name of a graph key as the registry files it, which find() takes back"
+    d = next((d for d, schema in XLAT.items() if schema == key[0]),
+             key[0][len(SCHEMA_NAMESPACE):] + "/")
+    return d + key[1]
+
+
+def __range_finding(dom, findings, file_range, cidr_range):
+    __sanity_finding(dom, findings, dom.schema[len(SCHEMA_NAMESPACE):], "range",
+                     "inetnum range [%s] does not match: [%s]" % (file_range, cidr_range))
+
+
+def __sanity_finding(dom, findings, key, code, message):
+    if findings is None:
+        return
+    line = dom.dom[dom.keys[key][0]][2] if key in dom.keys else 0
+    findings.append(_finding(log.VERB_ERROR, line, key, code, message))
+
+
+def match_routes(path):
+    """routes with no covering inetnum/inet6num, and routes not one level
+    below their nearest covering net
+
+    The level of an object is 1 + the number of nets containing it, as
+    @netlevel counts it. A route inside its parent is one level below it
+    unless the parent holds more specific nets inside the route: those
+    are at the route's own level, so the route spans assignments instead
+    of sitting under one. A route on exactly the prefix of its parent
+    net is the parent's own announcement and is one level below it
+    whatever the net holds.
+
+    Prefixes of both families are sorted once by (family, start, -end)
+    and swept with a stack of the nets containing the current position,
+    so each route is matched against its parents in a single pass."""
+    items = []
+    for kind, obj_type in enumerate(("inetnum", "inet6num", "route", "route6")):
+        d = os.path.join(path, obj_type)
+        if not os.path.isdir(d):
+            continue
+        for fn in os.listdir(d):
+            name = fn.replace("_", "/")
+            net = parse_net(obj_type, name)
+            if net is None or fn[0] == ".":
+                continue
+            family = 4 if obj_type in ("inetnum", "route") else 6
+            end = net[0] | ((1 << (128 - net[1])) - 1)
+            items.append((family, net[0], -end, kind >= 2, obj_type, name))
+    items.sort()
+
+    # Position of the next net at or after each item, to see whether a
+    # route contains nets more specific than its parent.
+    next_net = [None] * (len(items) + 1)
+    for i in range(len(items) - 1, -1, -1):
+        next_net[i] = next_net[i + 1] if items[i][3] else i
+
+    def obj(obj_type, name, level):
+        dom = FileDOM(os.path.join(path, obj_type, name.replace("/", "_")))
+        return {"type": obj_type, "name": name, "level": level, "mntner": dom.mntner}
+
+    findings = []
+    stack = []
+    for i, (family, start, end, is_route, obj_type, name) in enumerate(items):
+        end = -end
+        while stack and (stack[-1][0] != family or stack[-1][1] < start):
+            stack.pop()
+
+        if not is_route:
+            stack.append((family, end, obj_type, name, start))
+            continue
 
-        if cidr_range != file_range:
-            log.error(
-                "inetnum range [%s] does not match: [%s]" % (file_range, cidr_range)
-            )
-            ck = "FAIL"
+        if len(stack) > 0:
+            parent = stack[-1]
+            n = next_net[i + 1]
+            inner = n is not None and items[n][0] == family and items[n][1] <= end
+            if not inner or (parent[4], parent[1]) == (start, end):
+                continue
 
-    return ck
+        o = obj(obj_type, name, len(stack) + 1)
+        o["family"] = "ipv%d" % (family)
+        o["parent"] = None
+        if len(stack) > 0:
+            o["parent"] = obj(stack[-1][2], stack[-1][3], len(stack))
+        findings.append(o)
+
+    return findings
+
+
+def parse_range(obj_type, text):
+    """(low, high) of an inetnum/inet6num "first - last" range in the
+    IPv4-mapped IPv6 space, or None if it does not parse"""
+    try:
+        lo, hi = (i.strip() for i in text.split("-"))
+        if obj_type == "inetnum":
+            lo, hi = (0xFFFF << 32) | to_num(lo), (0xFFFF << 32) | to_num(hi)
+        else:
+            lo, hi = int(expand_ipv6(lo), 16), int(expand_ipv6(hi), 16)
+    except (ValueError, TypeError, IndexError, AttributeError):
+        return None
+
+    if not 0 <= lo <= hi < 1 << 128:
+        return None
+    return lo, hi
+
+
+def find_overlaps(path, only=None):
+    """address objects that conflict with each other
+
+    inetnum/inet6num ranges (the declared range, or the cidr if that
+    does not parse) that overlap without one containing the other, or
+    that cover the same addresses twice, and separate route/route6
+    objects for one prefix whose origins differ. Intervals are sorted by
+    (family, low, -high) and swept once with a stack of the ranges
+    containing the current one. With only, a set of paths, conflicts
+    that involve none of them are dropped."""
+    nets = []
+    routes = []
+    for obj_type in NetTree.TYPES:
+        d = os.path.join(path, obj_type)
+        if not os.path.isdir(d):
+            continue
+        family = 4 if obj_type in ("inetnum", "route") else 6
+        for fn in sorted(os.listdir(d)):
+            if fn[0] == ".":
+                continue
+            src = os.path.join(d, fn)
+            dom = FileDOM(src)
+            if obj_type in NetTree.NETS:
+                r = parse_range(obj_type, dom.get(obj_type))
+                if r is None:
+                    net = parse_net(obj_type, dom.get("cidr", default=""))
+                    if net is None:
+                        continue
+                    r = net[0], net[0] | ((1 << (128 - net[1])) - 1)
+                nets.append((family, r[0], -r[1], obj_type, src))
+            else:
+                net = parse_net(obj_type, dom.get(obj_type, default=""))
+                if net is None:
+                    continue
+                origins = tuple(sorted(set(
+                    dom.dom[i][1] for i in dom.keys.get("origin", []))))
+                routes.append((family, net[0], net[1], origins, obj_type, src))
+
+    findings = []
+
+    def report(kind, family, objs, **extra):
+        if only is not None and not any(o in only for o in objs):
+            return
+        f = {"kind": kind, "family": "ipv%d" % (family), "objects": objs}
+        f.update(extra)
+        findings.append(f)
+
+    nets.sort()
+    stack = []
+    for family, lo, hi, _, src in nets:
+        hi = -hi
+
+        # The stack holds the ranges that started before this one and are
+        # still open. Properly nested nets keep it as deep as the address
+        # hierarchy; those ending inside this range overlap it.
+        stack = [i for i in stack if i[0] == family and i[2] >= lo]
+        for _, s_lo, s_hi, s_src in stack:
+            if s_hi < hi:
+                report("overlap", family, [s_src, src])
+            elif (s_lo, s_hi) == (lo, hi):
+                report("duplicate", family, [s_src, src])
+        stack.append((family, lo, hi, src))
+
+    routes.sort()
+    i = 0
+    while i < len(routes):
+        j = i + 1
+        while j < len(routes) and routes[j][:3] == routes[i][:3]:
+            j += 1
+        if j - i > 1:
+            objs = [r[5] for r in routes[i:j]]
+            origins = sorted(set(r[3] for r in routes[i:j]))
+            report("route-conflict" if len(origins) > 1 else "route-duplicate",
+                   routes[i][0], objs, origins=[list(o) for o in origins])
+        i = j
+
+    return findings
+
+
+class RouteFilter:
+    """rules of filter.txt and filter6.txt compiled into a prefix trie
+
+    Rules are (nr, action, network, mask, minlen, maxlen, comment, src)
+    with the network and mask in the IPv4-mapped space and minlen/maxlen
+    as written. A rule matches a prefix inside its network whose length
+    is within minlen and maxlen, and the lowest numbered matching rule
+    decides. Each family has a NetTree of the rule prefixes; every
+    prefix with rules is annotated with the rules of all prefixes on its
+    path from the root in number order, so the candidates of a prefix
+    are the annotation of its longest matching rule prefix."""
+
+    FILES = (("filter.txt", "inetnum"), ("filter6.txt", "inet6num"))
+
+    def __init__(self, rules):
+        self.rules = sorted(rules)
+        self.trees = {4: NetTree(), 6: NetTree()}
+        for rule in self.rules:
+            obj_type = "inetnum" if _family(rule[2], rule[3]) == 4 else "inet6num"
+            self.trees[_family(rule[2], rule[3])].insert(obj_type, prefix_str(rule[2], rule[3]))
+
+        # Rules are sorted, so each list is in number order.
+        self.paths = {}
+        for rule in self.rules:
+            tree = self.trees[_family(rule[2], rule[3])]
+            for node in tree.covered_by(rule[2], rule[3]):
+                self.paths.setdefault((node.net, node.mask), []).append(rule)
+
+    @classmethod
+    def from_registry(cls, path):
+        "rules of filter.txt and filter6.txt under path"
+        rules = []
+        for fn, obj_type in cls.FILES:
+            src = os.path.join(path, fn)
+            if not os.path.exists(src):
+                continue
+            with open(src, mode="r", encoding="utf-8") as f:
+                for lineno, line in enumerate(f, 1):
+                    line, _, comment = line.partition("#")
+                    fields = line.split()
+                    if len(fields) == 0 or not fields[0][0].isdigit():
+                        continue
+                    net = parse_net(obj_type, fields[2]) if len(fields) == 5 else None
+                    if net is None or fields[1] not in ("permit", "deny") \
+                            or not (fields[3] + fields[4]).isdigit():
+                        log.warning("%s Line %d: Unable to parse filter rule" % (src, lineno))
+                        continue
+                    rules.append((int(fields[0]), fields[1], net[0], net[1],
+                                  int(fields[3]), int(fields[4]), comment.strip(), fn))
+        return cls(rules)
+
+    def match(self, net, mask):
+        "first rule covering the prefix and allowing its length, or None"
+        node = self.trees[_family(net, mask)].longest_prefix(net, mask)
+        if node is None:
+            return None
+        length = mask - (96 if _family(net, mask) == 4 else 0)
+        return next((r for r in self.paths[(node.net, node.mask)]
+                     if r[4] <= length <= r[5]), None)
+
+    def check(self, net, mask, max_length=None):
+        """(rule, maxlen, problem) of a route prefix and its max-length
+        text; problem is None when the route is permitted as is"""
+        rule = self.match(net, mask)
+        length = mask - (96 if _family(net, mask) == 4 else 0)
+        if rule is None:
+            return None, None, "no-rule"
+        if rule[1] != "permit":
+            return rule, None, "denied"
+
+        if max_length is None:
+            return rule, rule[5], None
+        if not max_length.isdigit():
+            return rule, rule[5], "max-length"
+        maxlen = max(length, min(int(max_length), rule[5]))
+        if maxlen != int(max_length):
+            return rule, maxlen, "max-length"
+        return rule, maxlen, None
+
+    def analyse(self):
+        """rules that can never decide a route: duplicate numbers, rules
+        whose prefix and lengths earlier rules around it always match
+        first (shadowed), and rules with no length at which some prefix
+        inside them is left to them (unreachable)"""
+        findings = []
+        seen = {}
+        for rule in self.rules:
+            fam = _family(rule[2], rule[3])
+            f = {"file": rule[7], "nr": rule[0], "action": rule[1],
+                 "prefix": prefix_str(rule[2], rule[3]), "by": []}
+
+            if (fam, rule[0]) in seen:
+                f.update(kind="duplicate", by=[seen[(fam, rule[0])][0]])
+                findings.append(f)
+                continue
+            seen[(fam, rule[0])] = rule
+
+            # Earlier rules of the family around or inside this one.
+            earlier = [r for r in self.rules if r < rule and _family(r[2], r[3]) == fam
+                       and (r[2] ^ rule[2]) >> (128 - min(r[3], rule[3])) == 0]
+            by = set()
+            for length in self.__lengths(rule):
+                taken = self.__taken(rule, earlier, length)
+                if taken is None:
+                    break
+                by.update(taken)
+            else:
+                outer = all(r[3] <= rule[3] for r in earlier if r[0] in by)
+                f.update(kind="shadowed" if outer and by else "unreachable",
+                         by=sorted(by))
+                findings.append(f)
+        return findings
+
+    @staticmethod
+    def __lengths(rule):
+        "prefix lengths, as masks, at which rule can match"
+        shift = 96 if _family(rule[2], rule[3]) == 4 else 0
+        return range(max(rule[4] + shift, rule[3]), min(rule[5] + shift, 128) + 1)
+
+    @staticmethod
+    def __taken(rule, earlier, length):
+        """numbers of the earlier rules that match every prefix of length
+        inside rule, or None if some prefix is left to rule"""
+        end = rule[2] | ((1 << (128 - rule[3])) - 1)
+        spans = []
+        for r in earlier:
+            shift = 96 if _family(r[2], r[3]) == 4 else 0
+            if r[3] <= length and r[4] + shift <= length <= r[5] + shift:
+                spans.append((max(r[2], rule[2]),
+                              min(r[2] | ((1 << (128 - r[3])) - 1), end), r[0]))
+
+        pos = rule[2]
+        taken = []
+        for lo, hi, nr in sorted(spans):
+            if lo > pos:
+                break
+            if hi >= pos:
+                taken.append(nr)
+                pos = hi + 1
+        return taken if pos > end else None
+
+
+def _family(net, mask):
+    "4 for prefixes in the IPv4-mapped range, otherwise 6"
+    return 4 if mask >= 96 and net >> 32 == 0xFFFF else 6
+
+
+def check_route_filters(path, rules=None):
+    """route/route6 objects that the filter rules deny, or whose
+    max-length is not within the permitted lengths, in one pass"""
+    if rules is None:
+        rules = RouteFilter.from_registry(path)
+
+    findings = []
+    for obj_type in ("route", "route6"):
+        d = os.path.join(path, obj_type)
+        if not os.path.isdir(d):
+            continue
+        for fn in sorted(os.listdir(d)):
+            if fn[0] == ".":
+                continue
+            dom = FileDOM(os.path.join(d, fn))
+            net = parse_net(obj_type, dom.get(obj_type, default=""))
+            if net is None:
+                findings.append({"kind": "parse", "type": obj_type, "name": fn.replace("_", "/"),
+                                 "rule": None, "max-length": None, "mntner": dom.mntner})
+                continue
+            rule, maxlen, problem = rules.check(*net, dom.get("max-length"))
+            if problem is not None:
+                findings.append({"kind": problem, "type": obj_type, "name": fn.replace("_", "/"),
+                                 "rule": None if rule is None else rule[0],
+                                 "max-length": maxlen, "mntner": dom.mntner})
+    return findings
+
+
+def prefix_str(net, mask):
+    "prefix in the IPv4-mapped space as written in configs"
+    if net >> 32 == 0xFFFF and mask >= 96:
+        return "%s/%d" % (to_ip(net & 0xFFFFFFFF), mask - 96)
+    return str(ipaddress.IPv6Network((net, mask)))
+
+
+def roa_entries(path, rules=None):
+    """sorted (family, network, mask, maxlen, asn) ROAs of the route and
+    route6 objects of path, with the mask and maxlen in the family's own
+    length, as allowed by the first matching filter rule"""
+    if rules is None:
+        rules = RouteFilter.from_registry(path)
+
+    roas = set()
+    for obj_type in ("route", "route6"):
+        d = os.path.join(path, obj_type)
+        if not os.path.isdir(d):
+            continue
+        family = 4 if obj_type == "route" else 6
+        for fn in os.listdir(d):
+            if fn[0] == ".":
+                continue
+            dom = FileDOM(os.path.join(d, fn))
+            net = parse_net(obj_type, dom.get(obj_type, default=""))
+            if net is None:
+                log.warning("%s: Unable to parse prefix" % (dom.src))
+                continue
+
+            rule, maxlen, problem = rules.check(*net, dom.get("max-length"))
+            mask = net[1] - (96 if family == 4 else 0)
+            if maxlen is None:
+                log.info("%s: Not permitted by filter rule %s"
+                         % (dom.src, "none" if rule is None else rule[0]))
+                continue
+
+            for i in dom.keys.get("origin", []):
+                asn = dom.dom[i][1]
+                if asn.upper().startswith("AS") and asn[2:].isdigit():
+                    roas.add((family, net[0], mask, maxlen, int(asn[2:])))
+    return sorted(roas)
+
+
+ROA_FORMATS = {
+    "bird1": ("dn42_roa_bird1_%d.conf", "roa %s max %d as %d;"),
+    "bird2": ("dn42_roa_bird2_%d.conf", "route %s max %d as %d;"),
+    "json": ("dn42_roa_46.json", None),
+    "frr": ("dn42_prefix_list_frr_%d.conf", None),
+}
+
+
+def roa_render(roas, fmt, family=None):
+    "text of the ROA table in fmt, for one family or both"
+    roas = [r for r in roas if family is None or r[0] == family]
+    shifts = {4: 96, 6: 0}
+    lines = []
+
+    if fmt == "json":
+        return json.dumps({
+            "metadata": {"counts": len(roas)},
+            "roas": [
+                {"prefix": prefix_str(net, mask + shifts[fam]), "maxLength": maxlen,
+                 "asn": "AS%d" % (asn)}
+                for fam, net, mask, maxlen, asn in roas
+            ],
+        }, indent=2) + "\n"
+
+    if fmt == "frr":
+        # Prefix lists do not carry the origin, keep the widest maxlen.
+        widest = {}
+        for fam, net, mask, maxlen, _ in roas:
+            key = (fam, net, mask)
+            widest[key] = max(widest.get(key, 0), maxlen)
+        for seq, ((fam, net, mask), maxlen) in enumerate(sorted(widest.items()), 1):
+            line = "%s prefix-list dn42-%d seq %d permit %s" % (
+                "ip" if fam == 4 else "ipv6", fam, seq * 5,
+                prefix_str(net, mask + shifts[fam]))
+            if maxlen > mask:
+                line += " le %d" % (maxlen)
+            lines.append(line)
+        return "".join(i + "\n" for i in lines)
+
+    line = ROA_FORMATS[fmt][1]
+    lines.append("# dn42 ROA table, %d entries" % (len(roas)))
+    for fam, net, mask, maxlen, asn in roas:
+        lines.append(line % (prefix_str(net, mask + shifts[fam]), maxlen, asn))
+    return "".join(i + "\n" for i in lines)
+
+
+def roa_inputs_digest(path):
+    "hash of the name, time and size of every file roa reads"
+    h = hashlib.sha1()
+    names = [fn for fn, _ in RouteFilter.FILES]
+    for obj_type in ("route", "route6"):
+        d = os.path.join(path, obj_type)
+        if os.path.isdir(d):
+            names.extend(os.path.join(obj_type, fn) for fn in os.listdir(d))
+    for name in sorted(names):
+        st = _file_stat(os.path.join(path, name))
+        h.update(("%s\t%s\n" % (name, st)).encode("utf-8"))
+    return h.hexdigest()
+
+
+def roa_write(path, outdir, formats, force=False):
+    """write the ROA tables of formats into outdir, returns the files
+    that changed; does nothing while the inputs are as last time"""
+    state = os.path.join(outdir, ".roa-inputs")
+    digest = roa_inputs_digest(path) + " " + ",".join(sorted(formats))
+    if not force:
+        try:
+            with open(state, mode="r", encoding="utf-8") as f:
+                if f.read() == digest:
+                    log.info("roa: inputs unchanged")
+                    return []
+        except OSError:
+            pass
+
+    roas = roa_entries(path)
+    changed = []
+    for fmt in formats:
+        name = ROA_FORMATS[fmt][0]
+        families = (4, 6) if "%d" in name else (None,)
+        for family in families:
+            fn = os.path.join(outdir, name % (family) if family else name)
+            if _write_if_changed(fn, roa_render(roas, fmt, family)):
+                changed.append(fn)
+
+    _write_if_changed(state, digest)
+    return changed
+
+
+def _set_closure(nodes, edges, base):
+    """{node: frozenset} of base[node] joined with the values of every
+    node reachable through edges, and the cycles found
+
+    Strongly connected components are found with an iterative Tarjan
+    pass; they come out with their successors first, so each component
+    is resolved once from already resolved ones and shares one value."""
+    index = {}
+    low = {}
+    stack = []
+    on_stack = set()
+    comps = []
+    counter = 0
+
+    for root in nodes:
+        if root in index:
+            continue
+        work = [(root, iter(edges.get(root, ())))]
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, it = work[-1]
+            child = next(it, None)
+            if child is not None:
+                if child not in nodes:
+                    continue
+                if child not in index:
+                    index[child] = low[child] = counter
+                    counter += 1
+                    stack.append(child)
+                    on_stack.add(child)
+                    work.append((child, iter(edges.get(child, ()))))
+                elif child in on_stack:
+                    low[node] = min(low[node], index[child])
+                continue
+
+            work.pop()
+            if work:
+                parent = work[-1][0]
+                low[parent] = min(low[parent], low[node])
+            if low[node] == index[node]:
+                comp = []
+                while True:
+                    i = stack.pop()
+                    on_stack.discard(i)
+                    comp.append(i)
+                    if i == node:
+                        break
+                comps.append(comp)
+
+    values = {}
+    cycles = []
+    for comp in comps:
+        members = set(comp)
+        if len(comp) > 1 or comp[0] in edges.get(comp[0], ()):
+            cycles.append(sorted(comp))
+        value = set()
+        for node in comp:
+            value.update(base.get(node, ()))
+            for child in edges.get(node, ()):
+                if child in values and child not in members:
+                    value.update(values[child])
+        value = frozenset(value)
+        for node in comp:
+            values[node] = value
+    return values, cycles
+
+
+def parse_set_prefix(text):
+    """(network, mask, low, high) of a route-set prefix member with an
+    optional ^-, ^+, ^n or ^n-m range operator (or a bare trailing +),
+    low and high being lengths of the prefix family, or None"""
+    op = ""
+    if "^" in text:
+        text, op = text.split("^", 1)
+    elif text.endswith("+"):
+        text, op = text[:-1], "+"
+
+    net = parse_net("inetnum" if ":" not in text else "inet6num", text)
+    if net is None:
+        return None
+    length = net[1] - (96 if _family(*net) == 4 else 0)
+    top = 32 if _family(*net) == 4 else 128
+
+    try:
+        if op == "":
+            lo = hi = length
+        elif op == "+":
+            lo, hi = length, top
+        elif op == "-":
+            lo, hi = length + 1, top
+        elif "-" in op:
+            lo, hi = (int(i) for i in op.split("-"))
+        else:
+            lo = hi = int(op)
+    except ValueError:
+        return None
+    if not length <= lo <= hi <= top:
+        return None
+    return net[0], net[1], lo, hi
+
+
+class SetExpander:
+    """as-set and route-set resolution for a registry
+
+    Members of as-sets are ASNs and other as-sets, members of route-sets
+    are prefixes, route-sets, as-sets and ASNs (the routes they
+    originate). aut-num and route objects join sets through member-of
+    when the set lists one of their maintainers, or ANY, in mbrs-by-ref.
+    Every set is resolved in one memoized pass over the whole registry
+    when the expander is built."""
+
+    def __init__(self, path):
+        self.sets = {}
+        self.missing = {}
+        self.origins = {}
+        self.max_length = {}
+        self.asns = {}
+        self.prefixes = {}
+        self.cycles = []
+
+        asn_edges = {}
+        asn_base = {}
+        route_edges = {}
+        route_base = {}
+        by_ref = {}
+        joins = []
+
+        def read(obj_type):
+            d = os.path.join(path, obj_type)
+            if not os.path.isdir(d):
+                return
+            for fn in sorted(os.listdir(d)):
+                if fn[0] != ".":
+                    yield FileDOM(os.path.join(d, fn))
+
+        for obj_type in ("as-set", "route-set"):
+            for dom in read(obj_type):
+                name = dom.get(obj_type, default="").upper()
+                if not name:
+                    continue
+                self.sets[name] = obj_type
+                asn_base[name] = set()
+                route_base[name] = set()
+                refs = set()
+                for k, v, _ in dom.dom:
+                    if k == "mbrs-by-ref":
+                        refs.update(i.upper() for i in v.replace(",", " ").split())
+                    if k not in ("members", "mp-members"):
+                        continue
+                    for m in v.replace(",", " ").split():
+                        self.__member(name, obj_type, m, asn_base, asn_edges,
+                                      route_base, route_edges)
+                by_ref[name] = refs
+
+        for dom in read("aut-num"):
+            joins.append(("aut-num", dom.get("aut-num", default=""), dom))
+        for obj_type in ("route", "route6"):
+            for dom in read(obj_type):
+                net = parse_net(obj_type, dom.get(obj_type, default=""))
+                if net is None:
+                    continue
+                length = net[1] - (96 if obj_type == "route" else 0)
+                ml = dom.get("max-length", default="")
+                if ml.isdigit() and int(ml) > length:
+                    self.max_length[net] = max(int(ml), self.max_length.get(net, 0))
+                entry = (net[0], net[1], length, length)
+                for i in dom.keys.get("origin", []):
+                    self.origins.setdefault(dom.dom[i][1].upper(), set()).add(entry)
+                joins.append((obj_type, entry, dom))
+
+        # member-of only counts where the set accepts the maintainer.
+        for obj_type, member, dom in joins:
+            for i in dom.keys.get("member-of", []):
+                for name in dom.dom[i][1].replace(",", " ").split():
+                    name = name.upper()
+                    refs = by_ref.get(name, ())
+                    if "ANY" not in refs and not any(m.upper() in refs for m in dom.mntner):
+                        continue
+                    if obj_type == "aut-num" and self.sets[name] == "as-set":
+                        asn_base[name].add(member.upper())
+                    elif obj_type != "aut-num" and self.sets[name] == "route-set":
+                        route_base[name].add(member)
+
+        nodes = set(self.sets)
+        for edges in (asn_edges, route_edges):
+            for name, refs in edges.items():
+                self.missing.setdefault(name, []).extend(i for i in refs if i not in nodes)
+        self.asns, cycles = _set_closure(nodes, asn_edges, asn_base)
+        self.cycles.extend(cycles)
+
+        # ASNs and as-sets named by route-sets stand for their routes.
+        for name in nodes:
+            for asn in self.asns[name] if self.sets[name] == "route-set" else ():
+                route_base[name].update(self.origins.get(asn, ()))
+        self.prefixes, cycles = _set_closure(nodes, route_edges, route_base)
+        self.cycles.extend(cycles)
+
+        for cycle in self.cycles:
+            log.warning("expand: reference cycle %s" % (" -> ".join(cycle)))
+
+    def __member(self, name, obj_type, m, asn_base, asn_edges, route_base, route_edges):
+        m = m.upper()
+        if m.startswith("AS") and m[2:].isdigit():
+            asn_base[name].add(m)
+        elif "/" in m:
+            prefix = parse_set_prefix(m.lower())
+            if prefix is None or obj_type != "route-set":
+                self.missing.setdefault(name, []).append(m)
+            else:
+                route_base[name].add(prefix)
+        else:
+            # Range operators on sets are not applied, the set is included.
+            ref = m.split("^", 1)[0]
+            edges = asn_edges if ref.split(":")[-1].startswith("AS-") else route_edges
+            edges.setdefault(name, []).append(ref)
+
+    def find(self, name):
+        "canonical name of a set, or None"
+        name = name.upper()
+        return name if name in self.sets else None
+
+    def routes(self, name, family=None):
+        "sorted (network, mask, low, high) prefixes of a set"
+        if self.sets[name] == "route-set":
+            res = self.prefixes[name]
+        else:
+            res = set()
+            for asn in self.asns[name]:
+                res.update(self.origins.get(asn, ()))
+        return sorted(i for i in res if family is None or _family(i[0], i[1]) == family)
+
+
+def expand_name(name, family):
+    "identifier for the prefix list of a set in BIRD and FRR"
+    return "%s_V%d" % (re.sub(r"[^A-Z0-9]", "_", name.upper()), family)
+
+
+def expand_render(expander, name, fmt, max_length=False):
+    """prefix lists of a set in the given format, with max_length also
+    allowing the more specifics route objects permit"""
+    def text(prefix):
+        net, mask, lo, hi = prefix
+        length = mask - (96 if _family(net, mask) == 4 else 0)
+        if max_length and lo == hi == length:
+            hi = max(hi, expander.max_length.get((net, mask), hi))
+        return prefix_str(net, mask), length, lo, hi
+
+    if fmt == "json":
+        return json.dumps({
+            "name": name,
+            "type": expander.sets[name],
+            "asns": sorted(expander.asns[name], key=lambda a: int(a[2:])),
+            "prefixes": [
+                {"prefix": p, "low": lo, "high": hi}
+                for p, _, lo, hi in (text(i) for i in expander.routes(name))
+            ],
+            "missing": expander.missing.get(name, []),
+        }, sort_keys=True) + "\n"
+
+    if fmt == "asns":
+        return "".join("%s\n" % (a) for a in
+                       sorted(expander.asns[name], key=lambda a: int(a[2:])))
+
+    out = []
+    for family in (4, 6):
+        ident = expand_name(name, family)
+        prefixes = [text(i) for i in expander.routes(name, family)]
+        if fmt == "bird":
+            if len(prefixes) == 0:
+                out.append("# %s is empty" % (ident))
+                continue
+            out.append("%s = [" % (ident))
+            items = [p if lo == hi == length else "%s{%d,%d}" % (p, lo, hi)
+                     for p, length, lo, hi in prefixes]
+            out.append(",\n".join("    " + i for i in items))
+            out.append("];")
+        else:
+            ip = "ip" if family == 4 else "ipv6"
+            out.append("no %s prefix-list %s" % (ip, ident))
+            if len(prefixes) == 0:
+                out.append("! generated prefix-list %s is empty" % (ident))
+                out.append("%s prefix-list %s deny %s" % (
+                    ip, ident, "0.0.0.0/0" if family == 4 else "::/0"))
+                continue
+            for seq, (p, length, lo, hi) in enumerate(prefixes, 1):
+                line = "%s prefix-list %s seq %d permit %s" % (ip, ident, seq * 5, p)
+                if lo > length:
+                    line += " ge %d" % (lo)
+                if hi > length:
+                    line += " le %d" % (hi)
+                out.append(line)
+    return "".join(i + "\n" for i in out)
 
 
 def get_args():
@@ -887,6 +4288,11 @@ def get_args():
         help="Enable full verbose output [Default OFF]",
         action="store_true",
     )
+    parser.add_argument(
+        "--log-dir",
+        help="Also write debug output to a daily log file in dir [Default OFF]",
+        type=str,
+    )
 
     subparsers = parser.add_subparsers(help="sub-command help", dest="command")
 
@@ -905,6 +4311,9 @@ def get_args():
 
     parser_index = subparsers.add_parser("index", help="Generate index")
     parser_index.add_argument("path", nargs="?", help="Path for dn42 data", type=str)
+    parser_index.add_argument(
+        "-o", "--output", help="Write index to file [Default stdout]", type=str
+    )
 
     parser_scanindex = subparsers.add_parser(
         "scan-index", help="Validate files in index"
@@ -919,6 +4328,13 @@ def get_args():
         help="Only scan files that has MNT [Default None]",
         action="store",
     )
+    parser_scanindex.add_argument(
+        "--format",
+        help="Result format, jsonl prints one JSON record per object and a "
+        "summary [Default text]",
+        choices=["text", "jsonl"],
+        default="text",
+    )
 
     parser_scan = subparsers.add_parser("scan", help="Validate files in index")
     parser_scan.add_argument("path", nargs="?", help="Path for dn42 data", type=str)
@@ -936,6 +4352,217 @@ def get_args():
         help="Only scan file given [Default None]",
         action="store",
     )
+    parser_scan.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes, 0 for one per CPU [Default 1]",
+        type=int,
+        default=1,
+        action="store",
+    )
+    parser_scan.add_argument(
+        "--since",
+        nargs="?",
+        help="Only scan objects changed since commit and objects that "
+        "reference removed ones [Default None]",
+        action="store",
+    )
+    parser_scan.add_argument(
+        "--cache",
+        nargs="?",
+        help="Reuse results for unchanged objects from cache file [Default None]",
+        action="store",
+    )
+    parser_scan.add_argument(
+        "--mnt-index",
+        nargs="?",
+        help="Keep object types and mnt-by values in index file so that -m "
+        "only opens matching objects [Default None]",
+        action="store",
+    )
+    parser_scan.add_argument(
+        "--format",
+        help="Result format, jsonl prints one JSON record per object and a "
+        "summary [Default text]",
+        choices=["text", "jsonl"],
+        default="text",
+    )
+    parser_scan.add_argument(
+        "--profile",
+        help="Time each scan phase and object type and list the slowest "
+        "objects [Default OFF]",
+        action="store_true",
+    )
+    parser_scan.add_argument(
+        "--profile-top",
+        help="Number of slowest objects to list [Default 10]",
+        type=int,
+        default=10,
+        action="store",
+    )
+
+    parser_scan.add_argument(
+        "--socket",
+        nargs="?",
+        help="Ask the serve daemon on this socket first, scan locally if it "
+        "is not running [Default None]",
+        action="store",
+    )
+
+    parser_serve = subparsers.add_parser(
+        "serve", help="Keep the registry in memory and answer scans on a socket"
+    )
+    parser_serve.add_argument(
+        "path", nargs="?", help="Path for dn42 data [Default data/]", type=str,
+        default="data/",
+    )
+    parser_serve.add_argument(
+        "--socket",
+        help="Unix socket to listen on [Default .cache/dn42-schema.sock]",
+        default=".cache/dn42-schema.sock",
+        action="store",
+    )
+
+    parser_whois = subparsers.add_parser(
+        "whois-serve", help="Answer whois queries from the registry held in memory"
+    )
+    parser_whois.add_argument(
+        "path", nargs="?", help="Path for dn42 data [Default data/]", type=str,
+        default="data/",
+    )
+    parser_whois.add_argument(
+        "--host", help="Address to listen on [Default 127.0.0.1]", default="127.0.0.1",
+    )
+    parser_whois.add_argument(
+        "--port", help="TCP port to listen on [Default 43]", type=int, default=43,
+    )
+
+    parser_graph = subparsers.add_parser(
+        "graph", help="Report dangling references, orphans and dependents"
+    )
+    parser_graph.add_argument(
+        "path", nargs="?", help="Path for dn42 data [Default data/]", type=str,
+        default="data/",
+    )
+    parser_graph.add_argument(
+        "--dangling", help="List references to missing objects", action="store_true"
+    )
+    parser_graph.add_argument(
+        "--orphans",
+        help="List persons, roles, mntners and organisations nothing refers to",
+        action="store_true",
+    )
+    parser_graph.add_argument(
+        "-d",
+        "--depends",
+        help="List objects that refer to NAME, dir/NAME (dns/NAME) or type/NAME "
+        "(domain/NAME) to be exact",
+        action="append",
+    )
+    parser_graph.add_argument(
+        "-r", "--recursive", help="Follow --depends transitively", action="store_true"
+    )
+    parser_graph.add_argument(
+        "--format",
+        help="Output format [Default text]",
+        choices=["text", "jsonl"],
+        default="text",
+    )
+
+    parser_overlaps = subparsers.add_parser(
+        "overlaps", help="Find overlapping nets and conflicting routes"
+    )
+    parser_overlaps.add_argument(
+        "path", nargs="?", help="Path for dn42 data [Default data/]", type=str,
+        default="data/",
+    )
+    parser_overlaps.add_argument(
+        "--since",
+        nargs="?",
+        help="Only report conflicts with objects changed since commit [Default None]",
+        action="store",
+    )
+    parser_overlaps.add_argument(
+        "--format",
+        help="Output format [Default text]",
+        choices=["text", "jsonl"],
+        default="text",
+    )
+
+    parser_filters = subparsers.add_parser(
+        "filter-check",
+        help="Check filter rules and route objects against filter.txt/filter6.txt",
+    )
+    parser_filters.add_argument(
+        "path", nargs="?", help="Path for dn42 data [Default data/]", type=str,
+        default="data/",
+    )
+    parser_filters.add_argument(
+        "--rules-only",
+        help="Only report shadowed and unreachable rules",
+        action="store_true",
+    )
+    parser_filters.add_argument(
+        "--format",
+        help="Output format [Default text]",
+        choices=["text", "jsonl"],
+        default="text",
+    )
+
+    parser_expand = subparsers.add_parser(
+        "expand", help="Expand as-sets and route-sets into prefix lists"
+    )
+    parser_expand.add_argument(
+        "name", nargs="*", help="as-set, route-set or ASN to expand", type=str
+    )
+    parser_expand.add_argument(
+        "-p", "--path", help="Path for dn42 data [Default data/]", type=str,
+        default="data/",
+    )
+    parser_expand.add_argument(
+        "--all", help="Expand every as-set and route-set", action="store_true",
+    )
+    parser_expand.add_argument(
+        "-f",
+        "--format",
+        help="Output format [Default bird]",
+        choices=["bird", "frr", "json", "asns"],
+        default="bird",
+    )
+    parser_expand.add_argument(
+        "-m",
+        "--max-length",
+        help="Allow more specifics of routes up to their max-length",
+        action="store_true",
+    )
+
+    parser_roa = subparsers.add_parser(
+        "roa", help="Generate ROA tables and prefix lists from route objects"
+    )
+    parser_roa.add_argument(
+        "path", nargs="?", help="Path for dn42 data [Default data/]", type=str,
+        default="data/",
+    )
+    parser_roa.add_argument(
+        "-f",
+        "--format",
+        help="Table format, repeat for more than one [Default all with -o, "
+        "bird2 otherwise]",
+        choices=sorted(ROA_FORMATS),
+        action="append",
+    )
+    parser_roa.add_argument(
+        "-o",
+        "--output-dir",
+        help="Write tables into dir, only rewriting files that change "
+        "[Default print to stdout]",
+        action="store",
+    )
+    parser_roa.add_argument(
+        "--force",
+        help="Regenerate even if no route or filter file changed",
+        action="store_true",
+    )
 
     parser_fmt = subparsers.add_parser("fmt", help="Format file")
     parser_fmt.add_argument(
@@ -944,23 +4571,151 @@ def get_args():
     parser_fmt.add_argument(
         "-i", "--in-place", help="Format file in place", action="store_true"
     )
+    parser_fmt.add_argument(
+        "--all",
+        help="Format every object of the registry in infile [Default data/]",
+        action="store_true",
+    )
+    parser_fmt.add_argument(
+        "--check",
+        help="With --all, only list files that are not formatted",
+        action="store_true",
+    )
+    parser_fmt.add_argument(
+        "--fix",
+        help="With --all, also rewrite inetnum/inet6num ranges from the cidr",
+        action="store_true",
+    )
+    parser_fmt.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of worker processes, 0 for one per CPU [Default 0]",
+        type=int,
+        default=0,
+        action="store",
+    )
 
     parser_sane = subparsers.add_parser(
         "sanity-check", help="Check the file for sane-ness"
     )
     parser_sane.add_argument(
-        "infile", nargs="?", help="Path for dn42 data file", type=str
+        "infile", nargs="+",
+        help="Path for dn42 data files, a registry or a type directory such as "
+        "data/inetnum is checked in bulk", type=str
     )
 
     parser_pol = subparsers.add_parser("policy", help="Format file")
     parser_pol.add_argument("type", nargs="?", type=str, help="dn42 object type")
     parser_pol.add_argument("name", nargs="?", type=str, help="dn42 object name")
     parser_pol.add_argument("mntner", nargs="?", type=str, help="dn42 object mntner")
+    parser_pol.add_argument(
+        "-l",
+        "--local",
+        nargs="?",
+        help="Check against the registry at this path instead of the remote "
+        "API [Default None]",
+        action="store",
+    )
+    parser_pol.add_argument(
+        "-r",
+        "--rev",
+        nargs="?",
+        help="Use the local registry as of this git revision [Default working tree]",
+        action="store",
+    )
+    parser_pol.add_argument(
+        "--server",
+        help="Registry API server, host[:port] or URL [Default %s]" % (REGISTRY_SERVER),
+        default=REGISTRY_SERVER,
+        action="store",
+    )
+
+    parser_polb = subparsers.add_parser(
+        "policy-batch",
+        help="Check policy for many objects, read as 'type name [mntner]' "
+        "lines from stdin or from a git diff",
+    )
+    parser_polb.add_argument(
+        "path", nargs="?", help="Path for dn42 data", type=str, default="data/"
+    )
+    parser_polb.add_argument(
+        "--since",
+        nargs="?",
+        help="Check objects changed since commit instead of reading stdin [Default None]",
+        action="store",
+    )
+    parser_polb.add_argument(
+        "-m",
+        "--use-mntner",
+        nargs="?",
+        help="Mntner for objects changed since commit or lines without one "
+        "[Default None]",
+        action="store",
+    )
+    parser_polb.add_argument(
+        "-l",
+        "--local",
+        nargs="?",
+        help="Check against the registry at this path instead of the remote "
+        "API [Default None]",
+        action="store",
+    )
+    parser_polb.add_argument(
+        "-r",
+        "--rev",
+        nargs="?",
+        help="Use the local registry as of this git revision [Default working tree]",
+        action="store",
+    )
+    parser_polb.add_argument(
+        "-j",
+        "--jobs",
+        help="Number of concurrent remote lookups [Default 8]",
+        type=int,
+        default=8,
+        action="store",
+    )
+    parser_polb.add_argument(
+        "--server",
+        help="Registry API server, host[:port] or URL [Default %s]" % (REGISTRY_SERVER),
+        default=REGISTRY_SERVER,
+        action="store",
+    )
+
+    parser_stub = subparsers.add_parser(
+        "registry-stub",
+        help="Serve the registry API queries policy makes from a local registry",
+    )
+    parser_stub.add_argument(
+        "path", nargs="?", help="Path for dn42 data [Default data/]", type=str,
+        default="data/",
+    )
+    parser_stub.add_argument(
+        "--host", help="Address to listen on [Default 127.0.0.1]", default="127.0.0.1",
+    )
+    parser_stub.add_argument(
+        "--port", help="TCP port to listen on [Default 8043]", type=int, default=8043,
+    )
+    parser_stub.add_argument(
+        "-r",
+        "--rev",
+        nargs="?",
+        help="Serve the registry as of this git revision [Default working tree]",
+        action="store",
+    )
 
     parser_mroute = subparsers.add_parser(
         "match-routes", help="Match routes to inetnums"
     )
-    _ = parser_mroute
+    parser_mroute.add_argument(
+        "path", nargs="?", help="Path for dn42 data", type=str, default="data/"
+    )
+    parser_mroute.add_argument(
+        "--format",
+        help="Output format [Default text]",
+        choices=["text", "jsonl"],
+        default="text",
+    )
 
     return vars(parser.parse_args())
 
@@ -977,6 +4732,9 @@ def run(args):
     if args["verbose"]:
         log.default.level_console = log.VERB_INFO
 
+    if args["log_dir"] is not None:
+        log.default.set_file(args["log_dir"], background=True)
+
     log.debug(args)
 
     valid = True
@@ -991,17 +4749,55 @@ def run(args):
         valid = check_schemas(args["path"])
 
     elif args["command"] == "index":
-        index_files(args["path"])
+        index_files(args["path"], args["output"])
 
     elif args["command"] == "scan-index":
-        scan_index(args["infile"], args["use_mntner"])
+        scan_index(args["infile"], args["use_mntner"], args["format"])
 
     elif args["command"] == "scan":
         log.notice(
             "## Scan Started at %s"
             % (time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()))
         )
-        ck = scan_files(args["path"], args["use_mntner"], args["use_file"])
+        resp = None
+        profile = None
+        if args["profile"]:
+            profile = ScanProfile(args["profile_top"])
+
+        if args["socket"] is not None and profile is None and args["since"] is None:
+            resp = serve_request(args["socket"], {
+                "command": "scan",
+                "path": os.path.abspath(args["path"]),
+                "mntner": args["use_mntner"],
+                "file": os.path.abspath(args["use_file"]) if args["use_file"] else None,
+                "format": args["format"],
+            })
+            if resp is not None and "error" in resp:
+                log.info("serve: %s, scanning locally" % (resp["error"]))
+                resp = None
+
+        if resp is not None:
+            log.default.replay([tuple(i) for i in resp["records"]])
+            sys.stdout.write(resp["out"])
+            ck = resp["status"]
+        elif args["since"] is not None:
+            ck = scan_changes(
+                args["path"], args["since"], args["use_mntner"], args["jobs"],
+                args["format"], args["mnt_index"], profile,
+            )
+        else:
+            ck = scan_files(
+                args["path"],
+                args["use_mntner"],
+                args["use_file"],
+                args["jobs"],
+                args["cache"],
+                args["mnt_index"],
+                args["format"],
+                profile,
+            )
+        if profile is not None:
+            profile.report(args["format"])
         log.notice(
             "## Scan Completed at %s"
             % (time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()))
@@ -1012,6 +4808,162 @@ def run(args):
         elif ck == "FAIL":
             sys.exit(1)
 
+    elif args["command"] == "graph":
+        g = RefGraph.from_registry(args["path"])
+        log.info("graph: %d objects, %d links"
+                 % (len(g.keys), sum(len(i) for i in g.out.values())))
+
+        ok = True
+        jsonl = args["format"] == "jsonl"
+        everything = not (args["dangling"] or args["orphans"] or args["depends"])
+        if args["dangling"] or everything:
+            for key, attr, val, refs, line in g.dangling:
+                if jsonl:
+                    print(json.dumps({"type": "dangling", "object": graph_name(key),
+                                      "path": g.keys[key], "line": line, "key": attr,
+                                      "value": val, "lookup": refs}))
+                else:
+                    print("DANGLING\t%-40s\t%s\t%s\t%s"
+                          % (graph_name(key), attr, val, refs))
+            if len(g.dangling) > 0:
+                ok = False
+
+        if args["orphans"] or everything:
+            for key in g.orphans():
+                if jsonl:
+                    print(json.dumps({"type": "orphan", "object": graph_name(key),
+                                      "path": g.keys[key]}))
+                else:
+                    print("ORPHAN\t%s" % (graph_name(key)))
+
+        for name in args["depends"] or []:
+            keys = g.find(name)
+            if len(keys) == 0:
+                log.error("graph: %s not found" % (name))
+                ok = False
+            for key in keys:
+                for attr, src in g.dependents(key, args["recursive"]):
+                    if jsonl:
+                        print(json.dumps({"type": "depends", "object": graph_name(key),
+                                          "key": attr, "from": graph_name(src),
+                                          "path": g.keys[src]}))
+                    else:
+                        print("DEPENDS\t%-40s\t%-12s\t%s"
+                              % (graph_name(key), attr, graph_name(src)))
+        if not ok:
+            sys.exit(1)
+
+    elif args["command"] == "overlaps":
+        only = None
+        if args["since"] is not None:
+            only = set(__git_changes(args["path"], args["since"])[0])
+        findings = find_overlaps(args["path"], only)
+
+        counts = {}
+        for i in findings:
+            counts[i["family"]] = counts.get(i["family"], 0) + 1
+            if args["format"] == "jsonl":
+                print(json.dumps(i, sort_keys=True))
+            else:
+                print("%-15s\t%s\t%s%s" % (
+                    i["kind"].upper(), i["family"], "\t".join(i["objects"]),
+                    "\tORIGINS: %s" % (" | ".join(",".join(o) for o in i["origins"]))
+                    if "origins" in i else ""))
+        for family in ("ipv4", "ipv6"):
+            log.notice("overlaps: %d %s conflicts" % (counts.get(family, 0), family))
+        if len(findings) > 0:
+            sys.exit(1)
+
+    elif args["command"] == "filter-check":
+        rules = RouteFilter.from_registry(args["path"])
+        findings = rules.analyse()
+        for i in findings:
+            if args["format"] == "jsonl":
+                print(json.dumps(dict(i, object="rule"), sort_keys=True))
+            else:
+                print("%-11s\t%s\t%04d\t%s\t%s\tBY: %s" % (
+                    i["kind"].upper(), i["file"], i["nr"], i["action"], i["prefix"],
+                    ",".join("%04d" % (n) for n in i["by"])))
+
+        routes = [] if args["rules_only"] else check_route_filters(args["path"], rules)
+        for i in routes:
+            if args["format"] == "jsonl":
+                print(json.dumps(dict(i, object="route"), sort_keys=True))
+            else:
+                print("%-11s\t%s\t%s\tRULE: %s\tMAX: %s\t%s" % (
+                    i["kind"].upper(), i["type"], i["name"],
+                    "none" if i["rule"] is None else "%04d" % (i["rule"]),
+                    i["max-length"], ",".join(i["mntner"])))
+
+        log.notice("filter-check: %d rules, %d rule findings, %d route findings"
+                   % (len(rules.rules), len(findings), len(routes)))
+        if len(findings) + len(routes) > 0:
+            sys.exit(1)
+
+    elif args["command"] == "expand":
+        expander = SetExpander(args["path"])
+        names = sorted(expander.sets) if args["all"] else []
+        ok = True
+        for name in args["name"]:
+            found = expander.find(name)
+            if found is None and name.upper().startswith("AS") and name[2:].isdigit():
+                # A bare ASN expands to the routes it originates.
+                found = name.upper()
+                expander.sets[found] = "as-set"
+                expander.asns[found] = frozenset([found])
+            if found is None:
+                log.error("expand: %s not found" % (name))
+                ok = False
+                continue
+            names.append(found)
+        for name in names:
+            for m in expander.missing.get(name, []):
+                log.warning("expand: %s: unknown member %s" % (name, m))
+            sys.stdout.write(expand_render(expander, name, args["format"], args["max_length"]))
+        if not ok:
+            sys.exit(1)
+
+    elif args["command"] == "roa":
+        if args["output_dir"] is not None:
+            for fn in roa_write(args["path"], args["output_dir"],
+                                args["format"] or sorted(ROA_FORMATS), args["force"]):
+                log.notice("roa: wrote %s" % (fn))
+        else:
+            roas = roa_entries(args["path"])
+            for fmt in args["format"] or ["bird2"]:
+                sys.stdout.write(roa_render(roas, fmt))
+
+    elif args["command"] == "serve":
+        serve(args["path"], args["socket"])
+
+    elif args["command"] == "registry-stub":
+        server = registry_stub(args["path"], args["host"], args["port"], args["rev"])
+        log.notice("registry-stub: listening on %s:%d" % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    elif args["command"] == "whois-serve":
+        whois_serve(args["path"], args["host"], args["port"])
+
+    elif args["command"] == "fmt" and args["all"]:
+        res = fmt_files(args["infile"] or "data/", args["check"], args["fix"], args["jobs"])
+        counts = {"ok": 0, "changed": 0, "invalid": 0}
+        for fn, status, fixes in res:
+            counts[status] += 1
+            if status != "ok":
+                print("%-7s\t%s%s" % (
+                    status.upper() if status == "invalid" or not args["check"] else "UNFMT",
+                    fn, "\tFIX: %s" % (",".join(fixes)) if fixes else ""))
+        log.notice("fmt: %d files, %d %s, %d invalid" % (
+            len(res), counts["changed"], "not formatted" if args["check"] else "rewritten",
+            counts["invalid"]))
+        if counts["invalid"] > 0 or (args["check"] and counts["changed"] > 0):
+            sys.exit(1)
+
     elif args["command"] == "fmt":
         dom = FileDOM(args["infile"])
         if args["in_place"]:
@@ -1031,114 +4983,68 @@ def run(args):
         if args["mntner"] is None:
             log.fatal("Mntner should be provided")
 
-        if args["type"] in ["inetnum", "inet6num", "route", "route6"]:
-            args["name"] = args["name"].replace("_", "/")
+        args["type"], args["name"] = policy_name(args["type"], args["name"])
 
-        status = test_policy(args["type"], args["name"], args["mntner"])
+        registry = RegistryClient(args["server"])
+        if args["local"] is not None:
+            registry = LocalRegistry(args["local"], args["rev"])
 
-        print(
-            "POLICY %-12s\t%-8s\t%20s\t%s"
-            % (args["mntner"], args["type"], args["name"], status)
-        )
-        if status != "PASS":
-            sys.exit(1)
+        status = test_policy(args["type"], args["name"], args["mntner"], registry)
 
-    elif args["command"] == "sanity-check":
-        dom = FileDOM(args["infile"])
-        ck = sanity_check(dom)
-        print("SANITY %-8s\t%20s\t%s" % (dom.schema.split(".")[1], args["infile"], ck))
-        if ck != "PASS":
+        print_policy(args["type"], args["name"], args["mntner"], status)
+        if status != "PASS":
             sys.exit(1)
 
-    elif args["command"] == "match-routes":
-        lis = find(
-            ["mnt-by", "cidr", "route", "@netlevel", "@netmin", "@netmax", "@uri"],
-            {"@family": "ipv4"},
-        )
-
-        def field(x, field):
-            for i in x:
-                if i[0] == field:
-                    return i[1]
-            return None
-
-        def lvl(x):
-            for i in x:
-                if i[0] == "@netlevel":
-                    return i[1]
-
-        def net(x):
-            for i in x:
-                if i[0] == "@netmin":
-                    return i[1]
+    elif args["command"] == "policy-batch":
+        if args["since"] is not None:
+            if args["use_mntner"] is None:
+                log.fatal("Mntner should be provided with --since")
+            items = policy_changes(args["path"], args["since"], args["use_mntner"])
+        else:
+            items = policy_items(sys.stdin, args["use_mntner"])
 
-        def is_net(x):
-            i = field(x, "cidr")
-            if i is not None:
-                return True
-            return False
+        registry = RegistryClient(args["server"])
+        if args["local"] is not None:
+            registry = LocalRegistry(args["local"], args["rev"])
 
-        def obj(x):
-            d = {}
-            for k, v in x:
-                if k in d:
-                    d[k].append(v)
-                else:
-                    d[k] = [v]
-            return d
-
-        inet = None
-        first = True
-        for n in sorted(sorted(lis, key=lvl), key=net):
-            o = obj(n)
-
-            if is_net(n):
-                if not first:
-                    print()
-                first = True
-                inet = o
-                continue
+        if not policy_batch(items, registry, args["jobs"]):
+            sys.exit(1)
 
-            ilvl = int(inet["@netlevel"][0])
-            rlvl = int(o["@netlevel"][0])
-
-            if ilvl + 1 != rlvl:
-                print(
-                    "\nNo Parent > ",
-                    o["route"][0],
-                    " ",
-                    rlvl,
-                    " ",
-                    ",".join(o["mnt-by"]),
-                    "Nearest INET ",
-                    inet["cidr"][0],
-                    " ",
-                    ilvl,
-                    " ",
-                    ",".join(inet["mnt-by"]),
-                )
+    elif args["command"] == "sanity-check":
+        files = []
+        for i in args["infile"]:
+            files.extend(_object_files(i) if os.path.isdir(i) else [i])
+        doms = [FileDOM(fn) for fn in files]
+        ok = True
+        for fn, dom, ck in zip(files, doms, sanity_check_bulk(doms)):
+            print("SANITY %-8s\t%20s\t%s" % (dom.schema.split(".")[1], fn, ck))
+            ok = ok and ck == "PASS"
+        if not ok:
+            sys.exit(1)
 
-                first = True
+    elif args["command"] == "match-routes":
+        findings = match_routes(args["path"])
+        for i in findings:
+            if args["format"] == "jsonl":
+                print(json.dumps(i, sort_keys=True))
                 continue
 
-            if inet["@netmin"][0] > o["@netmin"][0] or inet["@netmax"][0] < o["@netmax"][0]:
-                print(
-                    "\nNo Parent > ",
-                    o["route"][0],
-                    " ",
-                    rlvl,
-                    " ",
-                    ",".join(o["mnt-by"]),
-                    "Nearest INET ",
-                    inet["cidr"][0],
-                    " ",
-                    ilvl,
-                    " ",
-                    ",".join(inet["mnt-by"]),
+            parent = i["parent"]
+            print(
+                "%-9s\t%-6s\t%-43s\t%3d\t%s\tPARENT: %s"
+                % (
+                    "NOPARENT" if parent is None else "LEVEL",
+                    i["type"],
+                    i["name"],
+                    i["level"],
+                    ",".join(i["mntner"]),
+                    "NONE" if parent is None else "%s %s %d %s" % (
+                        parent["type"], parent["name"], parent["level"],
+                        ",".join(parent["mntner"])),
                 )
-
-                first = True
-                continue
+            )
+        if len(findings) > 0:
+            sys.exit(1)
 
 
 if __name__ == "__main__":
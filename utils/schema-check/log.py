@@ -2,8 +2,10 @@ from __future__ import print_function
 
 import os
 import sys
-import inspect
+import atexit
 import datetime
+import threading
+import queue
 
 OUTPUT = sys.stderr
 
@@ -29,6 +31,66 @@ VERB_DEBUG = 5
 VERB_NONE = -1
 
 
+class LogFile:
+    """buffered log file writer
+
+    Keeps one handle open and only reopens it when the file name changes
+    (at midnight). With background set, lines are handed to a writer
+    thread so the caller never waits on the disk."""
+
+    def __init__(self, background=False):
+        self.name = None
+        self.handle = None
+        self.lock = threading.Lock()
+        self.queue = None
+        self.thread = None
+
+        if background:
+            self.queue = queue.SimpleQueue()
+            self.thread = threading.Thread(target=self.__run, daemon=True)
+            self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, name, lines):
+        if self.queue is not None:
+            self.queue.put((name, lines))
+        else:
+            self.__write(name, lines)
+
+    def __write(self, name, lines):
+        with self.lock:
+            if name != self.name:
+                if self.handle is not None:
+                    self.handle.close()
+                self.handle = open(name, "a", buffering=64 * 1024)
+                self.name = name
+            self.handle.writelines(lines)
+
+    def __run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.__write(*item)
+
+    def flush(self):
+        with self.lock:
+            if self.handle is not None:
+                self.handle.flush()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.queue = None
+        with self.lock:
+            if self.handle is not None:
+                self.handle.close()
+                self.handle = None
+                self.name = None
+
+
 class Log:
     log_dir = ""
     log_pfx = "main"
@@ -36,13 +98,27 @@ class Log:
     level_console = VERB_ERROR
     level_file = VERB_NONE
     level_full = False
+    file_background = False
 
     count = [0, 0, 0, 0, 0, 0]
+    file = None
 
     def __init__(self):
         self.prog_name = sys.argv[0].rsplit("/", 1)[-1]
         self.prog_name = self.prog_name.split(".", 1)[0]
         self.log_pfx = self.prog_name
+        self.local = threading.local()
+
+    # When set to a list, messages from the current thread are recorded as
+    # (level, message, (file, function, line)) tuples instead of being
+    # written out. Used by worker processes and threads.
+    @property
+    def capture(self):
+        return getattr(self.local, "capture", None)
+
+    @capture.setter
+    def capture(self, records):
+        self.local.capture = records
 
     def __del__(self):
         if self.level_console >= 5:
@@ -53,23 +129,43 @@ class Log:
             os.makedirs(name)
         self.log_dir = name
 
+    #  Send messages up to level to a log file in name.
+    def set_file(self, name, level=VERB_DEBUG, background=False):
+        self.set_dir(name)
+        self.level_file = level
+        self.file_background = background
+
     #  Write a message to console or log, conditionally.
-    def output(self, level, message, frame=1):
+    def output(self, level, message, frame=1, caller=None):
         if level < 0 or level > 5:
             level = 5
 
+        if self.capture is not None:
+            if caller is None:
+                caller = self.__caller(frame)
+            self.capture.append((level, str(message), caller))
+            return
+
         self.count[level] += 1
 
-        # function_name = inspect.stack()[1][3]
+        to_console = self.level_console >= level
+        to_file = self.level_file >= level
+        if not to_console and not to_file:
+            return
+
         cur_date = datetime.datetime.now()
 
-        (frame, file, ln, fn, lines, index) = inspect.getouterframes(
-            inspect.currentframe())[frame]
+        # Caller info is only shown in full console output and log files.
+        file = fn = ln = None
+        if caller is not None:
+            file, fn, ln = caller
+        elif to_file or self.level_full:
+            file, fn, ln = self.__caller(frame)
 
         message = str(message).split("\n")
         cmsg = CMSG if self.level_full else CMULTI
 
-        if self.level_console >= level:
+        if to_console:
 
             if len(message) == 1:
                 if self.level_full:
@@ -89,17 +185,36 @@ class Log:
                     print(CMULTI.format(str(cur_date), CLEVEL[
                           VERB_NONE], line), file=OUTPUT)
 
-        if self.level_file >= level:
-            self.set_dir("./logs")
+        if to_file:
+            if not self.log_dir:
+                self.set_dir("./logs")
+            if self.file is None:
+                self.file = LogFile(self.file_background)
+
             log_file_name = os.path.join(
                 self.log_dir, self.log_pfx + str(cur_date.strftime('%Y-%m-%d')) + ".txt")
 
-            with open(log_file_name, "a") as logger:
-                logger.write(MSG.format(str(cur_date), LEVEL[
-                             level], self.prog_name, file, fn, ln, message[0]) + "\n")
-                for line in message[1:]:
-                    logger.write(MSG.format(str(cur_date), LEVEL[
-                                 VERB_NONE], self.prog_name, file, fn, ln, line) + "\n")
+            lines = [MSG.format(str(cur_date), LEVEL[
+                     level], self.prog_name, file, fn, ln, message[0]) + "\n"]
+            for line in message[1:]:
+                lines.append(MSG.format(str(cur_date), LEVEL[
+                             VERB_NONE], self.prog_name, file, fn, ln, line) + "\n")
+            self.file.write(log_file_name, lines)
+
+    @staticmethod
+    def __caller(frame):
+        caller = sys._getframe(frame + 1)
+        return caller.f_code.co_filename, caller.f_code.co_name, caller.f_lineno
+
+    #  Write out messages recorded by a capturing logger, with the caller
+    #  they were recorded at. Records without one show the replay() call.
+    def replay(self, records):
+        for record in records:
+            level, message = record[0], record[1]
+            if self.level_console >= level or self.level_file >= level:
+                self.output(level, message, 2, record[2] if len(record) > 2 else None)
+            else:
+                self.count[level] += 1
 
     def fatal(self, message):
         self.output(VERB_CRITICAL, message, 2)
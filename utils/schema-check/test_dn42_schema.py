@@ -0,0 +1,1477 @@
+#!/usr/bin/env python3
+"tests of dn42-schema.py, run with python3 -m unittest or pytest"
+
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, "..", "..", "data")
+sys.path.insert(0, HERE)
+
+
+def _load():
+    # The script parses sys.argv when imported.
+    argv, sys.argv = sys.argv, ["dn42-schema.py"]
+    try:
+        spec = importlib.util.spec_from_file_location(
+            "dn42_schema", os.path.join(HERE, "dn42-schema.py"))
+        module = importlib.util.module_from_spec(spec)
+        # Registered so worker processes can unpickle its functions.
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+    return module
+
+
+schema = _load()
+
+
+def _rule(nr, action, prefix, minlen, maxlen):
+    obj_type = "inet6num" if ":" in prefix else "inetnum"
+    net, mask = schema.parse_net(obj_type, prefix)
+    return (nr, action, net, mask, minlen, maxlen, "", "filter.txt")
+
+
+def _net(prefix):
+    return schema.parse_net("inet6num" if ":" in prefix else "inetnum", prefix)
+
+
+SAMPLE = [
+    "mntner/SAM-MNT", "mntner/DN42-MNT", "registry/DN42", "aut-num/AS4242422503",
+    "inetnum/172.23.161.64_27", "inetnum/172.23.161.0_27", "route/172.23.161.64_27",
+    "route/172.23.161.0_27",
+]
+
+
+def _sample(path):
+    "copy the schemas and a few objects of the registry to path"
+    shutil.copytree(os.path.join(DATA, "schema"), os.path.join(path, "schema"))
+    for name in SAMPLE:
+        os.makedirs(os.path.join(path, os.path.dirname(name)), exist_ok=True)
+        shutil.copy(os.path.join(DATA, name), os.path.join(path, name))
+
+
+def _scan(path, **kwargs):
+    "(status, logged warnings and errors, output) of scan_files"
+    out = io.StringIO()
+    capture, schema.log.default.capture = schema.log.default.capture, []
+    try:
+        with contextlib.redirect_stdout(out):
+            ck = schema.scan_files(path, **kwargs)
+        records = [i for i in schema.log.default.capture if i[0] <= schema.log.VERB_WARN]
+        return ck, records, out.getvalue()
+    finally:
+        schema.log.default.capture = capture
+
+
+class TestRouteFilter(unittest.TestCase):
+    "rule matching of filter.txt and filter6.txt"
+
+    RULES = [
+        _rule(1, "deny", "172.22.166.0/24", 24, 32),
+        _rule(1001, "permit", "172.20.0.0/24", 28, 32),
+        _rule(1100, "permit", "172.20.0.0/14", 21, 29),
+        _rule(9999, "deny", "0.0.0.0/0", 0, 32),
+        _rule(1001, "permit", "fd00::/8", 44, 64),
+        _rule(9999, "deny", "::/0", 0, 128),
+    ]
+
+    def setUp(self):
+        self.rules = schema.RouteFilter(self.RULES)
+
+    def test_first_rule_allowing_the_length(self):
+        self.assertEqual(self.rules.match(*_net("172.20.0.0/24"))[0], 1100)
+        self.assertEqual(self.rules.match(*_net("172.20.0.16/28"))[0], 1001)
+        self.assertEqual(self.rules.check(*_net("172.20.0.0/24"), "29"),
+                         (self.RULES[2], 29, None))
+
+    def test_falls_through_to_deny(self):
+        rule, _, problem = self.rules.check(*_net("172.20.0.0/16"))
+        self.assertEqual((rule[0], problem), (9999, "denied"))
+        rule, _, problem = self.rules.check(*_net("fd42:4242::/32"))
+        self.assertEqual((rule[0], problem), (9999, "denied"))
+        self.assertEqual(self.rules.check(*_net("172.22.166.0/25"))[2], "denied")
+
+    def test_no_rule(self):
+        rules = schema.RouteFilter(self.RULES[1:3])
+        self.assertEqual(rules.check(*_net("10.0.0.0/8")), (None, None, "no-rule"))
+        self.assertEqual(rules.check(*_net("172.20.0.0/20")), (None, None, "no-rule"))
+
+    def test_max_length(self):
+        self.assertEqual(self.rules.check(*_net("172.21.0.0/24"), "32"),
+                         (self.RULES[2], 29, "max-length"))
+        self.assertEqual(self.rules.check(*_net("fd42:4242::/48"), "64"),
+                         (self.RULES[4], 64, None))
+
+    def test_analyse(self):
+        rules = schema.RouteFilter(self.RULES + [
+            _rule(1200, "permit", "172.20.1.0/24", 24, 28),
+            _rule(1300, "permit", "172.20.0.0/24", 21, 32),
+            _rule(1300, "permit", "172.23.0.0/16", 16, 32),
+        ])
+        found = {(f["nr"], f["kind"]): f["by"] for f in rules.analyse()}
+        self.assertEqual(found, {(1200, "shadowed"): [1100],
+                                 (1300, "shadowed"): [1001, 1100],
+                                 (1300, "duplicate"): [1300]})
+        self.assertEqual(schema.RouteFilter(self.RULES).analyse(), [])
+
+
+class TestLog(unittest.TestCase):
+    "log.py console, file and captured output"
+
+    def setUp(self):
+        self.log = schema.log.Log()
+
+    def record(self):
+        self.log.error("recorded")
+
+    def test_replay_keeps_the_caller(self):
+        self.log.capture = []
+        self.record()
+        records, self.log.capture = self.log.capture, None
+        self.assertEqual(records[0][:2], (schema.log.VERB_ERROR, "recorded"))
+        self.assertEqual(records[0][2][:2], (__file__, "record"))
+
+        self.log.capture = []
+        self.log.replay(records + [(schema.log.VERB_ERROR, "bare")])
+        self.assertEqual(self.log.capture[0], records[0])
+        self.assertEqual(self.log.capture[1][2][1], "test_replay_keeps_the_caller")
+
+    def test_console(self):
+        out, schema.log.OUTPUT = schema.log.OUTPUT, io.StringIO()
+        count = list(self.log.count)
+        try:
+            self.log.level_console = schema.log.VERB_WARN
+            self.log.info("hidden")
+            self.log.warning("shown")
+            self.log.level_full = True
+            self.record()
+            text = schema.log.OUTPUT.getvalue()
+        finally:
+            schema.log.OUTPUT = out
+        self.assertEqual([a - b for a, b in zip(self.log.count, count)], [0, 1, 1, 0, 1, 0])
+        self.assertNotIn("hidden", text)
+        self.assertIn("shown", text)
+        self.assertIn("%s:%d [record]" % (__file__, self.record.__code__.co_firstlineno + 1),
+                      text)
+
+    def test_file(self):
+        for background in (False, True):
+            with tempfile.TemporaryDirectory() as path:
+                self.log.level_console = schema.log.VERB_NONE
+                self.log.set_file(path, schema.log.VERB_INFO, background)
+                self.record()
+                self.log.info("first\nsecond")
+                self.log.debug("hidden")
+                self.log.file.close()
+
+                names = os.listdir(path)
+                self.assertEqual(len(names), 1)
+                with open(os.path.join(path, names[0])) as f:
+                    lines = f.read().splitlines()
+                self.log.file = None
+
+            self.assertEqual([i.split("  ::  ")[1] for i in lines],
+                             ["recorded", "first", "second"])
+            self.assertIn("  ERR   ", lines[0])
+            self.assertIn("  record  ", lines[0])
+
+
+class TestScan(unittest.TestCase):
+    "scan_files with worker processes and a cache"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data")
+        _sample(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_jobs(self):
+        serial = _scan(self.path)
+        self.assertEqual(serial[0], "FAIL")
+        self.assertIn("172.23.161.64_27", serial[2])
+        self.assertEqual(_scan(self.path, jobs=2), serial)
+        self.assertEqual(_scan(self.path, jobs=2, mntner="SAM-MNT"),
+                         _scan(self.path, mntner="SAM-MNT"))
+
+    def test_cache(self):
+        cache = os.path.join(self.tmp.name, "cache.json")
+        serial = _scan(self.path)
+        self.assertEqual(_scan(self.path, cache=cache), serial)
+        self.assertEqual(len(schema.ScanCache(cache).objects), 26)
+        self.assertEqual(_scan(self.path, cache=cache), serial)
+        self.assertEqual(_scan(self.path, cache=cache, mntner="SAM-MNT"),
+                         _scan(self.path, mntner="SAM-MNT"))
+
+        # Objects referring to a removed file are checked again.
+        for name in ("mntner/SAM-MNT", "route/172.23.161.0_27"):
+            os.remove(os.path.join(self.path, name))
+            serial = _scan(self.path)
+            self.assertIn("SAM-MNT", serial[2])
+            self.assertEqual(_scan(self.path, cache=cache), serial)
+            self.assertEqual(_scan(self.path, cache=cache, jobs=2), serial)
+
+    def test_jsonl(self):
+        text = _scan(self.path)
+        ck, records, out = _scan(self.path, fmt="jsonl")
+        lines = [json.loads(i) for i in out.splitlines()]
+        summary = lines.pop()
+        self.assertEqual((ck, records), text[:2])
+        self.assertEqual([(i["type"], i["path"], i["status"]) for i in lines],
+                         [("object", i.split("\t")[1].strip(), i.split("\t")[2])
+                          for i in text[2].splitlines()])
+        self.assertEqual((summary["type"], summary["status"], summary["objects"],
+                          summary["counts"]), ("summary", "FAIL", 26, {"FAIL": 5, "PASS": 21}))
+
+        found = {os.path.relpath(i["path"], self.path): [f["code"] for f in i["findings"]]
+                 for i in lines if i["status"] == "FAIL"}
+        self.assertEqual(found["inetnum/172.23.161.64_27"], ["reference", "reference"])
+        self.assertEqual(sum(len(i) for i in found.values()),
+                         len([r for r in records if r[0] == schema.log.VERB_ERROR]))
+
+        pooled = _scan(self.path, fmt="jsonl", jobs=2)[2].splitlines()
+        self.assertEqual(pooled[:-1], out.splitlines()[:-1])
+
+    def test_profile(self):
+        for jobs in (1, 2):
+            profile = schema.ScanProfile(top=3)
+            self.assertEqual(_scan(self.path, jobs=jobs, profile=profile), _scan(self.path))
+
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                profile.report("jsonl")
+            res = json.loads(out.getvalue())
+            self.assertLessEqual(set(res["phases"]), set(schema.ScanProfile.PHASES))
+            self.assertEqual(res["phases"]["check"]["calls"], 26)
+            self.assertEqual(sum(i["objects"] for i in res["types"].values()), 26)
+            self.assertEqual(len(res["slowest"]), 3)
+
+    def test_profile_phases(self):
+        profile = schema.ScanProfile()
+
+        def outer():
+            time.sleep(0.02)
+            profile.timed("lookup", time.sleep, 0.02)
+
+        profile.timed("check", outer)
+        profile.timed("check", time.sleep, 0.01)
+        (n, wall, _), inner = profile.phases["check"], profile.phases["lookup"]
+        self.assertEqual((n, inner[0]), (2, 1))
+        self.assertGreaterEqual(inner[1], 0.02)
+        self.assertGreaterEqual(wall, 0.03)
+        self.assertLess(wall, 0.03 + inner[1] - 0.005)
+
+    def test_mnt_index(self):
+        fn = os.path.join(self.tmp.name, "mntner.json")
+        route = os.path.join(self.path, "route/172.23.161.64_27")
+        self.assertEqual(_scan(self.path, mnt_index=fn, mntner="SAM-MNT"),
+                         _scan(self.path, mntner="SAM-MNT"))
+
+        index = schema.MntnerIndex(fn)
+        self.assertEqual(len(index.files), 26)
+        self.assertEqual(schema.MntnerIndex(fn).refresh([route]),
+                         [schema._peek_file(route)])
+
+        with open(route) as f:
+            text = f.read()
+        with open(route, "w") as f:
+            f.write(text.replace("mnt-by:             SAM-MNT", "mnt-by:             TEST-MNT"))
+        index.refresh([route])
+        self.assertEqual(index.mntners, {route: ["TEST-MNT"]})
+        self.assertEqual(list(schema.MntnerIndex(fn).files), [route])
+        self.assertEqual(_scan(self.path, mnt_index=fn, mntner="SAM-MNT"),
+                         _scan(self.path, mntner="SAM-MNT"))
+
+
+class TestServe(unittest.TestCase):
+    "ResidentRegistry and the serve daemon"
+
+    def setUp(self):
+        self.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data")
+        _sample(self.path)
+
+    def tearDown(self):
+        schema.log.default.level_console = self.level
+        self.tmp.cleanup()
+
+    def scan(self, registry, *args):
+        status, records, out = registry.scan(*args)
+        return status, [i for i in records if i[0] <= schema.log.VERB_WARN], out
+
+    def change(self):
+        with open(os.path.join(self.path, "route/172.23.161.0_27"), "a") as f:
+            f.write("bad-key:            changed\n")
+        os.remove(os.path.join(self.path, "mntner/SAM-MNT"))
+
+    def test_scan(self):
+        registry = schema.ResidentRegistry(self.path)
+        self.assertEqual(self.scan(registry), _scan(self.path))
+        self.assertEqual(self.scan(registry, "SAM-MNT"), _scan(self.path, mntner="SAM-MNT"))
+
+        fn = os.path.join(self.path, "route/172.23.161.64_27")
+        self.assertEqual(self.scan(registry, None, fn),
+                         _scan(self.path, use_file=registry.paths[os.path.abspath(fn)]))
+        self.assertIsNone(registry.scan(None, os.path.join(self.tmp.name, "other")))
+
+    def test_refresh(self):
+        for inotify in (True, False):
+            registry = schema.ResidentRegistry(self.path)
+            if not inotify:
+                registry.watch.inotify = None
+            self.scan(registry)
+            self.change()
+            self.assertEqual(self.scan(registry), _scan(self.path))
+            self.assertIn("bad-key", str(self.scan(registry)[1]))
+            shutil.copy(os.path.join(DATA, "mntner/SAM-MNT"), os.path.join(self.path, "mntner"))
+            self.assertEqual(self.scan(registry), _scan(self.path))
+
+            with open(os.path.join(self.path, "mntner/SAM-MNT"), "w") as f:
+                f.write("")
+            status, _, out = self.scan(registry)
+            self.assertIn("mntner/SAM-MNT", out)
+            self.assertEqual(status, "FAIL")
+
+            self.tmp.cleanup()
+            _sample(self.path)
+
+    def test_daemon(self):
+        sock = os.path.join(self.tmp.name, "serve.sock")
+        cmd = [sys.executable, os.path.join(HERE, "dn42-schema.py")]
+        proc = subprocess.Popen(cmd + ["serve", self.path, "--socket", sock],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            for _ in range(100):
+                if schema.serve_request(sock, {"command": "ping"}) is not None:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(os.stat(sock).st_mode & 0o777, 0o600)
+
+            def scan(*args):
+                ret = subprocess.run(cmd + ["scan", self.path] + list(args), check=False,
+                                     stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                return ret.returncode, ret.stdout
+
+            self.assertEqual(scan("--socket", sock), scan())
+            self.change()
+            self.assertEqual(scan("--socket", sock, "-m", "SAM-MNT"), scan("-m", "SAM-MNT"))
+            self.assertEqual(schema.serve_request(sock, {"command": "scan", "path": "/"}),
+                             {"error": "serving %s, not /" % (os.path.abspath(self.path))})
+        finally:
+            proc.terminate()
+            proc.wait()
+
+
+class TestRegistryIndex(unittest.TestCase):
+    "binary registry index"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data")
+        self.fn = os.path.join(self.tmp.name, "index")
+        _sample(self.path)
+        schema.index_files(self.path, self.fn)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_objects(self):
+        ri = schema.RegistryIndex(self.fn)
+        self.assertTrue(schema.RegistryIndex.is_index(self.fn))
+        self.assertEqual(len(ri), 26)
+        for i, obj_type, name, src, mnts in ri:
+            dom = schema.FileDOM(src)
+            self.assertEqual((obj_type, name, mnts),
+                             (dom.schema, src.split("/")[-1].replace("_", "/"), dom.mntner))
+            self.assertEqual(ri.object(i), (obj_type, name, src, mnts))
+            with open(src) as f:
+                self.assertEqual(ri.text(i), f.read())
+            self.assertEqual(ri.dom(i).dom, dom.dom)
+            self.assertFalse(ri.stale(i))
+
+    def test_stale(self):
+        route = os.path.join(self.path, "route/172.23.161.0_27")
+        with open(route, "a") as f:
+            f.write("remarks:            changed\n")
+        os.remove(os.path.join(self.path, "mntner/SAM-MNT"))
+
+        ri = schema.RegistryIndex(self.fn)
+        stale = [src for i, _, _, src, _ in ri if ri.stale(i)]
+        self.assertEqual(sorted(os.path.relpath(i, self.path) for i in stale),
+                         ["mntner/SAM-MNT", "route/172.23.161.0_27"])
+
+    def test_scan(self):
+        capture, schema.log.default.capture = schema.log.default.capture, []
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out):
+                ck = schema.scan_index(self.fn)
+        finally:
+            schema.log.default.capture = capture
+        self.assertEqual((ck, out.getvalue()), (_scan(self.path)[0], _scan(self.path)[2]))
+
+    def test_version(self):
+        with open(self.fn, "r+b") as f:
+            f.seek(len(schema.RegistryIndex.MAGIC))
+            f.write(b"\1\0\0\0")
+        with self.assertRaises(ValueError):
+            schema.RegistryIndex(self.fn)
+
+
+class TestScanChanges(unittest.TestCase):
+    "scan --since"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data")
+        _sample(self.path)
+        for args in (["init", "-q"], ["add", "."], ["commit", "-q", "-m", "sample"]):
+            subprocess.run(["git", "-C", self.path, "-c", "user.name=test",
+                            "-c", "user.email=test@example.com"] + args,
+                           stdout=subprocess.DEVNULL, check=True)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def scan(self, **kwargs):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ck = schema.scan_changes(self.path, "HEAD", **kwargs)
+        return ck, [i.split("\t")[1].strip() for i in out.getvalue().splitlines()]
+
+    def test_unchanged(self):
+        self.assertEqual(self.scan(), (True, []))
+
+    def test_dependents(self):
+        with open(os.path.join(self.path, "route/172.23.161.0_27"), "a") as f:
+            f.write("remarks:            changed\n")
+        os.remove(os.path.join(self.path, "mntner/SAM-MNT"))
+
+        ck, found = self.scan()
+        self.assertEqual(ck, "FAIL")
+        self.assertEqual([os.path.relpath(i, self.path) for i in found], [
+            "aut-num/AS4242422503", "inetnum/172.23.161.64_27",
+            "route/172.23.161.0_27", "route/172.23.161.64_27",
+        ])
+        self.assertEqual(self.scan(jobs=2), (ck, found))
+
+        # The same results as a full scan for the objects it checks.
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            schema.scan_changes(self.path, "HEAD")
+        self.assertLessEqual(set(out.getvalue().splitlines()),
+                             set(_scan(self.path)[2].splitlines()))
+
+
+def _object(fn, **attrs):
+    text = "".join("%-20s%s\n" % (k.replace("_", "-") + ":", v) for k, v in attrs.items())
+    return schema.FileDOM(fn, text)
+
+
+class TestSchemaDOM(unittest.TestCase):
+    "compiled schemas and their cache"
+
+    TEXT = ("schema:             TEST-SCHEMA\n"
+            "ref:                dn42.test\n"
+            "key:                test           optional  multiple  primary schema\n"
+            "key:                descr          required  single\n"
+            "key:                mnt-by         optional  multiple  lookup=dn42.mntner\n"
+            "key:                remarks        optional  multiple  deprecate\n")
+
+    def setUp(self):
+        self.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+        self.tmp = tempfile.TemporaryDirectory()
+        self.fn = os.path.join(self.tmp.name, "TEST-SCHEMA")
+        with open(self.fn, "w") as f:
+            f.write(self.TEXT)
+
+    def tearDown(self):
+        schema.log.default.level_console = self.level
+        self.tmp.cleanup()
+
+    def test_compile(self):
+        s = schema.SchemaDOM(self.fn)
+        self.assertEqual((s.name, s.ref, s.primary, s.type),
+                         ("TEST-SCHEMA", "dn42.test", "test", "test"))
+        self.assertEqual(s.schema["test"], {"primary", "schema", "single", "required", "oneline"})
+        self.assertEqual(s.flags["descr"], s.REQUIRED | s.SINGLE)
+        self.assertEqual(s.flags["remarks"], s.DEPRECATE)
+        self.assertEqual(s.lookups, {"mnt-by": ((("dn42.mntner",), "['dn42.mntner']"),)})
+
+    def test_cache(self):
+        s = schema.SchemaDOM(self.fn)
+        cache = schema.SchemaCache.open(self.tmp.name)
+        self.assertTrue(cache.dirty)
+        cache.save()
+
+        cached = schema.SchemaCache(self.tmp.name)
+        self.assertEqual(cached.schemas, cache.schemas)
+        self.assertEqual(len(cached.schemas), 1)
+        t = schema.SchemaDOM(self.fn, self.TEXT)
+        self.assertEqual((t.schema, t.flags, t.lookups, t.checks),
+                         (s.schema, s.flags, s.lookups, s.checks))
+
+        # Entries for schema files that changed are dropped on save.
+        with open(self.fn, "a") as f:
+            f.write("key:                source         required  single\n")
+        schema.SchemaDOM(self.fn)
+        cache.save()
+        self.assertEqual(len(schema.SchemaCache(self.tmp.name).schemas), 1)
+
+    def test_check_file(self):
+        s = schema.SchemaDOM(self.fn)
+        text = ("test:               EXAMPLE\n"
+                "descr:              example\n"
+                "remarks:            old\n"
+                "mnt-by:             EXAMPLE-MNT\n"
+                "x-note:             mine\n")
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            ck = s.check_file(schema.FileDOM("test/EXAMPLE", text),
+                              {("dn42.mntner", "EXAMPLE-MNT")}, "jsonl")
+            self.assertEqual(s.check_file(schema.FileDOM("test/EXAMPLE", text), set(), "jsonl"),
+                             "FAIL")
+            self.assertEqual(s.check_file(schema.FileDOM("test/EXAMPLE", "descr: x\nbad: 1\n"),
+                                          None, "jsonl"), "FAIL")
+        found = [[f["code"] for f in json.loads(i)["findings"]]
+                 for i in out.getvalue().splitlines()]
+        self.assertEqual(ck, "INFO")
+        self.assertEqual(found, [
+            ["deprecated", "user-defined"],
+            ["deprecated", "reference", "user-defined"],
+            ["required", "first-line", "unknown-key"],
+        ])
+
+
+class TestFileDOM(unittest.TestCase):
+    "object parsing"
+
+    TEXT = ("inetnum:            172.20.0.0 - 172.20.0.255\n"
+            "descr:              first\n"
+            "                    second\n"
+            "\tthird\n"
+            "remarks:            see http://example.com:80/\n"
+            "not a key\n"
+            "mnt-by:             A-MNT\n"
+            "mnt-by:             B-MNT\n")
+
+    def test_parse(self):
+        dom = schema.FileDOM("inetnum/172.20.0.0_24", self.TEXT)
+        self.assertTrue(dom.valid)
+        self.assertEqual(dom.dom, [
+            ("inetnum", "172.20.0.0 - 172.20.0.255", 0),
+            ("descr", "first\nsecond\nthird", 1),
+            ("remarks", "see http://example.com:80/", 4),
+            ("mnt-by", "A-MNT", 6),
+            ("mnt-by", "B-MNT", 7),
+        ])
+        self.assertEqual(dom.keys, {"inetnum": [0], "descr": [1], "remarks": [2],
+                                    "mnt-by": [3, 4]})
+        self.assertEqual(dom.multi, {"descr": [3]})
+        self.assertEqual((dom.mntner, dom.schema), (["A-MNT", "B-MNT"], "dn42.inetnum"))
+        self.assertEqual((dom.get("mnt-by", 1), dom.get("mnt-by", 2)), ("B-MNT", None))
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as path:
+            fn = os.path.join(path, "172.20.0.0_24")
+            with open(fn, "w") as f:
+                f.write(self.TEXT)
+            dom = schema.FileDOM(fn)
+        self.assertEqual(dom.dom, schema.FileDOM(fn, self.TEXT).dom)
+        self.assertEqual(str(schema.FileDOM(fn, str(dom))), str(dom))
+
+    def test_leading_continuation(self):
+        capture, schema.log.default.capture = schema.log.default.capture, []
+        try:
+            dom = schema.FileDOM("inetnum/172.20.0.0_24", " 172.20.0.0\n" + self.TEXT)
+        finally:
+            schema.log.default.capture = capture
+        self.assertFalse(dom.valid)
+        self.assertEqual(dom.dom, [])
+
+
+class TestSanityCheck(unittest.TestCase):
+    "inetnum/inet6num range and cidr checks"
+
+    def setUp(self):
+        self.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+
+    def tearDown(self):
+        schema.log.default.level_console = self.level
+
+    def check(self, dom):
+        findings = []
+        ck = schema.sanity_check(dom, findings)
+        self.assertEqual(schema.sanity_check_bulk([dom]), [ck])
+        return ck, sorted(f["code"] for f in findings)
+
+    def test_pass(self):
+        self.assertEqual(self.check(_object(
+            "inetnum/172.20.0.0_24", inetnum="172.20.0.0 - 172.20.0.255",
+            cidr="172.20.0.0/24")), ("PASS", []))
+        self.assertEqual(self.check(_object(
+            "inet6num/fd42:4242::_32",
+            inet6num="fd42:4242:0000:0000:0000:0000:0000:0000 - "
+                     "fd42:4242:ffff:ffff:ffff:ffff:ffff:ffff",
+            cidr="fd42:4242::/32")), ("PASS", []))
+
+    def test_host_bits(self):
+        self.assertEqual(self.check(_object(
+            "inetnum/172.20.0.0_24", inetnum="172.20.0.0 - 172.20.0.255",
+            cidr="172.20.0.1/24")), ("FAIL", ["host-bits"]))
+        self.assertEqual(self.check(_object(
+            "inet6num/fd42:4242::_32",
+            inet6num="fd42:4242:0000:0000:0000:0000:0000:0000 - "
+                     "fd42:4242:ffff:ffff:ffff:ffff:ffff:ffff",
+            cidr="fd42:4242::1/32")), ("FAIL", ["host-bits"]))
+
+    def test_range(self):
+        # One finding per object: a range that does not match is not
+        # also reported as unaligned or for the host bits of its cidr.
+        self.assertEqual(self.check(_object(
+            "inetnum/172.23.161.64_27", inetnum="172.23.161.64 - 172.23.159.96",
+            cidr="172.23.161.64/27")), ("FAIL", ["range"]))
+        self.assertEqual(self.check(_object(
+            "inetnum/172.20.0.0_24", inetnum="172.20.0.0 - 172.20.1.255",
+            cidr="172.20.0.1/24")), ("FAIL", ["range"]))
+        self.assertEqual(self.check(_object(
+            "inet6num/fd42:4242::_32",
+            inet6num="fd42:4242:: - fd42:4242:ffff:ffff:ffff:ffff:ffff:ffff",
+            cidr="fd42:4242::/32")), ("FAIL", ["range"]))
+
+    def test_bulk(self):
+        doms = [
+            _object("inetnum/172.20.0.0_24", inetnum="172.20.0.0 - 172.20.0.255",
+                    cidr="172.20.0.0/24"),
+            _object("inetnum/172.20.0.0_24", inetnum="172.20.0.0 - 172.20.0.255",
+                    cidr="172.20.0.1/24"),
+            _object("inetnum/172.20.0.0_24", inetnum="172.20.000.0 - 172.20.0.255",
+                    cidr="172.20.0.0/24"),
+            _object("inet6num/fd42:4242::_32",
+                    inet6num="FD42:4242:0000:0000:0000:0000:0000:0000 - "
+                             "fd42:4242:ffff:ffff:ffff:ffff:ffff:ffff",
+                    cidr="fd42:4242::/32"),
+            _object("mntner/EXAMPLE-MNT", mntner="EXAMPLE-MNT"),
+        ]
+        self.assertEqual(schema.sanity_check_bulk(doms), ["PASS", "FAIL", "FAIL", "FAIL", "PASS"])
+        self.assertEqual(schema.sanity_check_bulk(doms), [schema.sanity_check(d) for d in doms])
+
+    def test_bad_cidr(self):
+        self.assertEqual(self.check(_object(
+            "inetnum/172.20.0.0_24", inetnum="172.20.0.0 - 172.20.0.255",
+            cidr="172.20.0/x")), ("FAIL", ["cidr"]))
+        self.assertEqual(self.check(_object(
+            "inetnum/172.20.0.0_24", inetnum="172.20.0.0 - 172.20.0.255")),
+            ("FAIL", ["cidr"]))
+
+    def test_type_directory(self):
+        with tempfile.TemporaryDirectory() as path:
+            os.mkdir(os.path.join(path, "inetnum"))
+            for name in ("172.20.0.0_24", ".hidden"):
+                with open(os.path.join(path, "inetnum", name), "w") as f:
+                    f.write("inetnum: 172.20.0.0 - 172.20.0.255\ncidr: 172.20.0.0/24\n")
+
+            want = [os.path.join(path, "inetnum", "172.20.0.0_24")]
+            self.assertEqual(schema._object_files(path), want)
+            self.assertEqual(schema._object_files(os.path.join(path, "inetnum")), want)
+
+
+def _registry(path, objects):
+    "write {type/name: {key: value}} objects under path"
+    for name, attrs in objects.items():
+        fn = os.path.join(path, name.replace("/", "_").replace("_", "/", 1))
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(fn, "w") as f:
+            f.write("".join("%-20s%s\n" % (k + ":", v) for k, v in attrs.items()))
+
+
+class TestNetTree(unittest.TestCase):
+    "NetTree insert, delete and lookups"
+
+    NAMES = [
+        ("inetnum", "10.0.0.0/8"), ("inetnum", "10.1.0.0/16"), ("route", "10.1.0.0/16"),
+        ("inetnum", "10.1.2.0/24"), ("route", "10.1.2.128/25"), ("inetnum", "10.2.0.0/16"),
+        ("inet6num", "fd00::/8"), ("inet6num", "fd42::/16"), ("route6", "fd42:1::/48"),
+    ]
+
+    def setUp(self):
+        self.tree = schema.NetTree()
+        for obj_type, name in self.NAMES:
+            self.assertIsNotNone(self.tree.insert(obj_type, name))
+
+    def names(self, nodes):
+        return [name for node in nodes for _, name in node.objects]
+
+    def check_shape(self):
+        "every node without objects but the root joins two branches"
+        stack = [self.tree.root]
+        size = 0
+        while stack:
+            node = stack.pop()
+            kids = [c for c in node.children if c is not None]
+            if node is not self.tree.root and len(node.objects) == 0:
+                self.assertEqual(len(kids), 2, node)
+            for c in kids:
+                self.assertIs(c.parent, node)
+                self.assertEqual((c.net ^ node.net) >> (128 - node.mask), 0)
+            size += len(node.objects)
+            stack.extend(kids)
+        self.assertEqual(size, self.tree.size)
+
+    def test_lookup(self):
+        self.check_shape()
+        self.assertEqual(self.names(self.tree.covering(*_net("10.1.2.200/32"))),
+                         ["10.0.0.0/8", "10.1.0.0/16", "10.1.0.0/16", "10.1.2.0/24",
+                          "10.1.2.128/25"])
+        self.assertEqual(self.names(self.tree.covering(*_net("10.1.2.0/24"), strict=True)),
+                         ["10.0.0.0/8", "10.1.0.0/16", "10.1.0.0/16"])
+        self.assertEqual(self.tree.longest_prefix(*_net("fd42:1::1/128")).objects,
+                         [("route6", "fd42:1::/48")])
+        self.assertIsNone(self.tree.longest_prefix(*_net("192.168.0.0/16")))
+        self.assertEqual(self.names(self.tree.covered_by(*_net("10.1.0.0/16"), strict=True)),
+                         ["10.1.2.0/24", "10.1.2.128/25"])
+
+        node = self.tree.node(*_net("10.1.0.0/16"))
+        self.assertEqual(self.names([self.tree.parent(node)]), ["10.0.0.0/8"])
+        self.assertEqual(self.names(self.tree.children(self.tree.node(*_net("10.0.0.0/8")))),
+                         ["10.1.0.0/16", "10.1.0.0/16", "10.2.0.0/16"])
+        self.assertEqual(self.tree.attrs("route", "10.1.0.0/16")["@netlevel"], "003")
+        self.assertEqual(self.tree.attrs("inetnum", "10.1.0.0/16"), {
+            "@family": "ipv4", "@netmask": "112", "@netlevel": "002",
+            "@netmin": "00000000000000000000ffff0a010000",
+            "@netmax": "00000000000000000000ffff0a01ffff",
+        })
+
+    def test_delete(self):
+        self.assertFalse(self.tree.delete("inetnum", "10.9.0.0/16"))
+        self.assertFalse(self.tree.delete("inetnum", "10.1.2.128/25"))
+        self.assertIsNone(self.tree.insert("inetnum", "10.1.2.0/x"))
+
+        self.assertTrue(self.tree.delete("inetnum", "10.1.0.0/16"))
+        self.assertEqual(self.tree.attrs("route", "10.1.0.0/16")["@netlevel"], "002")
+        self.assertTrue(self.tree.delete("route", "10.1.0.0/16"))
+        self.assertIsNone(self.tree.node(*_net("10.1.0.0/16")))
+        self.check_shape()
+        self.assertEqual(self.names(self.tree.covering(*_net("10.1.2.200/32"))),
+                         ["10.0.0.0/8", "10.1.2.0/24", "10.1.2.128/25"])
+
+        for obj_type, name in self.NAMES:
+            self.tree.delete(obj_type, name)
+        self.check_shape()
+        self.assertEqual(self.tree.size, 0)
+        self.assertEqual(self.tree.root.children, [None, None])
+
+    def test_random(self):
+        rng = random.Random(42)
+        nets = {}
+        for _ in range(2000):
+            mask = rng.randint(0, 32)
+            net = rng.getrandbits(32) & ~((1 << (32 - mask)) - 1)
+            name = "%s/%d" % (schema.to_ip(net), mask)
+            if name in nets and rng.random() < 0.5:
+                self.assertTrue(self.tree.delete("route", name))
+                del nets[name]
+            else:
+                self.tree.insert("route", name)
+                nets[name] = _net(name)
+        self.check_shape()
+
+        for _ in range(200):
+            net, mask = _net("%s/32" % (schema.to_ip(rng.getrandbits(32))))
+            want = sorted(n for n, (m, l) in nets.items() if m >> (128 - l) == net >> (128 - l))
+            found = [name for node in self.tree.covering(net, mask)
+                     for t, name in node.objects if t == "route"]
+            self.assertEqual(sorted(found), want)
+
+
+class TestLocalRegistry(unittest.TestCase):
+    "test_policy() against LocalRegistry"
+
+    OBJECTS = {
+        "inetnum/10.0.0.0/8": {"cidr": "10.0.0.0/8", "policy": "closed", "mnt-by": "A-MNT"},
+        "inetnum/10.1.0.0/16": {"cidr": "10.1.0.0/16", "mnt-by": "B-MNT", "mnt-lower": "C-MNT"},
+        "inet6num/fd00::/8": {"cidr": "fd00::/8", "policy": "open", "mnt-by": "A-MNT"},
+        "as-block/AS4242420000-AS4242429999": {"policy": "closed", "mnt-by": "A-MNT"},
+        "aut-num/AS4242420001": {"mnt-by": "B-MNT"},
+        "route/10.1.0.0/16": {"mnt-by": "B-MNT"},
+    }
+
+    POLICY = [
+        (("inetnum", "10.1.2.0/24", "C-MNT"), "PASS"),
+        (("inetnum", "10.1.2.0/24", "D-MNT"), "FAIL"),
+        (("inetnum", "10.1.0.0/16", "C-MNT"), "FAIL"),
+        (("inet6num", "fd42::/48", "D-MNT"), "PASS"),
+        (("inet6num", "fc00::/48", "D-MNT"), "FAIL"),
+        (("route", "10.1.2.0/24", "B-MNT"), "PASS"),
+        (("route", "10.1.2.0/24", "D-MNT"), "FAIL"),
+        (("route6", "fd42::/48", "D-MNT"), "PASS"),
+        (("aut-num", "AS4242420002", "A-MNT"), "PASS"),
+        (("aut-num", "AS4242420002", "B-MNT"), "FAIL"),
+        (("aut-num", "AS4242420001", "B-MNT"), "PASS"),
+        (("mntner", "X-MNT", "X-MNT"), "PASS"),
+        (("person", "X", "X-MNT"), "FAIL"),
+    ]
+
+    def setUp(self):
+        self.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name
+        _registry(self.path, self.OBJECTS)
+
+    def tearDown(self):
+        schema.log.default.level_console = self.level
+        self.tmp.cleanup()
+
+    def test_policy(self):
+        registry = schema.LocalRegistry(self.path)
+        self.assertEqual([schema.test_policy(*item, registry) for item, _ in self.POLICY],
+                         [ck for _, ck in self.POLICY])
+
+    def test_covering(self):
+        registry = schema.LocalRegistry(self.path)
+        lo, hi, mask = schema.inetrange("10.1.2.0/24")
+        self.assertEqual(registry.find(["cidr", "@netlevel", "mnt-by"], {
+            "@type": "net", "@netmin": "le=" + lo, "@netmax": "ge=" + hi,
+            "@netmask": "lt=%03d" % (mask)}), [
+            [["cidr", "10.0.0.0/8"], ["@netlevel", "001"], ["mnt-by", "A-MNT"]],
+            [["cidr", "10.1.0.0/16"], ["@netlevel", "002"], ["mnt-by", "B-MNT"]],
+        ])
+        self.assertEqual(registry.find(["@as-min", "@as-max"], {
+            "@type": "as-block", "@as-min": "le=AS4242420002", "@as-max": "ge=AS4242420002"}),
+            [[["@as-min", "AS4242420000"], ["@as-max", "AS4242429999"]]])
+        with self.assertRaises(ValueError):
+            registry.find(["mnt-by"], {"@type": "net"})
+
+    def test_revision(self):
+        for args in (["init", "-q"], ["add", "."], ["commit", "-q", "-m", "sample"]):
+            subprocess.run(["git", "-C", self.path, "-c", "user.name=test",
+                            "-c", "user.email=test@example.com"] + args,
+                           stdout=subprocess.DEVNULL, check=True)
+        os.remove(os.path.join(self.path, "route/10.1.0.0_16"))
+
+        item = ("route", "10.1.0.0/16", "C-MNT")
+        self.assertEqual(schema.test_policy(*item, schema.LocalRegistry(self.path)), "PASS")
+        self.assertEqual(schema.test_policy(*item, schema.LocalRegistry(self.path, "HEAD")),
+                         "FAIL")
+        registry = schema.LocalRegistry(self.path, "HEAD")
+        self.assertEqual([schema.test_policy(*item, registry) for item, _ in self.POLICY],
+                         [ck for _, ck in self.POLICY])
+
+
+class TestPolicyBatch(unittest.TestCase):
+    "policy-batch"
+
+    def setUp(self):
+        self.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name
+        _registry(self.path, TestLocalRegistry.OBJECTS)
+
+    def tearDown(self):
+        schema.log.default.level_console = self.level
+        self.tmp.cleanup()
+
+    def test_items(self):
+        self.assertEqual(schema.policy_items([
+            "# comment\n", "\n", "inetnum 10.1.2.0_24 C-MNT\n", "route 10.1.2.0/24\n",
+            "mntner X-MNT\n"], "D-MNT"), [
+            ("inetnum", "10.1.2.0/24", "C-MNT"),
+            ("route", "10.1.2.0/24", "D-MNT"),
+            ("mntner", "X-MNT", "D-MNT"),
+        ])
+
+    def test_batch(self):
+        items = [item for item, _ in TestLocalRegistry.POLICY]
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.assertFalse(schema.policy_batch(items, schema.LocalRegistry(self.path)))
+            self.assertTrue(schema.policy_batch(items[:1], schema.LocalRegistry(self.path)))
+        self.assertEqual([i.split("\t")[-1] for i in out.getvalue().splitlines()],
+                         [ck for _, ck in TestLocalRegistry.POLICY] + ["PASS"])
+
+    def test_query_cache(self):
+        calls = []
+        gate = threading.Event()
+
+        def find(fields, filters):
+            calls.append(filters)
+            gate.wait()
+            return [[["mnt-by", filters["@name"]]]]
+
+        query = schema.QueryCache(find)
+        threads = [threading.Thread(target=query.find, args=(["mnt-by"], {"@name": name}))
+                   for name in ("A-MNT", "A-MNT", "B-MNT")]
+        for t in threads:
+            t.start()
+        gate.set()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(query.find(["mnt-by"], {"@name": "A-MNT"}), [[["mnt-by", "A-MNT"]]])
+        self.assertEqual(len(calls), 2)
+
+    def test_changes(self):
+        for args in (["init", "-q"], ["add", "."], ["commit", "-q", "-m", "sample"]):
+            subprocess.run(["git", "-C", self.path, "-c", "user.name=test",
+                            "-c", "user.email=test@example.com"] + args,
+                           stdout=subprocess.DEVNULL, check=True)
+        _registry(self.path, {"route/10.1.2.0/24": {"mnt-by": "C-MNT"},
+                              "aut-num/AS4242420001": {"mnt-by": "C-MNT"}})
+        subprocess.run(["git", "-C", self.path, "add", "."], check=True)
+        self.assertEqual(sorted(schema.policy_changes(self.path, "HEAD", "C-MNT")), [
+            ("aut-num", "AS4242420001", "C-MNT"),
+            ("route", "10.1.2.0/24", "C-MNT"),
+        ])
+
+
+class TestRefGraph(unittest.TestCase):
+    "graph"
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data")
+        _sample(self.path)
+        _registry(self.path, {"person/LONE-DN42": {
+            "person": "Lone", "nic-hdl": "LONE-DN42", "mnt-by": "DN42-MNT", "source": "DN42"}})
+        self.graph = schema.RefGraph.from_registry(self.path)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def names(self, found):
+        return sorted((attr, schema.graph_name(src)) for attr, src in found)
+
+    def test_dangling(self):
+        lines = [json.loads(i) for i in _scan(self.path, fmt="jsonl")[2].splitlines()[:-1]]
+        self.assertEqual(
+            sorted((self.graph.keys[key], line, attr) for key, attr, _, _, line in self.graph.dangling),
+            sorted((i["path"], f["line"], f["key"]) for i in lines for f in i["findings"]
+                   if f["code"] == "reference"))
+
+    def test_dependents(self):
+        key = ("dn42.mntner", "SAM-MNT")
+        for name in ("SAM-MNT", "mntner/SAM-MNT", "dn42.mntner/SAM-MNT"):
+            self.assertEqual(self.graph.find(name), [key])
+        self.assertEqual(self.graph.find("SAM"), [])
+        self.assertEqual(self.graph.find(schema.graph_name(("dn42.registry", "DN42"))),
+                         [("dn42.registry", "DN42")])
+
+        self.assertEqual(self.names(self.graph.dependents(key)), [
+            ("mnt-by", "aut-num/AS4242422503"), ("mnt-by", "inetnum/172.23.161.64/27"),
+            ("mnt-by", "route/172.23.161.64/27")])
+        found = self.names(self.graph.dependents(("dn42.mntner", "DN42-MNT"), True))
+        self.assertEqual(len(found), len(self.graph.keys) - 1)
+        self.assertIn(("source", "mntner/SAM-MNT"), found)
+
+    def test_orphans(self):
+        self.assertEqual(self.graph.orphans(), [("dn42.person", "LONE-DN42")])
+        ret = subprocess.run(
+            [sys.executable, os.path.join(HERE, "dn42-schema.py"), "graph", self.path,
+             "--orphans", "-d", "SAM-MNT", "--format", "jsonl"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        self.assertEqual(ret.returncode, 0)
+        found = [(i["type"], i.get("from", i["object"]))
+                 for i in map(json.loads, ret.stdout.decode("utf-8").splitlines())]
+        self.assertEqual(found[0], ("orphan", "person/LONE-DN42"))
+        self.assertEqual(sorted(found[1:]), [
+            ("depends", name) for _, name in self.names(self.graph.dependents(
+                ("dn42.mntner", "SAM-MNT")))])
+
+
+class TestOverlaps(unittest.TestCase):
+    "overlaps"
+
+    OBJECTS = {
+        "inetnum/10.0.0.0/8": {"inetnum": "10.0.0.0 - 10.255.255.255"},
+        "inetnum/10.1.0.0/23": {"inetnum": "10.1.0.0 - 10.1.1.255"},
+        "inetnum/10.1.1.0/24": {"inetnum": "10.1.1.0 - 10.1.2.255"},
+        "inetnum/10.2.0.0/16": {"inetnum": "10.2.0.0 - 10.2.255.255"},
+        "inetnum/10.2.0.0/17": {"inetnum": "10.2.0.0 - 10.2.255.255"},
+        "inetnum/10.3.0.0/16": {"inetnum": "bad", "cidr": "10.3.0.0/16"},
+        "inetnum/10.3.0.0/17": {"inetnum": "10.3.0.0 - 10.3.127.255"},
+        "inet6num/fd00::/8": {"inet6num": "fd00:: - fdff:ffff:ffff:ffff:ffff:ffff:ffff:ffff"},
+        "inet6num/fd42::/16": {"inet6num": "fd42:: - fd43:ffff:ffff:ffff:ffff:ffff:ffff:ffff"},
+        "inet6num/fd43::/16": {"inet6num": "fd43:: - fd44:ffff:ffff:ffff:ffff:ffff:ffff:ffff"},
+        "route/10.1.0.0/24": {"route": "10.1.0.0/24", "origin": "AS1"},
+        "route/10.1.0.0/24-2": {"route": "10.1.0.0/24", "origin": "AS2"},
+        "route6/fd42::/48": {"route6": "fd42::/48", "origin": "AS1"},
+        "route6/fd42::/48-2": {"route6": "fd42::/48", "origin": "AS1"},
+    }
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def found(self, only=None):
+        return sorted((f["kind"], tuple(os.path.relpath(i, self.path) for i in f["objects"]))
+                      for f in schema.find_overlaps(self.path, only))
+
+    def test_kinds(self):
+        _registry(self.path, self.OBJECTS)
+        self.assertEqual(self.found(), [
+            ("duplicate", ("inetnum/10.2.0.0_16", "inetnum/10.2.0.0_17")),
+            ("overlap", ("inet6num/fd42::_16", "inet6num/fd43::_16")),
+            ("overlap", ("inetnum/10.1.0.0_23", "inetnum/10.1.1.0_24")),
+            ("route-conflict", ("route/10.1.0.0_24", "route/10.1.0.0_24-2")),
+            ("route-duplicate", ("route6/fd42::_48", "route6/fd42::_48-2")),
+        ])
+        only = {os.path.join(self.path, "route/10.1.0.0_24-2")}
+        self.assertEqual([kind for kind, _ in self.found(only)], ["route-conflict"])
+
+    def test_random(self):
+        rng = random.Random(7)
+        ranges = {}
+        for n in range(300):
+            lo = rng.randrange(1 << 16)
+            hi = min(lo + rng.choice((0, 1, 15, 255, 4095)), (1 << 16) - 1)
+            ranges["inetnum/10.0.0.0/%d" % (n)] = (lo, hi)
+        _registry(self.path, {name: {"inetnum": "%s - %s" % (
+            schema.to_ip(0x0A000000 + lo), schema.to_ip(0x0A000000 + hi))}
+            for name, (lo, hi) in ranges.items()})
+
+        want = []
+        for a, (a_lo, a_hi) in ranges.items():
+            for b, (b_lo, b_hi) in ranges.items():
+                if a == b:
+                    continue
+                if a_lo < b_lo <= a_hi < b_hi:
+                    want.append(("overlap", (a, b)))
+                elif (a_lo, a_hi) == (b_lo, b_hi) and a < b:
+                    want.append(("duplicate", (a, b)))
+        want = sorted((kind, tuple(i.replace("/", "_").replace("_", "/", 1) for i in objs))
+                      for kind, objs in want)
+        self.assertEqual([i for i in self.found() if i[0] == "overlap"],
+                         [i for i in want if i[0] == "overlap"])
+        self.assertEqual(len([i for i in self.found() if i[0] == "duplicate"]),
+                         len([i for i in want if i[0] == "duplicate"]))
+
+
+class TestRoa(unittest.TestCase):
+    "roa"
+
+    OBJECTS = {
+        "route/172.20.0.0/24": {"route": "172.20.0.0/24", "origin": "AS4242420001"},
+        "route/172.20.1.0/24": {"route": "172.20.1.0/24", "origin": "AS4242420002",
+                                "max-length": "26"},
+        "route/192.168.0.0/16": {"route": "192.168.0.0/16", "origin": "AS4242420003"},
+        "route/172.20.2.0/24": {"route": "bad", "origin": "AS4242420004"},
+        "route6/fd42::/48": {"route6": "fd42::/48", "origin": "AS4242420001"},
+        "route6/fd42:1::/48": {"route6": "fd42:1::/48", "origin": "AS4242420002"},
+    }
+
+    def setUp(self):
+        self.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "data")
+        _registry(self.path, self.OBJECTS)
+        for fn in ("filter.txt", "filter6.txt"):
+            shutil.copy(os.path.join(DATA, fn), self.path)
+        with open(os.path.join(self.path, "route6/fd42:1::_48"), "a") as f:
+            f.write("origin:             AS4242420003\norigin:             bogus\n")
+
+    def tearDown(self):
+        schema.log.default.level_console = self.level
+        self.tmp.cleanup()
+
+    def test_entries(self):
+        shifts = {4: 96, 6: 0}
+        self.assertEqual([(schema.prefix_str(net, mask + shifts[fam]), maxlen, asn)
+                          for fam, net, mask, maxlen, asn in schema.roa_entries(self.path)], [
+            ("172.20.0.0/24", 29, 4242420001),
+            ("172.20.1.0/24", 26, 4242420002),
+            ("fd42::/48", 64, 4242420001),
+            ("fd42:1::/48", 64, 4242420002),
+            ("fd42:1::/48", 64, 4242420003),
+        ])
+
+    def test_render(self):
+        roas = schema.roa_entries(self.path)
+        self.assertEqual(schema.roa_render(roas, "bird2", 4),
+                         "# dn42 ROA table, 2 entries\n"
+                         "route 172.20.0.0/24 max 29 as 4242420001;\n"
+                         "route 172.20.1.0/24 max 26 as 4242420002;\n")
+        self.assertEqual(schema.roa_render(roas, "frr", 6),
+                         "ipv6 prefix-list dn42-6 seq 5 permit fd42::/48 le 64\n"
+                         "ipv6 prefix-list dn42-6 seq 10 permit fd42:1::/48 le 64\n")
+        res = json.loads(schema.roa_render(roas, "json"))
+        self.assertEqual(res["metadata"]["counts"], 5)
+        self.assertEqual(res["roas"][4], {"prefix": "fd42:1::/48", "maxLength": 64,
+                                          "asn": "AS4242420003"})
+
+    def test_write(self):
+        out = os.path.join(self.tmp.name, "roa")
+        names = ["dn42_roa_46.json", "dn42_roa_bird1_4.conf", "dn42_roa_bird1_6.conf"]
+        written = schema.roa_write(self.path, out, ["bird1", "json"])
+        self.assertEqual(sorted(os.path.basename(i) for i in written), names)
+        self.assertEqual(schema.roa_write(self.path, out, ["bird1", "json"]), [])
+        self.assertEqual(schema.roa_write(self.path, out, ["bird1", "json"], True), [])
+
+        _registry(self.path, {"route6/fd42:2::/48": {"route6": "fd42:2::/48",
+                                                     "origin": "AS4242420005"}})
+        written = schema.roa_write(self.path, out, ["bird1", "json"])
+        self.assertEqual(sorted(os.path.basename(i) for i in written), [names[0], names[2]])
+        with open(os.path.join(out, names[2])) as f:
+            self.assertIn("roa fd42:2::/48 max 64 as 4242420005;", f.read())
+
+
+class TestSetExpander(unittest.TestCase):
+    "expand"
+
+    OBJECTS = {
+        "as-set/AS-A": {"as-set": "AS-A", "members": "AS1, AS-B", "mbrs-by-ref": "X-MNT"},
+        "as-set/AS-B": {"as-set": "AS-B", "members": "AS2 AS-A AS-MISSING"},
+        "aut-num/AS3": {"aut-num": "AS3", "member-of": "AS-A", "mnt-by": "X-MNT"},
+        "aut-num/AS4": {"aut-num": "AS4", "member-of": "AS-A", "mnt-by": "Y-MNT"},
+        "route/10.0.0.0/24": {"route": "10.0.0.0/24", "origin": "AS1"},
+        "route/10.0.1.0/24": {"route": "10.0.1.0/24", "origin": "AS2", "max-length": "26"},
+        "route/10.0.2.0/24": {"route": "10.0.2.0/24", "origin": "AS4"},
+        "route6/fd42::/48": {"route6": "fd42::/48", "origin": "AS3"},
+        "route-set/RS-A": {"route-set": "RS-A", "members": "10.9.0.0/16^+, RS-B"},
+        "route-set/RS-B": {"route-set": "RS-B",
+                           "members": "RS-A 10.8.0.0/16^24-28 10.7.0.0/33 AS-B"},
+    }
+
+    def setUp(self):
+        self.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+        self.tmp = tempfile.TemporaryDirectory()
+        _registry(self.tmp.name, self.OBJECTS)
+        self.expander = schema.SetExpander(self.tmp.name)
+
+    def tearDown(self):
+        schema.log.default.level_console = self.level
+        self.tmp.cleanup()
+
+    def routes(self, name, family=None):
+        return [(schema.prefix_str(net, mask), lo, hi)
+                for net, mask, lo, hi in self.expander.routes(name, family)]
+
+    def test_cycle(self):
+        e = self.expander
+        self.assertEqual(sorted(e.cycles), [["AS-A", "AS-B"], ["RS-A", "RS-B"]])
+        self.assertEqual(e.asns["AS-A"], {"AS1", "AS2", "AS3"})
+        self.assertIs(e.asns["AS-A"], e.asns["AS-B"])
+        self.assertEqual(dict((k, v) for k, v in e.missing.items() if v),
+                         {"AS-B": ["AS-MISSING"], "RS-B": ["10.7.0.0/33"]})
+        self.assertEqual((e.find("as-a"), e.find("AS-C")), ("AS-A", None))
+
+    def test_routes(self):
+        self.assertEqual(self.routes("AS-B"), [
+            ("10.0.0.0/24", 24, 24), ("10.0.1.0/24", 24, 24), ("fd42::/48", 48, 48)])
+        self.assertEqual(self.routes("RS-A", 4), [
+            ("10.0.0.0/24", 24, 24), ("10.0.1.0/24", 24, 24),
+            ("10.8.0.0/16", 24, 28), ("10.9.0.0/16", 16, 32)])
+        self.assertEqual(self.routes("RS-A"), self.routes("RS-B"))
+        self.assertEqual(
+            schema.expand_render(self.expander, "AS-B", "bird", max_length=True).split("\n")[:4],
+            ["AS_B_V4 = [", "    10.0.0.0/24,", "    10.0.1.0/24{24,26}", "];"])
+
+    def test_closure(self):
+        rng = random.Random(3)
+        nodes = set(range(60))
+        edges = {n: [rng.randrange(70) for _ in range(rng.randint(0, 3))] for n in nodes}
+        base = {n: {n} for n in nodes}
+        values, cycles = schema._set_closure(nodes, edges, base)
+
+        for n in nodes:
+            seen = {n}
+            todo = [n]
+            while todo:
+                for c in edges[todo.pop()]:
+                    if c in nodes and c not in seen:
+                        seen.add(c)
+                        todo.append(c)
+            self.assertEqual(values[n], seen, n)
+        for cycle in cycles:
+            self.assertTrue(all(values[c] == values[cycle[0]] for c in cycle))
+
+
+class TestWhoisIndex(unittest.TestCase):
+    "whois-serve lookups and refresh"
+
+    OBJECTS = {
+        "inetnum/10.0.0.0/8": {"inetnum": "10.0.0.0 - 10.255.255.255", "cidr": "10.0.0.0/8",
+                               "mnt-by": "A-MNT"},
+        "inetnum/10.1.0.0/16": {"inetnum": "10.1.0.0 - 10.1.255.255", "cidr": "10.1.0.0/16",
+                                "mnt-by": "X-MNT", "admin-c": "P1-DN42"},
+        "route/10.1.0.0/16": {"route": "10.1.0.0/16", "origin": "AS4242420001",
+                              "mnt-by": "X-MNT"},
+        "inet6num/fd00::/8": {"inet6num": "fd00:: - fdff:ffff:ffff:ffff:ffff:ffff:ffff:ffff",
+                              "cidr": "fd00::/8", "mnt-by": "A-MNT"},
+        "inet6num/fd42::/48": {"inet6num": "fd42:: - fd42::ffff:ffff:ffff:ffff:ffff",
+                               "cidr": "fd42::/48", "mnt-by": "X-MNT"},
+        "as-block/AS4242420000-AS4242429999": {"as-block": "AS4242420000 - AS4242429999",
+                                               "mnt-by": "A-MNT"},
+        "aut-num/AS4242420001": {"aut-num": "AS4242420001", "mnt-by": "X-MNT",
+                                 "admin-c": "P2-DN42", "tech-c": "P1-DN42"},
+        "mntner/X-MNT": {"mntner": "X-MNT", "mnt-by": "X-MNT"},
+    }
+
+    def setUp(self):
+        self.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+        self.tmp = tempfile.TemporaryDirectory()
+        _registry(self.tmp.name, self.OBJECTS)
+
+    def tearDown(self):
+        schema.log.default.level_console = self.level
+        self.tmp.cleanup()
+
+    def names(self, index, *args, **kwargs):
+        return [os.path.relpath(fn, self.tmp.name)
+                for fn in index.lookup(*args, **kwargs)]
+
+    def test_lookup(self):
+        index = schema.WhoisIndex(self.tmp.name)
+        self.assertEqual(self.names(index, "10.1.2.3"),
+                         ["inetnum/10.1.0.0_16", "route/10.1.0.0_16"])
+        self.assertEqual(self.names(index, "10.1.2.0/24", less=True),
+                         ["inetnum/10.0.0.0_8", "inetnum/10.1.0.0_16", "route/10.1.0.0_16"])
+        self.assertEqual(self.names(index, "10.2.0.0/16", types={"route"}), [])
+        self.assertEqual(self.names(index, "fd42::1"), ["inet6num/fd42::_48"])
+        self.assertEqual(self.names(index, "fd42:1::/48"), ["inet6num/fd00::_8"])
+        self.assertEqual(self.names(index, "10.1.2.0/24", exact=True), [])
+        self.assertEqual(self.names(index, "as4242420001"), ["aut-num/AS4242420001"])
+        self.assertEqual(self.names(index, "4242420005"),
+                         ["as-block/AS4242420000-AS4242429999"])
+
+        self.assertEqual(self.names(index, "x-mnt", inverse=["mnt-by"]), [
+            "aut-num/AS4242420001", "inet6num/fd42::_48", "inetnum/10.1.0.0_16",
+            "mntner/X-MNT", "route/10.1.0.0_16"])
+        self.assertEqual(self.names(index, "P1-DN42", inverse=["admin-c", "tech-c"]),
+                         ["aut-num/AS4242420001", "inetnum/10.1.0.0_16"])
+        self.assertEqual(self.names(index, "P2-DN42", inverse=["tech-c"]), [])
+
+        out = index.query("-T route 10.1.2.3")
+        self.assertTrue(out.startswith("% Information related to 'route/10.1.0.0/16':\n"
+                                       "route:              10.1.0.0/16\n"))
+        self.assertEqual(index.query("-i descr X-MNT"),
+                         "%ERROR:106: inverse lookup only on mnt-by, admin-c, tech-c\n\n")
+        self.assertEqual(index.query("-x 10.1.2.0/24"), "%ERROR:101: no entries found\n\n")
+        self.assertEqual(index.query("-T"), "%ERROR:106: option needs an argument\n\n")
+
+    def test_refresh(self):
+        for inotify in (True, False):
+            index = schema.WhoisIndex(self.tmp.name)
+            if not inotify:
+                index.watch.inotify = None
+            _registry(self.tmp.name, {
+                "inetnum/10.1.2.0/24": {"inetnum": "10.1.2.0 - 10.1.2.255",
+                                        "cidr": "10.1.2.0/24", "mnt-by": "Y-MNT"},
+                "aut-num/AS4242420001": {"aut-num": "AS4242420001", "mnt-by": "Y-MNT"},
+            })
+            os.remove(os.path.join(self.tmp.name, "route/10.1.0.0_16"))
+
+            self.assertEqual(len(index.refresh()), 3)
+            self.assertEqual(index.refresh(), [])
+            self.assertEqual(self.names(index, "10.1.2.3"), ["inetnum/10.1.2.0_24"])
+            self.assertEqual(self.names(index, "Y-MNT", inverse=["mnt-by"]),
+                             ["aut-num/AS4242420001", "inetnum/10.1.2.0_24"])
+            self.assertEqual(self.names(index, "P1-DN42", inverse=["tech-c"]), [])
+            self.assertNotIn("route", "".join(self.names(index, "X-MNT", inverse=["mnt-by"])))
+
+            self.tmp.cleanup()
+            _registry(self.tmp.name, self.OBJECTS)
+
+
+class TestMatchRoutes(unittest.TestCase):
+    "match-routes levels"
+
+    NAMES = [
+        "inetnum/10.0.0.0/8", "inetnum/10.26.0.0/16", "inetnum/10.26.0.0/24",
+        "inetnum/10.1.0.0/16", "route/10.26.0.0/16", "route/10.26.0.0/25",
+        "route/10.0.0.0/15", "route/192.168.0.0/24",
+        "inet6num/fd00::/8", "inet6num/fd42::/16", "inet6num/fd42::/32",
+        "route6/fd42::/16", "route6/fd40::/14", "route6/fe80::/10",
+    ]
+
+    def test_levels(self):
+        with tempfile.TemporaryDirectory() as path:
+            _registry(path, {n: {n.split("/")[0]: n.split("/", 1)[1], "mnt-by": "T-MNT"}
+                             for n in self.NAMES})
+            found = {(i["type"], i["name"]): i["parent"] and i["parent"]["name"]
+                     for i in schema.match_routes(path)}
+
+        self.assertEqual(found, {
+            ("route", "10.0.0.0/15"): "10.0.0.0/8",
+            ("route", "192.168.0.0/24"): None,
+            ("route6", "fd40::/14"): "fd00::/8",
+            ("route6", "fe80::/10"): None,
+        })
+
+
+class TestFmt(unittest.TestCase):
+    "fmt --all"
+
+    OBJECTS = {
+        "inetnum/172.20.0.0_24": "inetnum: 172.20.0.0-172.20.0.127\ncidr:  172.20.0.0/24\n"
+                                 "descr: first line\n  second line\nsource: DN42\n",
+        "mntner/EXAMPLE-MNT": "mntner:             EXAMPLE-MNT\nsource:             DN42\n",
+    }
+
+    def fmt(self, path, *args):
+        return subprocess.run(
+            [sys.executable, os.path.join(HERE, "dn42-schema.py"), "fmt", "--all", path]
+            + list(args), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+
+    def read(self, path):
+        res = {}
+        for name in self.OBJECTS:
+            with open(os.path.join(path, name)) as f:
+                res[name] = f.read()
+        return res
+
+    def test_check_is_idempotent(self):
+        with tempfile.TemporaryDirectory() as path:
+            for name, text in self.OBJECTS.items():
+                os.makedirs(os.path.dirname(os.path.join(path, name)), exist_ok=True)
+                with open(os.path.join(path, name), "w") as f:
+                    f.write(text)
+
+            res = self.fmt(path, "--check", "-j", "1")
+            self.assertEqual(res.returncode, 1)
+            self.assertIn(b"UNFMT", res.stdout)
+            self.assertEqual(self.read(path), self.OBJECTS)
+
+            self.assertEqual(self.fmt(path, "--fix", "-j", "1").returncode, 0)
+            fixed = self.read(path)
+            self.assertIn("172.20.0.0 - 172.20.0.255", fixed["inetnum/172.20.0.0_24"])
+            self.assertEqual(fixed["mntner/EXAMPLE-MNT"], self.OBJECTS["mntner/EXAMPLE-MNT"])
+
+            res = self.fmt(path, "--check", "--fix", "-j", "1")
+            self.assertEqual((res.returncode, res.stdout), (0, b""))
+            self.assertEqual(self.fmt(path, "--fix").returncode, 0)
+            self.assertEqual(self.read(path), fixed)
+
+
+class TestBench(unittest.TestCase):
+    "bench.py on a synthetic registry"
+
+    @classmethod
+    def setUpClass(cls):
+        argv, sys.argv = sys.argv, ["bench.py"]
+        try:
+            spec = importlib.util.spec_from_file_location("bench", os.path.join(HERE, "bench.py"))
+            cls.bench = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(cls.bench)
+        finally:
+            sys.argv = argv
+
+        cls.tmp = tempfile.TemporaryDirectory()
+        src = os.path.join(cls.tmp.name, "data")
+        _sample(src)
+        shutil.copytree(os.path.join(DATA, "as-block"), os.path.join(src, "as-block"))
+        for fn in ("filter.txt", "filter6.txt"):
+            shutil.copy(os.path.join(DATA, fn), src)
+        cls.path = cls.bench.synthetic(src, cls.tmp.name, 20, 42)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_synthetic(self):
+        files = self.bench.list_files(self.path)
+        self.assertEqual(len(files), 325)
+        self.assertEqual(_scan(self.path)[0], True)
+        self.assertEqual(self.bench.synthetic(None, self.tmp.name, 20, 42), self.path)
+
+        again = os.path.join(self.tmp.name, "again")
+        self.bench.synthesize(os.path.join(self.tmp.name, "data"), again, 20, 42)
+        for fn in files:
+            with open(fn) as f, open(os.path.join(again, os.path.relpath(fn, self.path))) as g:
+                self.assertEqual(f.read(), g.read())
+
+    def test_benchmarks(self):
+        res = {name: func(self.path, 1) for name, func in self.bench.BENCHMARKS.items()}
+        self.assertEqual(res["parse"]["objects"], 325)
+        self.assertEqual(res["validate"]["objects"], 325)
+        self.assertEqual((res["lookup"]["keys"], res["lookup"]["unresolved"]), (325, 0))
+        self.assertEqual(res["policy"]["status"], {"PASS": res["policy"]["checks"]})
+        self.assertEqual(res["remote"]["cache_entries"], res["remote"]["checks"])
+        self.assertEqual(res["hierarchy"]["objects"], 147)
+
+    def test_compare(self):
+        out = os.path.join(self.tmp.name, "parse.json")
+        ret = subprocess.run(
+            [sys.executable, os.path.join(HERE, "bench.py"), self.path, "-b", "parse",
+             "-r", "1", "-o", out, "--compare", out],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
+        self.assertEqual(ret.returncode, 0, ret.stderr)
+        with open(out) as f:
+            self.assertEqual(json.load(f)["results"][self.path]["parse"]["objects"], 325)
+        ratios = {i.split()[2]: i.split()[-1] for i in ret.stdout.decode("utf-8").splitlines()}
+        self.assertEqual((ratios["objects"], ratios["bytes"]), ("1.00x", "1.00x"))
+        self.assertIn("objects_per_sec", ratios)
+
+
+class TestRegistryStub(unittest.TestCase):
+    "test_policy() through registry-stub and RegistryClient"
+
+    ITEMS = [
+        ("mntner", "SAM-MNT", "SAM-MNT"),
+        ("aut-num", "AS4242422503", "SAM-MNT"),
+        ("aut-num", "AS4242422503", "DN42-MNT"),
+        ("route", "172.23.161.64/27", "SAM-MNT"),
+        ("inetnum", "172.20.0.0/24", "SAM-MNT"),
+        ("inet6num", "fd77:e464:b857::/48", "SAM-MNT"),
+        ("person", "NOT-THERE-DN42", "SAM-MNT"),
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.level = schema.log.default.level_console
+        schema.log.default.level_console = schema.log.VERB_NONE
+        cls.local = schema.LocalRegistry(DATA)
+        cls.server = schema.registry_stub(DATA, port=0)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        schema.log.default.level_console = cls.level
+
+    def test_round_trip(self):
+        client = schema.RegistryClient("http://%s:%d" % self.server.server_address[:2])
+        try:
+            for item in self.ITEMS:
+                self.assertEqual(schema.test_policy(*item, client),
+                                 schema.test_policy(*item, self.local), item)
+            self.assertEqual(
+                [schema.test_policy(*item, self.local) for item in self.ITEMS],
+                ["PASS", "PASS", "FAIL", "PASS", "FAIL", "PASS", "PASS"])
+
+            misses = client.misses
+            schema.test_policy(*self.ITEMS[1], client)
+            self.assertEqual(client.misses, misses)
+            self.assertGreater(client.hits, 0)
+        finally:
+            client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()